@@ -49,7 +49,7 @@ setup(name = "postomaat",
     author_email = "oli@wgwh.ch",
     package_dir={'':'src'},
     packages = ['postomaat','postomaat.plugins','postomaat.extensions'],
-    scripts = ["src/startscript/postomaat","src/tools/postomaat_conf"],
+    scripts = ["src/startscript/postomaat","src/tools/postomaat_conf","src/tools/postomaat_control","src/tools/postomaat_bench"],
     long_description = """Postomaat is a modular mail policy server written in python.""" ,
     data_files=[
                 ('/etc/postomaat',glob.glob('conf/*.dist')),
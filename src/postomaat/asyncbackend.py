@@ -0,0 +1,303 @@
+# -*- coding: UTF-8 -*-
+#   Copyright 2012-2018 Oli Schacher
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# asyncio backend (backend=asyncio), requires python >= 3.5
+# this module is only imported if the asyncio backend is configured
+
+import asyncio
+import concurrent.futures
+import inspect
+import logging
+import threading
+import time
+import traceback
+
+from postomaat.shared import Suspect, DUNNO, DEFER
+from postomaat.scansession import SessionHandler, format_response
+from postomaat.deadline import DeadlineExceeded
+from postomaat.stats import Statskeeper, timer
+
+
+def is_async_plugin(plugin):
+    """returns True if the plugin provides a native coroutine hook examine_async(suspect)"""
+    return inspect.iscoroutinefunction(getattr(plugin, 'examine_async', None))
+
+
+class AsyncSessionHandler(SessionHandler):
+
+    """handles all requests of one policy connection on the event loop"""
+
+    def __init__(self, reader, writer, config, plugins, executor):
+        SessionHandler.__init__(self, None, config, plugins)
+        self.reader = reader
+        self.writer = writer
+        self.executor = executor
+        self.readstart = None # timer() when the first line and the end of the last request were read
+        self.readend = None
+
+    async def getrequest(self):
+        """read one request from the stream. returns the values dict or None if the client closed the connection
+        or the request did not finish"""
+        values = {}
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                if values:
+                    self.logger.error('incoming request did not finish')
+                return None
+            line = line.decode('utf-8', 'replace').strip()
+            if line == '':
+                if not values:
+                    # ignore stray empty lines between requests
+                    continue
+                self.readend = timer()
+                return values
+            if not values:
+                self.readstart = timer()
+            try:
+                key, val = line.split('=', 1)
+                values[key] = val
+            except Exception:
+                self.logger.error('Invalid Protocol line: %s' % line)
+                return None
+
+    async def handlesession_async(self):
+        """handle requests on the connection until the client closes it or the keepalive timeout expires"""
+        keepalive = self.get_keepalive_timeout()
+        self.sessionstart = time.time()
+        try:
+            while True:
+                try:
+                    if keepalive > 0:
+                        values = await asyncio.wait_for(self.getrequest(), keepalive)
+                    else:
+                        values = await self.getrequest()
+                except asyncio.TimeoutError:
+                    self.logger.debug('Connection idle for %ss - closing' % keepalive)
+                    break
+                if values is None:
+                    break
+
+                self.action = DUNNO
+                self.arg = ""
+                self.requestcount += 1
+                self.trace = self.start_trace(self.readstart, self.readend)
+                try:
+                    await self.handlerequest_async(values)
+                except asyncio.CancelledError:
+                    # backend is shutting down
+                    self.action, self.arg = DEFER, "Temporarily unavailable... Please try again later."
+                    self.writer.write(format_response(self.action, self.arg))
+                    raise
+                writestart = timer()
+                self.writer.write(format_response(self.action, self.arg))
+                await self.writer.drain()
+                if self.trace is not None:
+                    self.trace.add('write', writestart, timer())
+                self.finish_trace()
+                if keepalive <= 0:
+                    break
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            self.logger.exception(e)
+        finally:
+            self.writer.close()
+            self.logger.debug('Session finished')
+
+    async def handlerequest_async(self, values):
+        """run the plugins on one request, sets self.action and self.arg"""
+        starttime = time.time()
+        port = None
+        try:
+            suspect = Suspect(values)
+            suspect.deadline = self.get_request_deadline(starttime)
+            suspect.trace = self.trace
+            self.attach_transaction(suspect)
+            try:
+                port = self.writer.get_extra_info('sockname')[1]
+                if port is not None:
+                    suspect.tags['incomingport'] = port
+            except Exception as e:
+                self.logger.warning('Could not get incoming port: %s' % str(e))
+
+            await self.run_plugins_async(suspect, self.plugins)
+            difftime = time.time() - starttime
+            suspect.tags['postomaat.scantime'] = "%.4f" % difftime
+            self.logger.debug(suspect)
+
+        except ValueError:
+            # Error in envelope send/receive address
+            self.action, self.arg = self.address_compliance_fail()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.logger.exception(e)
+
+        Statskeeper().record_request(time.time() - starttime, port, self.action)
+        self.set_trace_info(values, port)
+
+    async def run_plugins_async(self, suspect, pluglist):
+        """Run scannerplugins on suspect. Plugins providing examine_async are awaited directly,
+        synchronous plugins are run in the executor. With concurrent_plugins, concurrent_safe plugins
+        are started as tasks at the beginning and awaited in order"""
+        loop = asyncio.get_event_loop()
+        tasks = {}
+        if self.get_concurrent_plugins(pluglist):
+            for index, plugin in enumerate(pluglist):
+                if plugin.is_concurrent_safe():
+                    tasks[index] = loop.create_task(self.examine_plugin_async(suspect, plugin))
+        try:
+            for index, plugin in enumerate(pluglist):
+                if self.request_timed_out(suspect):
+                    break
+                try:
+                    self.logger.debug('Running plugin %s' % plugin)
+                    task = tasks.pop(index, None)
+                    if task is not None:
+                        ans = await task
+                    else:
+                        ans = await self.examine_plugin_async(suspect, plugin)
+                    if self.handle_plugin_result(suspect, plugin, ans):
+                        break
+                except asyncio.CancelledError:
+                    raise
+                except DeadlineExceeded:
+                    if self.handle_plugin_result(suspect, plugin, self.plugin_timed_out(plugin)):
+                        break
+                except Exception:
+                    exc = traceback.format_exc()
+                    self.logger.error('Plugin %s failed: %s' % (str(plugin), exc))
+                    Statskeeper().count_plugin_result(plugin, error=True)
+        finally:
+            # results of plugins after the decision are not needed anymore
+            for task in tasks.values():
+                task.cancel()
+
+    async def examine_plugin_async(self, suspect, plugin):
+        """returns the answer of plugin, from the verdict cache if possible.
+        raises DeadlineExceeded if the plugin did not finish within its time budget"""
+        starttime = timer()
+        try:
+            return await self._examine_plugin_async(suspect, plugin)
+        finally:
+            Statskeeper().record_plugin_call(plugin, timer() - starttime)
+
+    async def _examine_plugin_async(self, suspect, plugin):
+        cachekey, ans = self.get_cached_verdict(suspect, plugin)
+        if cachekey is None or ans is None:
+            deadline = self.get_plugin_deadline(suspect, plugin)
+            native = is_async_plugin(plugin)
+            if native:
+                coro = plugin.examine_async(suspect)
+            else:
+                # examine_with_deadline records the span of the plugin in the executor thread
+                coro = asyncio.get_event_loop().run_in_executor(self.executor, self.examine_with_deadline,
+                                                                suspect, plugin, deadline)
+            starttime = timer()
+            try:
+                if deadline is None:
+                    ans = await coro
+                else:
+                    try:
+                        ans = await asyncio.wait_for(coro, max(deadline - time.time(), 0))
+                    except asyncio.TimeoutError:
+                        raise DeadlineExceeded('plugin %s exceeded its time budget' % plugin)
+            finally:
+                if native and suspect.trace is not None:
+                    suspect.trace.add('examine_async %s' % plugin, starttime, timer())
+            self.store_verdict(suspect, plugin, cachekey, ans)
+        return ans
+
+
+class AsyncBackend(threading.Thread):
+
+    """Runs the listeners and all policy sessions of this process on one asyncio event loop.
+    Synchronous plugins are run in a bounded thread pool executor."""
+
+    def __init__(self, maxexecutorthreads=40):
+        threading.Thread.__init__(self)
+        self.name = 'Asyncio backend'
+        self.daemon = True
+        self.logger = logging.getLogger('%s.asyncbackend' % __package__)
+        self.maxexecutorthreads = maxexecutorthreads
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=maxexecutorthreads)
+        self.loop = asyncio.new_event_loop()
+        self.servers = {}
+        self.sessions = set()
+        self._running = threading.Event()
+        self.start()
+        self._running.wait()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.logger.debug('Asyncio backend initializing. maxexecutorthreads=%s' % self.maxexecutorthreads)
+        self.loop.call_soon(self._running.set)
+        try:
+            self.loop.run_forever()
+            # answer and close sessions still in progress
+            pending = list(self.sessions)
+            for task in pending:
+                task.cancel()
+            if pending:
+                self.loop.run_until_complete(asyncio.wait(pending, timeout=10))
+        finally:
+            self.loop.close()
+        self.logger.info('Asyncio backend shut down')
+
+    def add_server(self, policyserver):
+        """start serving the listening socket of a PolicyServer on the event loop"""
+        future = asyncio.run_coroutine_threadsafe(self._start_server(policyserver), self.loop)
+        future.result()
+
+    def remove_server(self, policyserver):
+        """stop serving a PolicyServer"""
+        if not self.loop.is_running():
+            return
+        future = asyncio.run_coroutine_threadsafe(self._stop_server(policyserver.port), self.loop)
+        try:
+            future.result(10)
+        except Exception as e:
+            self.logger.warning('Could not stop server on port %s: %s' % (policyserver.port, str(e)))
+
+    async def _start_server(self, policyserver):
+        def client_connected(reader, writer):
+            handler = AsyncSessionHandler(reader, writer, policyserver.controller.config,
+                                          policyserver.plugins, self.executor)
+            task = self.loop.create_task(handler.handlesession_async())
+            self.sessions.add(task)
+            task.add_done_callback(self.sessions.discard)
+
+        server = await asyncio.start_server(client_connected, sock=policyserver._socket)
+        self.servers[policyserver.port] = server
+        self.logger.info('policy server running on port %s (asyncio)' % policyserver.port)
+
+    async def _stop_server(self, port):
+        server = self.servers.pop(port, None)
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+
+    def shutdown(self):
+        for port in list(self.servers.keys()):
+            future = asyncio.run_coroutine_threadsafe(self._stop_server(port), self.loop)
+            try:
+                future.result(10)
+            except Exception:
+                pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.join(120)
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,541 @@
+# -*- coding: UTF-8 -*-
+#   Copyright 2012-2018 Oli Schacher
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# Load generator for the policy protocol (postomaat_bench): sends requests from a corpus file or synthesized
+# from DEFAULT_REQUEST_ATTRS to a running postomaat with a number of client threads, optionally at a fixed
+# rate and over persistent connections, and measures throughput, latency, answers and errors.
+# PluginBenchmark runs the examine of a single plugin the same way, against the stand-in services of
+# postomaat.standins instead of live DNS, SMTP, SQL and redis servers (postomaat_bench --plugin).
+
+import socket
+import threading
+import tempfile
+import time
+import json
+import sys
+import os
+
+try:
+    import ConfigParser
+except ImportError:
+    import configparser as ConfigParser
+
+from postomaat.shared import DEFAULT_REQUEST_ATTRS, DUNNO, Suspect, strip_address
+from postomaat.stats import Histogram, timer
+from postomaat.extensions.sql import SQL_EXTENSION_ENABLED
+from postomaat.standins import StubDNSServer, FakeSMTPRelay, FakeRedis, SQLiteFixture, use_stub_resolver, \
+    inject_sql_faults
+
+
+def read_corpus(fp):
+    """returns the requests of a file in the policy protocol format: name=value lines, requests separated
+    by empty lines. lines starting with # are ignored"""
+    requests = []
+    values = {}
+    for line in fp:
+        line = line.strip()
+        if line.startswith('#'):
+            continue
+        if line == '':
+            if values:
+                requests.append(values)
+                values = {}
+            continue
+        if '=' not in line:
+            raise ValueError('invalid request line: %s' % line)
+        name, value = line.split('=', 1)
+        values[name] = value
+    if values:
+        requests.append(values)
+    return requests
+
+
+def synthesize(count, vary=True):
+    """returns count requests with the attributes of DEFAULT_REQUEST_ATTRS. with vary, sender, recipient,
+    client and instance differ between the requests so they do not hit the caches of postomaat"""
+    requests = []
+    for index in range(count):
+        values = DEFAULT_REQUEST_ATTRS.copy()
+        if vary:
+            values.update({
+                'sender': 'sender%s@example.com' % index,
+                'recipient': 'recipient%s@example.org' % index,
+                'client_address': '10.%s.%s.%s' % ((index >> 16) & 255, (index >> 8) & 255, index & 255),
+                'queue_id': '%010X' % index,
+                'instance': 'bench.%s' % index,
+            })
+        requests.append(values)
+    return requests
+
+
+def format_request(values):
+    return ''.join('%s=%s\n' % (name, value) for name, value in values.items()).encode('utf-8') + b'\n'
+
+
+class PolicyClient(object):
+    """sends policy requests to a postomaat, one connection per request or a persistent connection"""
+
+    def __init__(self, host, port, timeout=10, persistent=False):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.persistent = persistent
+        self.sock = None
+        self.buffer = b''
+        self.reconnects = 0
+
+    def connect(self):
+        self.close()
+        self.sock = socket.create_connection((self.host, self.port), self.timeout)
+        self.buffer = b''
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except Exception:
+                pass
+            self.sock = None
+
+    def query(self, values):
+        """send a request, returns the action answered by postomaat (e.g. 'reject some reason')"""
+        data = format_request(values)
+        reused = self.sock is not None
+        if not reused:
+            self.connect()
+        try:
+            answer = self._exchange(data)
+        except EOFError:
+            if not reused:
+                raise
+            # the server closed the persistent connection (keepalive_timeout) before the request
+            self.reconnects += 1
+            self.connect()
+            answer = self._exchange(data)
+        if not self.persistent:
+            self.close()
+        return answer
+
+    def _exchange(self, data):
+        try:
+            self.sock.sendall(data)
+            while b'\n\n' not in self.buffer:
+                chunk = self.sock.recv(4096)
+                if not chunk:
+                    raise EOFError('connection closed by server')
+                self.buffer += chunk
+        except Exception:
+            self.close()
+            raise
+        answer, self.buffer = self.buffer.split(b'\n\n', 1)
+        answer = answer.decode('utf-8', 'replace').strip()
+        if not answer.startswith('action='):
+            self.close()
+            raise ValueError('invalid answer: %s' % answer)
+        return answer[len('action='):]
+
+
+class BenchResult(object):
+    """answers, errors and latencies of a benchmark run"""
+
+    def __init__(self):
+        self.histogram = Histogram()
+        self.actions = {}
+        self.errors = {}
+        self.requests = 0
+        self.reconnects = 0
+        self.duration = 0.0
+
+    def record(self, latency, action):
+        self.requests += 1
+        self.histogram.record(latency)
+        action = action.split(None, 1)[0].lower() if action else 'empty'
+        self.actions[action] = self.actions.get(action, 0) + 1
+
+    def record_error(self, error):
+        self.requests += 1
+        name = error.__class__.__name__
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+    def merge(self, other):
+        self.histogram.merge(other.histogram)
+        for name, count in other.actions.items():
+            self.actions[name] = self.actions.get(name, 0) + count
+        for name, count in other.errors.items():
+            self.errors[name] = self.errors.get(name, 0) + count
+        self.requests += other.requests
+        self.reconnects += other.reconnects
+
+    def as_dict(self):
+        """the results, latencies in seconds"""
+        latency = dict(('p%s' % str(q).replace('.', ''), value) for q, value in self.histogram.percentiles().items())
+        latency['mean'] = self.histogram.mean()
+        return dict(requests=self.requests, answered=self.histogram.count, errors=self.errors,
+                    reconnects=self.reconnects, duration=self.duration,
+                    throughput=self.histogram.count / self.duration if self.duration > 0 else 0.0,
+                    latency=latency, actions=self.actions)
+
+    def as_json(self):
+        return json.dumps(self.as_dict(), indent=2, sort_keys=True)
+
+    def as_text(self):
+        result = self.as_dict()
+        lines = [
+            'requests:   %s (%s answered, %s errors, %s reconnects)' % (
+                result['requests'], result['answered'], sum(self.errors.values()), result['reconnects']),
+            'duration:   %.2fs' % result['duration'],
+            'throughput: %.1f requests/s' % result['throughput'],
+            'latency:    mean %.2fms %s' % (result['latency']['mean'] * 1000, ' '.join(
+                'p%s %.2fms' % (q, value * 1000) for q, value in sorted(self.histogram.percentiles().items()))),
+            'actions:',
+        ]
+        for action, count in sorted(self.actions.items(), key=lambda item: -item[1]):
+            lines.append('  %-16s %8s %5.1f%%' % (action, count, 100.0 * count / max(result['answered'], 1)))
+        if self.errors:
+            lines.append('errors:')
+            for name, count in sorted(self.errors.items(), key=lambda item: -item[1]):
+                lines.append('  %-16s %8s' % (name, count))
+        return '\n'.join(lines) + '\n'
+
+
+class LoadGenerator(object):
+    """sends requests (cycling through the list) from concurrency client threads until count requests are sent
+    or duration seconds passed. with a rate (requests per second), requests are sent at fixed intervals and
+    their latency is measured from the time they were due, so slow answers do not hide the queueing they cause"""
+
+    def __init__(self, host, port, requests, concurrency=10, count=1000, duration=0, rate=0, persistent=False,
+                 timeout=10):
+        if not requests:
+            raise ValueError('no requests to send')
+        self.host = host
+        self.port = port
+        self.requests = requests
+        self.concurrency = max(concurrency, 1)
+        self.count = count
+        self.duration = duration
+        self.rate = rate
+        self.persistent = persistent
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._next = 0
+        self._starttime = None
+
+    def next_request(self):
+        """returns (index, due time) of the next request to send, None if the run is over"""
+        with self._lock:
+            index = self._next
+            if self.count and index >= self.count:
+                return None
+            self._next += 1
+        due = self._starttime + index / float(self.rate) if self.rate > 0 else None
+        if self.duration and (due or timer()) >= self._starttime + self.duration:
+            return None
+        return index, due
+
+    def make_client(self):
+        return PolicyClient(self.host, self.port, self.timeout, self.persistent)
+
+    def client(self, result):
+        client = self.make_client()
+        try:
+            while True:
+                entry = self.next_request()
+                if entry is None:
+                    break
+                index, due = entry
+                if due is not None:
+                    wait = due - timer()
+                    if wait > 0:
+                        time.sleep(wait)
+                start = timer() if due is None else due
+                try:
+                    action = client.query(self.requests[index % len(self.requests)])
+                except Exception as e:
+                    result.record_error(e)
+                    continue
+                result.record(timer() - start, action)
+        finally:
+            client.close()
+            result.reconnects = client.reconnects
+
+    def run(self):
+        """run the benchmark, returns a BenchResult"""
+        results = [BenchResult() for _ in range(self.concurrency)]
+        threads = [threading.Thread(target=self.client, args=(result,), name='Bench client %s' % index)
+                   for index, result in enumerate(results)]
+        for thread in threads:
+            thread.daemon = True
+        self._starttime = timer()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        total = BenchResult()
+        for result in results:
+            total.merge(result)
+        total.duration = timer() - self._starttime
+        return total
+
+
+class PluginClient(object):
+    """runs the examine of a plugin for each request, in place of a PolicyClient"""
+
+    def __init__(self, plugin):
+        self.plugin = plugin
+        self.reconnects = 0
+
+    def query(self, values):
+        ans = self.plugin.examine(Suspect(dict(values)))
+        if isinstance(ans, tuple):
+            ans = ans[0]
+        return DUNNO if ans is None else ans
+
+    def close(self):
+        pass
+
+
+# limiters of the ratelimit scenarios
+BENCH_LIMITERS = """
+limit name=fromaddr rate=10/30 fields=from_address action=REJECT message=Too many messages from ${from_address}
+limit name=fromdomain rate=5000/60 fields=from_domain action=DEFER message=Too many messages from ${from_domain}
+"""
+
+
+class PluginBenchmark(LoadGenerator):
+    """runs the examine of the plugin of a scenario (see SCENARIOS) for the requests like LoadGenerator sends them.
+    the stand-ins of the scenario are started with the latency and error rate (seconds, 0..1) of faults
+    ({'dns': (latency, errorrate), 'smtp': ..., 'sql': ..., 'redis': ...}). options are (section, option, value)
+    tuples overriding the plugin config, section None is the section of the plugin. zone are additional
+    dns records (see postomaat.standins.read_zone)"""
+
+    SCENARIOS = ('spf', 'ebl', 'callahead', 'ratelimit-sql', 'ratelimit-redis', 'blackwhitelist')
+
+    def __init__(self, scenario, requests, concurrency=10, count=1000, duration=0, rate=0, faults=None,
+                 options=None, zone=None):
+        if scenario not in self.SCENARIOS:
+            raise ValueError('unknown scenario %s, use one of %s' % (scenario, ', '.join(self.SCENARIOS)))
+        LoadGenerator.__init__(self, None, None, [dict(values) for values in requests], concurrency=concurrency,
+                               count=count, duration=duration, rate=rate)
+        self.scenario = scenario
+        self.faults = faults or {}
+        self.options = options or []
+        self.zone = zone or []
+        self.config = ConfigParser.RawConfigParser()
+        self.plugin = None
+        self.dns = None
+        self.smtp = None
+        self.redis = None
+        self.sqlfaults = None
+        self.databases = []
+        self.tempfiles = []
+
+    def make_client(self):
+        return PluginClient(self.plugin)
+
+    def run(self):
+        """start the stand-ins, load the plugin and run the benchmark, returns a BenchResult"""
+        try:
+            getattr(self, 'setup_%s' % self.scenario.replace('-', '_'))()
+            return LoadGenerator.run(self)
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        for service in (self.dns, self.smtp):
+            if service is not None:
+                service.stop()
+        for database in self.databases:
+            database.remove()
+        for filename in self.tempfiles:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+        self.databases = []
+        self.tempfiles = []
+
+    def standin_stats(self):
+        """the number of calls to the stand-ins"""
+        stats = {}
+        if self.dns is not None:
+            stats['dns_queries'] = self.dns.queries
+        if self.smtp is not None:
+            stats['smtp_connections'] = self.smtp.connections
+        if self.redis is not None:
+            stats['redis_commands'] = self.redis.commands
+        if self.sqlfaults is not None:
+            stats['sql_statements'] = self.sqlfaults.count
+        return stats
+
+    # -- stand-ins
+
+    def set_options(self, section, **options):
+        if not self.config.has_section(section):
+            self.config.add_section(section)
+        for option, value in options.items():
+            self.config.set(section, option, str(value))
+
+    def load_plugin(self, structured_name):
+        """load the plugin with the options of the scenario and the benchmark, returns its module"""
+        from postomaat.core import MainController
+        section = structured_name.rsplit('.', 1)[1]
+        for optsection, option, value in self.options:
+            self.set_options(optsection or section, **{option: value})
+        controller = MainController(self.config)
+        controller.propagate_core_defaults()
+        self.config.set('main', 'plugins', structured_name)
+        if not controller.load_plugins():
+            raise ValueError('could not load plugin %s' % structured_name)
+        self.plugin = controller.plugins[0]
+        return sys.modules[self.plugin.__module__]
+
+    def start_dns(self, records):
+        latency, errorrate = self.faults.get('dns', (0, 0))
+        self.dns = StubDNSServer(list(records) + list(self.zone), latency=latency, errorrate=errorrate)
+        self.dns.start()
+        use_stub_resolver(self.dns.address, self.dns.port)
+
+    def start_smtp(self, responses):
+        latency, errorrate = self.faults.get('smtp', (0, 0))
+        self.smtp = FakeSMTPRelay(responses, latency=latency, errorrate=errorrate)
+        self.smtp.start()
+
+    def make_redis(self):
+        latency, errorrate = self.faults.get('redis', (0, 0))
+        self.redis = FakeRedis(latency, errorrate)
+        return self.redis
+
+    def create_database(self, *statements):
+        """create a sqlite database with (statement, rows) tuples, returns its connection string"""
+        database = SQLiteFixture()
+        self.databases.append(database)
+        for statement, rows in statements:
+            database.execute(statement, rows)
+        return database.url
+
+    def require_sql(self):
+        if not SQL_EXTENSION_ENABLED:
+            raise ValueError('scenario %s needs sqlalchemy' % self.scenario)
+
+    def inject_sql(self, connectstring):
+        if not SQL_EXTENSION_ENABLED:
+            return
+        latency, errorrate = self.faults.get('sql', (0, 0))
+        self.sqlfaults = inject_sql_faults(connectstring, latency, errorrate)
+
+    def write_file(self, text):
+        fd, filename = tempfile.mkstemp(prefix='postomaat-bench-')
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(text)
+        self.tempfiles.append(filename)
+        return filename
+
+    # -- scenarios
+
+    def setup_spf(self):
+        """SPFPlugin with the sender domains to check in sql (in a domain_selective_spf_file without sqlalchemy).
+        example.com permits the first half of 192.0.2.0/24, the private client addresses of synthesized requests
+        are moved to this network"""
+        if SQL_EXTENSION_ENABLED:
+            url = self.create_database(
+                ('CREATE TABLE domain (domain_name VARCHAR(255), check_spf INTEGER)', None),
+                ('INSERT INTO domain VALUES (?, ?)', [('example.com', 1), ('example.net', 1), ('example.org', 0)]))
+            self.set_options('SPFPlugin', dbconnection=url, domain_selective_spf_file='')
+            self.inject_sql(url)
+        else:
+            self.set_options('SPFPlugin', dbconnection='',
+                             domain_selective_spf_file=self.write_file('example.com\nexample.net\n'))
+        self.start_dns([
+            ('example.com', 'TXT', '"v=spf1 ip4:192.0.2.0/25 -all"'),
+            ('example.net', 'TXT', '"v=spf1 include:_spf.example.com ~all"'),
+            ('_spf.example.com', 'TXT', '"v=spf1 ip4:198.51.100.0/24 -all"'),
+        ])
+        for values in self.requests:
+            address = values.get('client_address', '')
+            if address.startswith('10.'):
+                values['client_address'] = '192.0.2.%s' % address.rsplit('.', 1)[1]
+        self.set_options('SPFPlugin', ip_whitelist_file='', on_fail='REJECT', on_softfail='DUNNO')
+        module = self.load_plugin('postomaat.plugins.spfcheck.SPFPlugin')
+        if not module.HAVE_SPF:
+            raise ValueError('scenario spf needs pyspf')
+
+    def setup_ebl(self):
+        """EBLLookup with every tenth sender of the requests listed"""
+        self.set_options('EBLLookup', dnszone='ebl.bench.example', whitelist_file='')
+        module = self.load_plugin('postomaat.plugins.ebl-lookup.EBLLookup')
+        if not module.DNSQUERY_EXTENSION_ENABLED:
+            raise ValueError('scenario ebl needs dnspython or pydns')
+        senders = sorted(set(strip_address(values.get('sender', '')) for values in self.requests))
+        records = []
+        for sender in senders[::10]:
+            name = '%s.ebl.bench.example' % self.plugin._create_hash(self.plugin._email_normalise(sender))
+            records.append((name, 'A', '127.0.0.2'))
+            records.append((name, 'TXT', '"listed by the benchmark"'))
+        self.start_dns(records)
+
+    def setup_callahead(self):
+        """AddressCheck with the domain overrides in sql and the cache in redis, asking a relay that rejects the
+        call-ahead test address and the recipients ending with 3. the relay is a static ip address: the names of
+        mx records would be resolved by the system resolver on connect"""
+        url = self.create_database(
+            ('CREATE TABLE ca_configoverride (domain VARCHAR(255), confkey VARCHAR(255), confvalue VARCHAR(255))', None),
+            ('INSERT INTO ca_configoverride VALUES (?, ?, ?)', [('example.net', 'enabled', '0')]))
+        self.start_smtp({'rbxzg133-7tst@*': (550, '5.1.1 User unknown'), '*3@*': (550, '5.1.1 User unknown')})
+        self.set_options('AddressCheck', dbconnection=url, cache_storage='redis')
+        self.set_options('ca_default', server='static:%s' % self.smtp.address, port=self.smtp.port, use_tls=0)
+        self.inject_sql(url)
+        module = self.load_plugin('postomaat.plugins.call-ahead.AddressCheck')
+        self.plugin.cache = module.RedisCache(self.config, self.make_redis())
+
+    def setup_ratelimit_sql(self):
+        """RateLimitPlugin with the sqlalchemy backend on BENCH_LIMITERS"""
+        self.require_sql()
+        # created here as sqlite only generates the ids of INTEGER PRIMARY KEY columns, not of BIGINT ones
+        url = self.create_database(
+            ('CREATE TABLE postomaat_ratelimit (eventid INTEGER PRIMARY KEY, eventname VARCHAR(255) NOT NULL, '
+             'occurence INTEGER NOT NULL)', None),
+            ('CREATE INDEX udx_ev_oc ON postomaat_ratelimit (eventname, occurence)', None))
+        self.set_options('RateLimitPlugin', limiterfile=self.write_file(BENCH_LIMITERS), backendtype='sqlalchemy',
+                         backendconfig=url)
+        self.inject_sql(url)
+        self.load_plugin('postomaat.plugins.ratelimit.RateLimitPlugin')
+
+    def setup_ratelimit_redis(self):
+        """RateLimitPlugin with the redis backend on BENCH_LIMITERS"""
+        self.set_options('RateLimitPlugin', limiterfile=self.write_file(BENCH_LIMITERS), backendtype='redis',
+                         backendconfig='localhost:6379:0')
+        module = self.load_plugin('postomaat.plugins.ratelimit.RateLimitPlugin')
+        if 'redis' not in module.AVAILABLE_RATELIMIT_BACKENDS:
+            raise ValueError('scenario ratelimit-redis needs the redis module')
+        backend = module.RedisBackend(self.config.get(self.plugin.section, 'backendconfig'))
+        backend.redis = self.make_redis()
+        self.plugin.backend_instance = backend
+
+    def setup_blackwhitelist(self):
+        """BlackWhiteList with a global blacklist_from entry for the senders ending with 3, a whitelist_from entry
+        for example.org and 1000 per recipient entries"""
+        self.require_sql()
+        rows = [('$GLOBAL', 'blacklist_from', '*3@example.com'), ('%example.org', 'whitelist_from', '*7@example.com')]
+        rows.extend(('recipient%s@example.org' % index, 'whitelist_from', 'partner%s@example.net' % index)
+                    for index in range(1000))
+        url = self.create_database(
+            ('CREATE TABLE userpref (prefid INTEGER PRIMARY KEY, username VARCHAR(100) NOT NULL, '
+             'preference VARCHAR(30) NOT NULL, value VARCHAR(100) NOT NULL)', None),
+            ('INSERT INTO userpref (username, preference, value) VALUES (?, ?, ?)', rows))
+        self.set_options('BlackWhiteList', dbconnection=url)
+        self.inject_sql(url)
+        self.load_plugin('postomaat.plugins.blackwhitelist.BlackWhiteList')
+
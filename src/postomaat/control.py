@@ -0,0 +1,366 @@
+# -*- coding: UTF-8 -*-
+#   Copyright 2012-2018 Oli Schacher
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# Control server on a unix socket: one command per connection, the answer is sent as text (JSON for
+# structured data) and the connection is closed. Commands are run by the control thread of the main process,
+# commands changing the state of caches or lists are broadcast to the worker processes (backend=process).
+#
+# example: echo "latency" | socat - UNIX-CONNECT:/var/run/postomaat/control.sock
+
+import os
+import socket
+import stat
+import threading
+import logging
+import json
+
+import postomaat.shared
+from postomaat.shared import get_verdictcache, get_transactionmemo
+from postomaat.stats import Statskeeper
+from postomaat.scansession import format_threadinfo
+import postomaat.profiler
+import postomaat.trace
+
+HELP = """commands:
+help                                  this text
+status                                uptime, backend and statistics counters
+pool                                  worker pool and the state of each worker with its current threadinfo
+queue                                 sessions waiting for a worker
+latency                               latency percentiles (seconds) per port, action and plugin
+plugins                               calls, time, actions, errors and decisions per plugin
+caches                                size and hits of the caches (of the main process)
+flush <default|verdicts|transactions|all>
+                                      clear a cache (also in all worker processes)
+reload-lists                          reload the list and rule files of all plugins (also in all worker processes)
+callahead blacklist                   show the call-ahead server blacklist
+callahead unblacklist <relay|domain>  remove a server from the call-ahead blacklist
+callahead wipe-address <address>      remove an address from the call-ahead cache
+callahead wipe-domain <domain>        remove all addresses of a domain from the call-ahead cache
+callahead counts                      number of positive and negative call-ahead cache entries
+ratelimit count <event>               current count of a rate limit event (event is limiter name + values)
+ratelimit clear <event>               reset a rate limit event (also in all worker processes)
+slow [count]                          the last slow requests (slow_request_threshold) with their spans (milliseconds)
+profile [seconds]                     sample the stacks of all threads (also in all worker processes) for some
+                                      seconds, written to profile_dir in flamegraph collapsed format
+"""
+
+# commands changing the state of the process they run in, see run_local_command
+LOCAL_COMMANDS = ('flush', 'reload-lists', 'ratelimit-clear', 'profile')
+
+
+def _unique(plugins):
+    seen = set()
+    result = []
+    for plugin in plugins:
+        if id(plugin) not in seen:
+            seen.add(id(plugin))
+            result.append(plugin)
+    return result
+
+
+def run_local_command(command, plugins):
+    """run a command changing caches or lists of the current process (LOCAL_COMMANDS) on plugins.
+    returns a result dict"""
+    args = command.split()
+    if not args or args[0] not in LOCAL_COMMANDS:
+        raise ValueError('unknown command: %s' % command)
+    name = args[0]
+    plugins = _unique(plugins)
+
+    if name == 'flush':
+        what = args[1] if len(args) > 1 else 'all'
+        if what not in ('default', 'verdicts', 'transactions', 'all'):
+            raise ValueError('unknown cache: %s' % what)
+        flushed = []
+        if what in ('default', 'all') and postomaat.shared.DEFAULTCACHE is not None:
+            postomaat.shared.DEFAULTCACHE.clear()
+            flushed.append('default')
+        if what in ('verdicts', 'all'):
+            get_verdictcache().clear()
+            flushed.append('verdicts')
+        if what in ('transactions', 'all'):
+            get_transactionmemo().clear()
+            flushed.append('transactions')
+        return dict(flushed=flushed)
+
+    if name == 'reload-lists':
+        reloaded = {}
+        for plugin in plugins:
+            reload_lists = getattr(plugin, 'reload_lists', None)
+            if reload_lists is None:
+                continue
+            filenames = reload_lists()
+            if filenames:
+                reloaded.setdefault(str(plugin), []).extend(filenames)
+        return dict(reloaded=reloaded)
+
+    if name == 'profile':
+        duration = float(args[1]) if len(args) > 1 else None
+        return dict(profile=postomaat.profiler.start(duration))
+
+    # ratelimit-clear <event>
+    if len(args) != 2:
+        raise ValueError('usage: ratelimit clear <event>')
+    cleared = 0
+    for plugin in plugins:
+        backend = getattr(plugin, 'backend_instance', None)
+        if backend is not None:
+            backend.clear(args[1])
+            cleared += 1
+    return dict(cleared=cleared)
+
+
+class ControlServer(object):
+    """accepts control connections on a unix socket, see HELP for the commands"""
+
+    def __init__(self, controller, path):
+        self.controller = controller
+        self.path = path
+        self.logger = logging.getLogger('%s.control' % __package__)
+        self._socket = None
+        self.stayalive = True
+
+    def start(self):
+        if os.path.exists(self.path):
+            if not stat.S_ISSOCK(os.stat(self.path).st_mode):
+                raise ValueError('%s exists and is not a socket' % self.path)
+            # left over from a previous run
+            os.unlink(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # the socket must never be accessible to other users, not even between bind and chmod
+        oldumask = os.umask(0o177)
+        try:
+            sock.bind(self.path)
+        finally:
+            os.umask(oldumask)
+        os.chmod(self.path, 0o600)
+        sock.listen(5)
+        self._socket = sock
+        thread = threading.Thread(name='Control server', target=self.serve)
+        thread.daemon = True
+        thread.start()
+        self.logger.info('Control server listening on %s' % self.path)
+
+    def shutdown(self):
+        self.stayalive = False
+        if self._socket is not None:
+            try:
+                # wakes up the accept() of the control thread
+                self._socket.shutdown(socket.SHUT_RDWR)
+            except Exception:
+                pass
+            try:
+                self._socket.close()
+            except Exception:
+                pass
+            self._socket = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def serve(self):
+        sock = self._socket
+        while self.stayalive:
+            try:
+                conn, _ = sock.accept()
+            except Exception:
+                if self.stayalive:
+                    self.logger.error('Control server accept failed, shutting down')
+                break
+            thread = threading.Thread(name='Control connection', target=self.handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def handle(self, conn):
+        try:
+            conn.settimeout(10)
+            data = b''
+            while b'\n' not in data and len(data) < 4096:
+                chunk = conn.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+            command = data.decode('utf-8', 'replace').strip()
+            self.logger.info('Control command: %s' % command)
+            conn.sendall(self.execute(command).encode('utf-8'))
+        except Exception as e:
+            self.logger.error('Control connection failed: %s' % str(e))
+        finally:
+            conn.close()
+
+    def execute(self, command):
+        """run command, returns the answer text"""
+        args = command.split()
+        if not args:
+            return HELP
+        method = getattr(self, 'cmd_%s' % args[0].replace('-', '_'), None)
+        if method is None:
+            return 'ERROR: unknown command %s\n%s' % (args[0], HELP)
+        try:
+            result = method(*args[1:])
+        except TypeError as e:
+            return 'ERROR: wrong arguments for %s: %s\n' % (args[0], str(e))
+        except ValueError as e:
+            return 'ERROR: %s\n' % str(e)
+        except Exception as e:
+            self.logger.exception(e)
+            return 'ERROR: %s\n' % str(e)
+        if isinstance(result, str):
+            return result
+        return json.dumps(result, indent=2, sort_keys=True, default=str) + '\n'
+
+    def get_plugins(self):
+        """all plugin instances of the main process, including those of single ports"""
+        plugins = list(self.controller.plugins)
+        for server in self.controller.servers:
+            plugins.extend(server.plugins or [])
+        return _unique(plugins)
+
+    def run_everywhere(self, command):
+        """run a local command in this process and all worker processes"""
+        result = dict(main=run_local_command(command, self.get_plugins()))
+        procpool = self.controller.procpool
+        if procpool is not None:
+            result['workers'] = procpool.broadcast(command)
+        return result
+
+    def cmd_help(self):
+        return HELP
+
+    def cmd_status(self):
+        stats = Statskeeper()
+        return dict(uptime=stats.uptime(), backend=self.controller.config.get('performance', 'backend'),
+                    threads=stats.numthreads(), counters=stats.get_counters())
+
+    def cmd_pool(self):
+        providers = Statskeeper().provider_stats(('threadpool', 'procpool'))
+        result = {}
+        threadpool = self.controller.threadpool
+        if threadpool is not None:
+            result['threadpool'] = providers.get('threadpool', {})
+            result['threadpool']['threads'] = [dict(name=worker.name, state=worker.workerstate,
+                                                    threadinfo=format_threadinfo(getattr(worker, 'threadinfo', '')))
+                                               for worker in list(threadpool.workers)]
+        if self.controller.procpool is not None:
+            result['procpool'] = providers.get('procpool', {})
+        if self.controller.asyncbackend is not None:
+            result['asyncio'] = dict(maxexecutorthreads=self.controller.asyncbackend.maxexecutorthreads)
+        return result
+
+    def cmd_queue(self):
+        for pool in (self.controller.threadpool, self.controller.procpool):
+            if pool is not None:
+                return dict(queue_depth=pool.queue_depth(), queue_wait=pool.queue_wait())
+        return dict(queue_depth=0, queue_wait=0.0)
+
+    def cmd_latency(self):
+        result = {}
+        for name, histogram in Statskeeper().get_histograms().items():
+            entry = dict(count=histogram.count, mean=histogram.mean())
+            for q, value in histogram.percentiles().items():
+                entry['p%s' % str(q).replace('.', '')] = value
+            result[name] = entry
+        return result
+
+    def cmd_plugins(self):
+        return Statskeeper().plugin_stats()
+
+    def cmd_caches(self):
+        counters = Statskeeper().get_counters()
+        result = dict(verdicts=get_verdictcache().stats(), transactions=get_transactionmemo().stats(),
+                      verdictlookups=dict(hits=counters.get('verdictcache.hits', 0),
+                                          misses=counters.get('verdictcache.misses', 0)))
+        if postomaat.shared.DEFAULTCACHE is not None:
+            result['default'] = postomaat.shared.DEFAULTCACHE.stats()
+        return result
+
+    def cmd_flush(self, what='all'):
+        return self.run_everywhere('flush %s' % what)
+
+    def cmd_reload_lists(self):
+        return self.run_everywhere('reload-lists')
+
+    def get_callahead_cache(self):
+        for plugin in self.get_plugins():
+            if plugin.__class__.__name__ == 'AddressCheck':
+                plugin._init_cache(plugin.config)
+                if plugin.cache is not None:
+                    return plugin.cache
+        raise ValueError('no call-ahead plugin with a cache loaded')
+
+    def cmd_callahead(self, subcommand, argument=None):
+        cache = self.get_callahead_cache()
+        if subcommand == 'blacklist':
+            return [dict(domain=domain, relay=relay, reason=reason, expires=expires)
+                    for domain, relay, reason, expires in cache.get_blacklist()]
+        if subcommand == 'counts':
+            positive, negative = cache.get_total_counts()
+            return dict(positive=positive, negative=negative)
+        if argument is None:
+            raise ValueError('callahead %s needs an argument' % subcommand)
+        if subcommand == 'unblacklist':
+            return dict(removed=cache.unblacklist(argument))
+        if subcommand == 'wipe-address':
+            return dict(removed=cache.wipe_address(argument))
+        if subcommand == 'wipe-domain':
+            return dict(removed=cache.wipe_domain(argument))
+        raise ValueError('unknown callahead command %s' % subcommand)
+
+    def cmd_ratelimit(self, subcommand, event):
+        if subcommand == 'count':
+            counts = {}
+            for plugin in self.get_plugins():
+                backend = getattr(plugin, 'backend_instance', None)
+                if backend is not None:
+                    counts[str(plugin)] = backend.count(event)
+            if not counts:
+                raise ValueError('no rate limit backend in use in the main process')
+            return counts
+        if subcommand == 'clear':
+            return self.run_everywhere('ratelimit-clear %s' % event)
+        raise ValueError('unknown ratelimit command %s' % subcommand)
+
+    def cmd_slow(self, count='10'):
+        if postomaat.trace.SETTINGS['threshold'] <= 0:
+            raise ValueError('slow request tracing is disabled (slow_request_threshold)')
+        return postomaat.trace.get_slow_requests(int(count))
+
+    def cmd_profile(self, seconds=None):
+        duration = None
+        if seconds is not None:
+            duration = float(seconds)
+            if duration <= 0:
+                raise ValueError('profile duration must be positive')
+        return self.controller.start_profiler(duration)
+
+
+def send_command(path, command, timeout=30):
+    """send command to the control server listening on path, returns the answer"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        sock.sendall((command.strip() + '\n').encode('utf-8'))
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        sock.close()
+    return b''.join(chunks).decode('utf-8', 'replace')
@@ -23,9 +23,13 @@ import time
 import traceback
 import re
 import inspect
-from postomaat.shared import Suspect
-from postomaat.scansession import SessionHandler
-from postomaat.stats import StatsThread
+from postomaat.shared import Suspect, get_verdictcache, get_transactionmemo
+from postomaat.scansession import SessionHandler, format_response
+from postomaat.stats import StatsThread, Statskeeper
+from postomaat.metrics import MetricsServer
+from postomaat.control import ControlServer
+import postomaat.profiler
+import postomaat.trace
 import threading
 from postomaat.threadpool import ThreadPool
 import postomaat.procpool
@@ -33,6 +37,11 @@ import multiprocessing
 import multiprocessing.reduction
 import code
 import datetime
+import select
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 from multiprocessing.reduction import ForkingPickler
 try:
@@ -120,6 +129,24 @@ class MainController(object):
                 'default':"9998",
             },
             
+            'metrics_port':{
+                'section':'main',
+                'description':"port of the http listener serving statistics in the prometheus text format on /metrics. 0: disabled",
+                'default':"0",
+            },
+            
+            'metrics_bindaddress':{
+                'section':'main',
+                'description':"address of the metrics listener",
+                'default':"127.0.0.1",
+            },
+            
+            'controlsocket':{
+                'section':'main',
+                'description':"path of the unix socket for runtime control commands (postomaat_control). empty: disabled",
+                'default':"",
+            },
+            
             #performance section
             'minthreads':{
                 'default':"2",
@@ -129,7 +156,7 @@ class MainController(object):
             'maxthreads':{
                 'default':"40",
                 'section':'performance',
-                'description':'maximum scanner threads',
+                'description':'maximum scanner threads. With backend=asyncio this is the maximum number of executor threads for plugins without an examine_async hook',
             },
 
             'address_compliance_checker': {
@@ -150,12 +177,187 @@ class MainController(object):
             'backend': {
                 'default': "thread",
                 'section': 'performance',
-                'description': "Method for parallelism, either 'thread' or 'process' ",
+                'description': "Method for parallelism, either 'thread', 'process' or 'asyncio' (python 3 only)",
+            },
+            'keepalive_timeout': {
+                'default': "",
+                'section': 'performance',
+                'description': "Postfix keeps policy connections open and sends further requests on them. Seconds to wait for the next request on an idle connection. 0 closes the connection after each request. Empty: 10 with backend=asyncio, 0 otherwise, as an idle connection occupies a worker thread/process with the thread and process backends.",
+            },
+            'verdictcache_ttl': {
+                'default': "0",
+                'section': 'performance',
+                'description': "Seconds to memoize the verdict of plugins declaring the request attributes their verdict depends on (eg. SPF, GeoIP, RDNS, HELO checks). Can be overridden with verdictcache_ttl in the plugin section. 0 disables the verdict cache.",
+            },
+            'verdictcache_size': {
+                'default': "10000",
+                'section': 'performance',
+                'description': "Maximum number of verdicts in the verdict cache (per process)",
+            },
+            'request_timeout': {
+                'default': "0",
+                'section': 'performance',
+                'description': "Seconds from receiving a request until the answer must be sent. Plugins not started until then are skipped, DNS, SQL and call-ahead timeouts are limited to the time left. Should be lower than postfix' smtpd_policy_service_timeout (default 100s). 0 disables the request deadline.",
+            },
+            'plugin_timeout': {
+                'default': "0",
+                'section': 'performance',
+                'description': "Time budget in seconds for each plugin, can be overridden with plugin_timeout in the plugin section. The answer of a plugin running longer is replaced by timeout_action. 0: no per plugin budget",
+            },
+            'timeout_action': {
+                'default': "dunno",
+                'section': 'performance',
+                'description': "Action for plugins exceeding their time budget and requests exceeding request_timeout. With dunno the remaining plugins still run (unless the request deadline has passed)",
+            },
+            'timeout_message': {
+                'default': "",
+                'section': 'performance',
+                'description': "Message returned with timeout_action",
+            },
+            'concurrent_plugins': {
+                'default': "0",
+                'section': 'performance',
+                'description': "Start plugins marked as side effect free (eg. spfcheck, ebl-lookup, or any plugin with concurrent=1 in its section) concurrently at the beginning of a request. Results are still evaluated in the configured order, the first decision other than DUNNO wins.",
+            },
+            'concurrent_plugins_threads': {
+                'default': "20",
+                'section': 'performance',
+                'description': "Threads running concurrent plugins (thread and process backend, shared by all sessions of a process)",
+            },
+            'transaction_memo_size': {
+                'default': "1000",
+                'section': 'performance',
+                'description': "Maximum number of smtp transactions (postfix 'instance') to remember plugin verdicts for, so the checks depending only on client, helo and sender run once per transaction instead of once per recipient. 0 disables the transaction memo.",
+            },
+            'transaction_memo_ttl': {
+                'default': "600",
+                'section': 'performance',
+                'description': "Seconds after the last request of a smtp transaction its memo is discarded",
+            },
+            'thread_idle_timeout': {
+                'default': "30",
+                'section': 'performance',
+                'description': "Seconds a worker thread above minthreads waits for a session before it ends (backend=thread)",
+            },
+            'thread_spawn_batch': {
+                'default': "4",
+                'section': 'performance',
+                'description': "Minimum number of worker threads started at once when sessions wait without an idle worker (backend=thread)",
+            },
+            'thread_scale_wait': {
+                'default': "0.05",
+                'section': 'performance',
+                'description': "Start more worker threads if sessions wait longer than this many seconds in the queue (backend=thread)",
+            },
+            'listen_backlog': {
+                'default': "128",
+                'section': 'performance',
+                'description': "Backlog of the listening sockets, connections the kernel queues before they are accepted",
+            },
+            'shed_queue_depth': {
+                'default': "0",
+                'section': 'performance',
+                'description': "Answer new requests right away with shed_action if this many sessions wait for a worker. 0: disabled",
+            },
+            'shed_queue_wait': {
+                'default': "0",
+                'section': 'performance',
+                'description': "Answer new requests right away with shed_action if sessions wait longer than this many seconds for a worker thread. 0: disabled",
+            },
+            'shed_action': {
+                'default': "dunno",
+                'section': 'performance',
+                'description': "Action for requests shed by admission control",
+            },
+            'shed_message': {
+                'default': "",
+                'section': 'performance',
+                'description': "Message returned with shed_action",
+            },
+            'shed_read_timeout': {
+                'default': "0.5",
+                'section': 'performance',
+                'description': "Seconds a shed connection may take to send its request. shed requests are read and answered by a separate thread, connections not sending their request in time are closed without answer",
+            },
+            'process_accept': {
+                'default': "queue",
+                'section': 'performance',
+                'description': "How connections get to the worker processes with backend=process. 'queue': the main process accepts them and passes them to the workers through a queue. 'prefork': each worker process accepts connections on the listening sockets itself, the main process only supervises",
+            },
+            'reuse_unchanged_plugins': {
+                'default': "1",
+                'section': 'performance',
+                'description': "On reload, keep the loaded instance of plugins whose config section did not change (including their caches and connections) instead of creating a new one",
+            },
+            'rolling_reload_batch': {
+                'default': "2",
+                'section': 'performance',
+                'description': "With backend=process, reload replaces this many worker processes at a time, each batch once its replacements loaded their plugins. 0: start a complete new process pool on reload",
             },
             'initialprocs': {
                 'default': "0",
                 'section': 'performance',
-                'description': "Initial number of processes when backend='process'. If 0 (the default), automatically selects twice the number of available virtual cores. Despite its 'initial'-name, this number currently is not adapted automatically.",
+                'description': "Initial number of processes when backend='process'. If 0 (the default), automatically selects twice the number of available virtual cores. The number is adapted to the load between minprocs and maxprocs.",
+            },
+            'minprocs': {
+                'default': "0",
+                'section': 'performance',
+                'description': "Minimum number of processes when backend='process'. 0: initialprocs",
+            },
+            'maxprocs': {
+                'default': "0",
+                'section': 'performance',
+                'description': "Maximum number of processes when backend='process'. More processes are started while sessions wait for a worker. 0: initialprocs",
+            },
+            'process_idle_timeout': {
+                'default': "60",
+                'section': 'performance',
+                'description': "Stop a process above minprocs if all processes were idle for this many seconds",
+            },
+            'max_requests_per_child': {
+                'default': "0",
+                'section': 'performance',
+                'description': "Replace a worker process after it handled this many requests. 0: no limit",
+            },
+            'max_rss_per_child': {
+                'default': "0",
+                'section': 'performance',
+                'description': "Replace a worker process once its resident memory exceeds this many megabytes. 0: no limit",
+            },
+            'respawn_backoff': {
+                'default': "1",
+                'section': 'performance',
+                'description': "Seconds to wait before replacing a crashed worker process, doubled for each further crash within a minute (up to 60s)",
+            },
+            
+            'slow_request_threshold': {
+                'default': "0",
+                'section': 'performance',
+                'description': "Requests taking longer than this many seconds are logged with the time spent in each step (accept, queue, read, plugins, dns/sql/redis/smtp calls, write) to the postomaat.slowrequests logger. 0: disabled, no request is traced",
+            },
+            
+            'slow_request_buffer': {
+                'default': "100",
+                'section': 'performance',
+                'description': "Number of slow requests kept for the control command 'slow'",
+            },
+            
+            'profile_dir': {
+                'default': "/var/lib/postomaat",
+                'section': 'performance',
+                'description': "Directory for the stack samples of the profiler (SIGUSR1 or control command 'profile'). Must be writable by the postomaat user, should not be writable by other users",
+            },
+            
+            'profile_duration': {
+                'default': "30",
+                'section': 'performance',
+                'description': "Seconds the profiler samples after being switched on",
+            },
+            
+            'profile_interval': {
+                'default': "0.01",
+                'section': 'performance',
+                'description': "Seconds between two stack samples of the profiler",
             },
             
             #  plugin alias
@@ -175,14 +377,19 @@ class MainController(object):
         self.stayalive=True
         self.threadpool=None
         self.procpool=None
+        self.asyncbackend=None
         self.controlserver = None
         self.started = datetime.datetime.now()
         self.statsthread = None
+        self.metricsserver = None
         self.debugconsole = False
         self._logQueue = logQueue
         self._logProcessFacQueue = logProcessFacQueue
         self.configFileUpdates = None
         self.logConfigFileUpdates = None
+        self._loadedplugins = {} # (plugin name, config section) -> [(instance, settings)] of the last load
+        self._reusableplugins = {} # the same for the previous load, while loading
+        self._reusedplugins = set()
 
     @property
     def logQueue(self):
@@ -210,6 +417,64 @@ class MainController(object):
         mrtg_stats_thread.start()
         return statsthread
 
+    def _get_metrics_listener(self):
+        """returns (address, port) of the metrics listener, port 0 if it is disabled"""
+        try:
+            return self.config.get('main', 'metrics_bindaddress'), self.config.getint('main', 'metrics_port')
+        except Exception:
+            return '127.0.0.1', 0
+
+    def _start_metricsserver(self):
+        """start, restart or stop the metrics listener according to the config"""
+        address, port = self._get_metrics_listener()
+        current = self.metricsserver
+        if current is not None:
+            if (current.address, current.port) == (address, port):
+                return
+            self.logger.info('Closing metrics listener on %s:%s' % (current.address, current.port))
+            current.shutdown()
+            self.metricsserver = None
+        if port > 0:
+            server = MetricsServer(address, port)
+            try:
+                server.start()
+            except Exception as e:
+                self.logger.error('Could not start metrics listener on %s:%s: %s' % (address, port, str(e)))
+                return
+            self.metricsserver = server
+
+    def start_profiler(self, duration=None):
+        """switch on the sampling profiler in this process and all worker processes for duration seconds
+        (default: profile_duration). returns a dict process -> profile file (None: already running)"""
+        if duration is None:
+            duration = postomaat.profiler.SETTINGS['duration']
+        result = dict(main=postomaat.profiler.start(duration))
+        if self.procpool is not None:
+            result['workers'] = self.procpool.broadcast('profile %s' % duration)
+        return result
+
+    def _start_controlserver(self):
+        """start, move or stop the control server according to the config"""
+        try:
+            path = self.config.get('main', 'controlsocket').strip()
+        except Exception:
+            path = ''
+        current = self.controlserver
+        if current is not None:
+            if current.path == path:
+                return
+            self.logger.info('Closing control socket %s' % current.path)
+            current.shutdown()
+            self.controlserver = None
+        if path:
+            server = ControlServer(self, path)
+            try:
+                server.start()
+            except Exception as e:
+                self.logger.error('Could not start control server on %s: %s' % (path, str(e)))
+                return
+            self.controlserver = server
+
     def _start_threadpool(self):
         self.logger.info("Init Threadpool")
         try:
@@ -222,16 +487,53 @@ class MainController(object):
             maxthreads = 3
 
         queuesize = maxthreads * 10
-        return ThreadPool(minthreads, maxthreads, queuesize)
+        kwargs = {}
+        for option, key, convert in [('thread_idle_timeout', 'idletimeout', float),
+                                     ('thread_spawn_batch', 'spawnbatch', int),
+                                     ('thread_scale_wait', 'scalewait', float)]:
+            try:
+                kwargs[key] = convert(self.config.get('performance', option))
+            except Exception:
+                pass
+        threadpool = ThreadPool(minthreads, maxthreads, queuesize, **kwargs)
+        Statskeeper().register_provider('threadpool', threadpool.stats)
+        return threadpool
 
-    def _start_processpool(self):
+    def _get_processpool_limits(self):
         numprocs = self.config.getint('performance','initialprocs')
         if numprocs < 1:
             numprocs = multiprocessing.cpu_count() *2
-        self.logger.info("Init process pool with %s worker processes"%(numprocs))
-        pool = postomaat.procpool.ProcManager(self._logQueue, numprocs = numprocs, config = self.config)
+        return dict(numprocs = numprocs,
+                    minprocs = self.config.getint('performance', 'minprocs'),
+                    maxprocs = self.config.getint('performance', 'maxprocs'),
+                    respawn_backoff = self.config.getfloat('performance', 'respawn_backoff'),
+                    idletimeout = self.config.getfloat('performance', 'process_idle_timeout'))
+
+    def _is_prefork(self):
+        return self.config.get('performance', 'process_accept').strip().lower() == 'prefork'
+
+    def _start_processpool(self):
+        limits = self._get_processpool_limits()
+        self.logger.info("Init process pool with %s worker processes"%(limits['numprocs']))
+        pool = postomaat.procpool.ProcManager(self._logQueue, config = self.config, prefork = self._is_prefork(), **limits)
+        Statskeeper().register_provider('procpool', pool.stats)
         return pool
 
+    def _start_asyncbackend(self):
+        if sys.version_info < (3, 5):
+            raise ValueError("backend \"asyncio\" requires python 3.5 or newer")
+        from postomaat.asyncbackend import AsyncBackend
+        maxthreads = self.config.getint('performance', 'maxthreads')
+        self.logger.info("Init asyncio backend with %s executor threads" % maxthreads)
+        return AsyncBackend(maxthreads)
+
+    def _close_all_servers(self):
+        """close all listeners, they will be recreated by reload()"""
+        for server in self.servers:
+            self.logger.info('Closing server socket on port %s' % server.port)
+            server.shutdown()
+        self.servers = []
+
     def startup(self):
         ok=self.load_plugins()
         if not ok:
@@ -240,13 +542,18 @@ class MainController(object):
             sys.exit(1)
 
         self.statsthread = self._start_stats_thread()
+        postomaat.profiler.configure(self.config)
+        postomaat.trace.configure(self.config)
+        self._start_metricsserver()
         backend = self.config.get('performance','backend')
         if backend == 'process':
             self.procpool = self._start_processpool()
         elif backend == 'thread':
             self.threadpool = self._start_threadpool()
+        elif backend == 'asyncio':
+            self.asyncbackend = self._start_asyncbackend()
         else:
-            raise ValueError("Input \"%s\" not allowed for backend, valid options are \"thread\" and \"process\""%backend)
+            raise ValueError("Input \"%s\" not allowed for backend, valid options are \"thread\", \"process\" and \"asyncio\""%backend)
 
         ports=self.config.get('main', 'incomingport')
         for portconfig in ports.split():
@@ -267,6 +574,9 @@ class MainController(object):
             tr.daemon = True
             tr.start()
             self.servers.append(server)
+        if self.procpool is not None:
+            self.procpool.set_listeners(self.servers)
+        self._start_controlserver()
         self.logger.info('Startup complete')
         if self.debugconsole:
             self.run_debugconsole()
@@ -317,30 +627,75 @@ class MainController(object):
 
             # stop existing procpool
             if self.procpool is not None:
+                if self.procpool.prefork:
+                    # listeners without accept thread, they will be recreated below
+                    self._close_all_servers()
                 self.logger.info('Delete old procpool')
                 self.procpool.shutdown()
                 self.procpool = None
 
+            self._stop_asyncbackend()
+
         elif backend == 'process':
-            # start new procpool
             currentProcPool = self.procpool
-            self.logger.info('Create new processpool')
-            self.procpool = self._start_processpool()
+            batchsize = self.config.getint('performance', 'rolling_reload_batch')
+            if currentProcPool is not None and currentProcPool.prefork == self._is_prefork() and batchsize > 0:
+                # -> each worker process has its own controller, the workers are replaced to take
+                #    configuration changes into account
+                if currentProcPool.config_changed(self.config):
+                    currentProcPool.rolling_reload(self.config, batchsize)
+                else:
+                    self.logger.info('Keep existing processpool, configuration did not change')
+                currentProcPool.set_limits(**self._get_processpool_limits())
+            else:
+                # start new procpool
+                self.logger.info('Create new processpool')
+                self.procpool = self._start_processpool()
+                wasprefork = currentProcPool is not None and currentProcPool.prefork
+                if self.procpool.prefork != wasprefork:
+                    # accept threads have to be started or stopped, the listeners are recreated below
+                    self._close_all_servers()
 
-            # stop existing procpool
-            # -> the procpool has to be recreated to take configuration changes
-            #    into account (each worker process has its own controller unlike using threadpool)
-            if currentProcPool is not None:
-                self.logger.info('Delete old processpool')
-                currentProcPool.shutdown()
+                # stop existing procpool
+                # -> the procpool has to be recreated to take configuration changes
+                #    into account (each worker process has its own controller unlike using threadpool)
+                if currentProcPool is not None:
+                    self.logger.info('Delete old processpool')
+                    currentProcPool.shutdown()
 
             # stop existing threadpool
             if self.threadpool is not None:
                 self.logger.info('Delete old threadpool')
                 self.threadpool.shutdown()
                 self.threadpool = None
+
+            self._stop_asyncbackend()
+
+        elif backend == 'asyncio':
+            if self.asyncbackend is None:
+                # listeners accepting in threads have to be recreated on the event loop
+                self._close_all_servers()
+                self.logger.info('Create new asyncio backend')
+                self.asyncbackend = self._start_asyncbackend()
+            elif self.asyncbackend.maxexecutorthreads != self.config.getint('performance', 'maxthreads'):
+                self.logger.info('Executor config changed, initialising new asyncio backend')
+                self._close_all_servers()
+                self.asyncbackend.shutdown()
+                self.asyncbackend = self._start_asyncbackend()
+            else:
+                self.logger.info('Keep existing asyncio backend')
+
+            if self.procpool is not None:
+                self.logger.info('Delete old procpool')
+                self.procpool.shutdown()
+                self.procpool = None
+
+            if self.threadpool is not None:
+                self.logger.info('Delete old threadpool')
+                self.threadpool.shutdown()
+                self.threadpool = None
         else:
-            self.logger.error('backend %s not detected -> ignoring input! (valid options \"thread\" and \"process\")'%backend)
+            self.logger.error('backend %s not detected -> ignoring input! (valid options \"thread\", \"process\" and \"asyncio\")'%backend)
 
         #smtp engine changes?
         ports=self.config.get('main', 'incomingport')
@@ -373,9 +728,24 @@ class MainController(object):
             else:
                 self.logger.info('Keep server socket on port %s' % serv.port)
 
+        if self.procpool is not None:
+            self.procpool.set_listeners(self.servers)
+
+        postomaat.profiler.configure(self.config)
+        postomaat.trace.configure(self.config)
+        self._start_metricsserver()
+        self._start_controlserver()
         self.logger.info('Config changes applied')
     
     
+    def _stop_asyncbackend(self):
+        """stop the asyncio backend if it is running. its listeners are recreated by reload()"""
+        if self.asyncbackend is not None:
+            self._close_all_servers()
+            self.logger.info('Delete old asyncio backend')
+            self.asyncbackend.shutdown()
+            self.asyncbackend = None
+
     def test(self,valuedict,port=None):
         """dryrun without postfix"""
         suspect=Suspect(valuedict)
@@ -410,6 +780,12 @@ class MainController(object):
     def shutdown(self):
         if self.statsthread:
             self.statsthread.stayalive = False
+        if self.metricsserver is not None:
+            self.metricsserver.shutdown()
+            self.metricsserver = None
+        if self.controlserver is not None:
+            self.controlserver.shutdown()
+            self.controlserver = None
         for server in self.servers:
             self.logger.info('Closing server socket on port %s' % server.port)
             server.shutdown()
@@ -424,6 +800,11 @@ class MainController(object):
             self.logger.info('Delete threadpool')
             self.threadpool.shutdown()
             self.threadpool = None
+        # stop asyncio backend
+        if self.asyncbackend is not None:
+            self.logger.info('Delete asyncio backend')
+            self.asyncbackend.shutdown()
+            self.asyncbackend = None
 
         self.stayalive=False
         self.logger.info('Shutdown complete')
@@ -540,6 +921,12 @@ class MainController(object):
         self.logger.debug('Module search path %s' % sys.path)
         self.logger.debug('Loading scanner plugins')
         
+        self._reusableplugins = {}
+        if self._reuse_plugins_enabled():
+            self._reusableplugins = self._loadedplugins
+        previousplugins = self._loadedplugins
+        self._loadedplugins = {}
+        self._reusedplugins = set()
         newplugins,loadok=self._load_all(self.config.get('main', 'plugins'))
         if not loadok:
             allOK=False
@@ -547,9 +934,62 @@ class MainController(object):
         if allOK:
             self.plugins=newplugins
             self.propagate_plugin_defaults()
+            self._setup_plugin_caches(keep=self._reusedplugins)
+        else:
+            # the old plugins stay in use
+            self._loadedplugins = previousplugins
+        self._reusableplugins = {}
             
         return allOK
     
+    def _reuse_plugins_enabled(self):
+        try:
+            return self.config.getboolean('performance', 'reuse_unchanged_plugins')
+        except Exception:
+            return False
+    
+    def _plugin_settings(self, plugin):
+        """returns the effective options of the config section of plugin (defaults from requiredvars included),
+        to find plugins whose config did not change on reload"""
+        settings = {}
+        requiredvars = getattr(plugin, 'requiredvars', None)
+        if isinstance(requiredvars, dict):
+            for option, infodic in requiredvars.items():
+                if infodic.get('section', plugin.section) == plugin.section:
+                    settings[option] = infodic.get('default')
+        if self.config.has_section(plugin.section):
+            settings.update(self.config.items(plugin.section))
+        return settings
+    
+    def _reuse_plugin(self, key):
+        """returns an instance of the previous load for key if its config section did not change, otherwise None"""
+        candidates = self._reusableplugins.get(key)
+        while candidates:
+            plugininstance, settings = candidates.pop(0)
+            if self._plugin_settings(plugininstance) == settings:
+                plugininstance.config = self.config
+                self._reusedplugins.add((plugininstance.__class__.__name__, plugininstance.section))
+                self.logger.debug('Keeping plugin %s, its config did not change' % plugininstance)
+                return plugininstance
+        return None
+    
+    def _setup_plugin_caches(self, keep=None):
+        """apply the verdict cache and transaction memo config. cached verdicts are dropped as the plugin config
+        may have changed, except those of the plugins in keep (set of (class name, section))"""
+        verdictcache = get_verdictcache()
+        transactionmemo = get_transactionmemo()
+        try:
+            verdictcache.maxsize = self.config.getint('performance', 'verdictcache_size')
+            transactionmemo.maxsize = self.config.getint('performance', 'transaction_memo_size')
+            transactionmemo.ttl = self.config.getfloat('performance', 'transaction_memo_ttl')
+        except Exception:
+            pass
+        verdictcache.clear(keep=keep)
+        transactionmemo.clear()
+        Statskeeper().register_provider('verdictcache', verdictcache.stats)
+        Statskeeper().register_provider('transactionmemo', transactionmemo.stats)
+        Statskeeper().register_provider('plugins', Statskeeper().plugin_stats)
+    
     def _load_all(self,configstring):
         """load all plugins from config string. returns tuple ([list of loaded instances],allOk)"""
         pluglist=[]
@@ -567,7 +1007,11 @@ class MainController(object):
             structured_name,configoverride=m.groups()
             structured_name=self.get_component_by_alias(structured_name)
             try:
-                plugininstance=self._load_component(structured_name,configsection=configoverride)
+                key=(structured_name,configoverride)
+                plugininstance=self._reuse_plugin(key)
+                if plugininstance is None:
+                    plugininstance=self._load_component(structured_name,configsection=configoverride)
+                self._loadedplugins.setdefault(key,[]).append((plugininstance,self._plugin_settings(plugininstance)))
                 pluglist.append(plugininstance)
             except Exception as e:
                 self.logger.error('Could not load plugin %s : %s'%(structured_name, str(e)))
@@ -632,6 +1076,7 @@ class PolicyServer(object):
         self.port=port
         self.controller=controller
         self.stayalive=1
+        self.shedresponder=None
         if plugins is None:
             self.plugins=controller.plugins
         else:
@@ -641,7 +1086,7 @@ class PolicyServer(object):
             self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self._socket.bind((address, port))
-            self._socket.listen(5)
+            self._socket.listen(self.get_backlog())
         except Exception as e:
             self.logger.error('Could not start incoming policy server: %s'%e)
             sys.exit(1)
@@ -649,9 +1094,20 @@ class PolicyServer(object):
    
     def shutdown(self):
         self.stayalive=False
+        if self.controller.asyncbackend is not None:
+            self.controller.asyncbackend.remove_server(self)
+        if self.shedresponder is not None:
+            self.shedresponder.shutdown()
         self._socket.close()
         
     def serve(self):
+        if self.controller.asyncbackend is not None:
+            # the event loop accepts and handles the connections
+            self.controller.asyncbackend.add_server(self)
+            return
+        if self.controller.procpool is not None and self.controller.procpool.prefork:
+            # the worker processes accept the connections, see ProcManager.set_listeners
+            return
 
         self.logger.info('policy server running on port %s'%self.port)
         while self.stayalive:
@@ -662,15 +1118,21 @@ class PolicyServer(object):
                     break
                 engine = SessionHandler(sock,self.controller.config,self.plugins)
                 self.logger.debug('Incoming connection from %s'%str(addr))
-                if self.controller.threadpool:
-                    #this will block if queue is full
-                    self.controller.threadpool.add_task(engine)
+                pool = self.controller.threadpool or self.controller.procpool
+                if pool is not None and self.overloaded(pool):
+                    self.shed(sock, addr)
+                elif self.controller.threadpool:
+                    #this will block if queue is full and load shedding is disabled
+                    if not self.controller.threadpool.add_task(engine, block=not self.shedding_enabled()):
+                        self.shed(sock, addr)
                 elif self.controller.procpool:
                     # in multi processing, the other process manages configs and plugins itself, we only pass the minimum required information:
                     # a pickled version of the socket (this is no longer required in python 3.4, but in python 2 the multiprocessing queue can not handle sockets
                     # see https://stackoverflow.com/questions/36370724/python-passing-a-tcp-socket-object-to-a-multiprocessing-queue
-                    task = forking_dumps(sock)
-                    self.controller.procpool.add_task(task)
+                    # with the accept and queue time for the trace of the first request, see SessionHandler.start_trace
+                    task = (forking_dumps(sock), engine.acceptedtime, time.time())
+                    if not self.controller.procpool.add_task(task, block=not self.shedding_enabled()):
+                        self.shed(sock, addr)
 
 
                 else:
@@ -678,6 +1140,156 @@ class PolicyServer(object):
             except Exception as e:
                 self.logger.exception(e)
 
+    def get_backlog(self):
+        try:
+            return max(self.controller.config.getint('performance', 'listen_backlog'), 1)
+        except Exception:
+            return 128
+
+    def get_shed_limits(self):
+        """returns (max queue depth, max queue wait in seconds), 0 means no limit"""
+        config = self.controller.config
+        try:
+            depth = config.getint('performance', 'shed_queue_depth')
+        except Exception:
+            depth = 0
+        try:
+            wait = config.getfloat('performance', 'shed_queue_wait')
+        except Exception:
+            wait = 0
+        return depth, wait
+
+    def shedding_enabled(self):
+        depth, wait = self.get_shed_limits()
+        return depth > 0 or wait > 0
+
+    def overloaded(self, pool):
+        """returns True if new requests should be shed instead of queued"""
+        depth, wait = self.get_shed_limits()
+        if depth > 0 and pool.queue_depth() >= depth:
+            return True
+        if wait > 0 and pool.queue_wait() >= wait:
+            return True
+        return False
+
+    def get_shed_answer(self):
+        """returns the (action, message) for requests shed by admission control"""
+        try:
+            action = self.controller.config.get('performance', 'shed_action').strip().lower()
+        except Exception:
+            action = 'dunno'
+        try:
+            message = self.controller.config.get('performance', 'shed_message')
+        except Exception:
+            message = ''
+        return action, message
+
+    def get_shed_read_timeout(self):
+        try:
+            return max(self.controller.config.getfloat('performance', 'shed_read_timeout'), 0.0)
+        except Exception:
+            return 0.5
+
+    def shed(self, sock, addr):
+        """answer the request on sock without running the plugins and close the connection. the request is read
+        and answered by the ShedResponder thread, a slow client must not block accepting new connections"""
+        action, message = self.get_shed_answer()
+        self.logger.debug('Overloaded, answering request from %s with %s' % (str(addr), action))
+        if self.shedresponder is None:
+            self.shedresponder = ShedResponder(self.port)
+            self.shedresponder.start()
+        self.shedresponder.add(sock, addr, action, message, self.get_shed_read_timeout())
+        Statskeeper().increase_shed(action)
+
+
+class ShedResponder(threading.Thread):
+    """reads the requests of shed connections and answers them with the shed action. the connections are
+    multiplexed with select, so slow clients neither block the accept thread nor each other"""
+    maxpending = 512 # connections waiting for their request, more are closed right away (select handles < 1024 fds)
+    maxrequestsize = 65536
+
+    def __init__(self, port):
+        threading.Thread.__init__(self, name='Shed responder %s' % port)
+        self.daemon = True
+        self.logger = logging.getLogger("%s.proto.incoming.%s.shed" % (__package__, port))
+        self.incoming = queue.Queue()
+        self.pending = {} # socket -> [addr, action, message, deadline, data read]
+        self.stayalive = True
+
+    def add(self, sock, addr, action, message, timeout):
+        self.incoming.put((sock, addr, action, message, time.time() + timeout))
+
+    def shutdown(self):
+        self.stayalive = False
+        self.incoming.put(None)
+
+    def run(self):
+        while self.stayalive:
+            try:
+                self._take_incoming(block=not self.pending)
+                if self.pending:
+                    self._serve_pending()
+            except Exception as e:
+                self.logger.error('Shed responder failed: %s' % str(e))
+        for sock in list(self.pending):
+            self._close(sock)
+
+    def _take_incoming(self, block):
+        """move new connections to self.pending, waiting for one if block is True"""
+        while True:
+            try:
+                item = self.incoming.get(block)
+            except queue.Empty:
+                return
+            block = False
+            if item is None:
+                continue
+            sock, addr, action, message, deadline = item
+            if len(self.pending) >= self.maxpending:
+                self.logger.debug('Too many shed connections waiting, closing connection from %s' % str(addr))
+                self._close(sock)
+                continue
+            sock.settimeout(0.1) # only for sending the answer, reads wait for select
+            self.pending[sock] = [addr, action, message, deadline, b'']
+
+    def _serve_pending(self):
+        now = time.time()
+        timeout = min(max(min(entry[3] for entry in self.pending.values()) - now, 0), 0.02)
+        readable = select.select(list(self.pending), [], [], timeout)[0]
+        for sock in readable:
+            entry = self.pending[sock]
+            try:
+                data = sock.recv(4096)
+            except (OSError, socket.error) as e:
+                self.logger.debug('Could not read shed request from %s: %s' % (str(entry[0]), str(e)))
+                self._close(sock)
+                continue
+            if not data or len(entry[4]) + len(data) > self.maxrequestsize:
+                self._close(sock)
+                continue
+            entry[4] += data
+            if b'\n\n' in entry[4] or b'\r\n\r\n' in entry[4]:
+                try:
+                    sock.sendall(format_response(entry[1], entry[2]))
+                except (OSError, socket.error) as e:
+                    self.logger.debug('Could not answer shed request from %s: %s' % (str(entry[0]), str(e)))
+                self._close(sock)
+        now = time.time()
+        for sock, entry in list(self.pending.items()):
+            if entry[3] <= now:
+                self.logger.debug('Shed connection from %s sent no request in time' % str(entry[0]))
+                self._close(sock)
+
+    def _close(self, sock):
+        self.pending.pop(sock, None)
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except (OSError, socket.error):
+            pass
+        finally:
+            sock.close()
+
+
 def forking_dumps(obj):
     """ Pickle a socket This is required to pass the socket in multiprocessing"""
     buf = StringIO()
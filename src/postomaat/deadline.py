@@ -0,0 +1,72 @@
+# -*- coding: UTF-8 -*-
+#   Copyright 2012-2018 Oli Schacher
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# The deadline of the plugin currently running in this thread. Extensions doing network io
+# (dnsquery, sql, call-ahead) take their timeouts from what is left of it.
+
+import threading
+import time
+
+_local = threading.local()
+
+
+class DeadlineExceeded(Exception):
+    """raised if there is no time left for an operation"""
+    pass
+
+
+def get_deadline():
+    """returns the deadline (unix timestamp) of the current thread or None"""
+    return getattr(_local, 'deadline', None)
+
+
+def time_left(default=None):
+    """returns the seconds left until the deadline of the current thread (never negative),
+    default if no deadline is set"""
+    deadline = get_deadline()
+    if deadline is None:
+        return default
+    return max(deadline - time.time(), 0)
+
+
+def get_timeout(timeout):
+    """returns timeout, limited to the time left until the deadline.
+    raises DeadlineExceeded if the deadline has passed"""
+    left = time_left()
+    if left is None:
+        return timeout
+    if left <= 0:
+        raise DeadlineExceeded('deadline exceeded')
+    if timeout is None:
+        return left
+    return min(timeout, left)
+
+
+class deadline_scope(object):
+    """context manager setting the deadline of the current thread"""
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.previous = None
+
+    def __enter__(self):
+        self.previous = get_deadline()
+        _local.deadline = self.deadline
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        _local.deadline = self.previous
+        return False
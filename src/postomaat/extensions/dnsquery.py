@@ -15,6 +15,9 @@
 #
 #
 #
+from postomaat.deadline import get_timeout
+from postomaat.trace import span
+
 STATUS = "not loaded"
 
 try:
@@ -58,17 +61,38 @@ QTYPE_TLSA = 'TLSA'
 
 
 
-def lookup(hostname, qtype=QTYPE_A):
+# timeout: seconds for the whole lookup. It is limited to the time left for the running plugin (see
+# postomaat.deadline), DeadlineExceeded is raised if there is no time left. None: resolver default
+
+
+def _query(name, qtype, timeout):
+    if timeout is None:
+        return resolver.query(name, qtype)
+    return resolver.query(name, qtype, lifetime=timeout)
+
+
+
+def _pydns_timeout(timeout):
+    if timeout is None:
+        return 30
+    return timeout
+
+
+
+def lookup(hostname, qtype=QTYPE_A, timeout=None):
+    timeout = get_timeout(timeout)
     try:
         if HAVE_DNSPYTHON:
             arecs = []
-            arequest = resolver.query(hostname, qtype)
+            with span('dns', qtype, hostname):
+                arequest = _query(hostname, qtype, timeout)
             for rec in arequest:
                 arecs.append(rec.to_text())
             return arecs
 
         elif HAVE_PYDNS:
-            return DNS.dnslookup(hostname, qtype)
+            with span('dns', qtype, hostname):
+                return DNS.dnslookup(hostname, qtype, timeout=_pydns_timeout(timeout))
 
     except Exception:
         return None
@@ -77,11 +101,13 @@ def lookup(hostname, qtype=QTYPE_A):
 
 
 
-def mxlookup(domain):
+def mxlookup(domain, timeout=None):
+    timeout = get_timeout(timeout)
     try:
         if HAVE_DNSPYTHON:
             mxrecs = []
-            mxrequest = resolver.query(domain, QTYPE_MX)
+            with span('dns', QTYPE_MX, domain):
+                mxrequest = _query(domain, QTYPE_MX, timeout)
             for rec in mxrequest:
                 mxrecs.append(rec.to_text())
             mxrecs.sort()  # automatically sorts by priority
@@ -89,7 +115,8 @@ def mxlookup(domain):
 
         elif HAVE_PYDNS:
             mxrecs = []
-            mxrequest = DNS.mxlookup(domain)
+            with span('dns', QTYPE_MX, domain):
+                mxrequest = DNS.mxlookup(domain, timeout=_pydns_timeout(timeout))
             for dataset in mxrequest:
                 if type(dataset) == tuple:
                     mxrecs.append(dataset)
@@ -104,8 +131,8 @@ def mxlookup(domain):
 
 
 
-def revlookup(ip):
+def revlookup(ip, timeout=None):
     a = ip.split('.')
     a.reverse()
     revip = '.'.join(a)+'.in-addr.arpa'
-    return lookup(revip, qtype=QTYPE_PTR)
+    return lookup(revip, qtype=QTYPE_PTR, timeout=timeout)
@@ -17,9 +17,13 @@
 #
 
 import logging
+import math
+from postomaat.deadline import get_timeout
+from postomaat.stats import timer
+from postomaat.trace import get_trace, add_span
 
 try:
-    from sqlalchemy import create_engine
+    from sqlalchemy import create_engine, event
     from sqlalchemy.orm import scoped_session, sessionmaker
     SQL_EXTENSION_ENABLED=True
 except ImportError:
@@ -30,6 +34,80 @@ ENABLED = SQL_EXTENSION_ENABLED # fuglu compatibility
 _sessmaker = None
 _engines = {}
 
+# statement limits are whole seconds, a limit in place is kept while it is at most one step above the time left,
+# so the limit is only set again when a request starts or its time budget shrank by more than a step
+_STATEMENT_TIMEOUT_STEP = 1000
+
+
+def _statement_timeout_setting(dialect, millis):
+    """returns the statement limiting the runtime of the following statements on a connection to millis
+    (0: unlimited), None if the server does not support it"""
+    if dialect.name == 'postgresql':
+        return 'SET statement_timeout=%d' % millis
+    if dialect.name != 'mysql':
+        return None
+    version = tuple(getattr(dialect, 'server_version_info', None) or ())
+    try:
+        if getattr(dialect, '_is_mariadb', False) or 'MariaDB' in version:
+            if version[:2] >= (10, 1):
+                return 'SET SESSION max_statement_time=%.3f' % (millis / 1000.0)
+        elif version[:3] >= (5, 7, 8):
+            # only limits SELECT statements
+            return 'SET SESSION max_execution_time=%d' % millis
+    except TypeError:
+        pass
+    return None
+
+
+def _limit_statement_time(conn, cursor, statement, parameters, context, executemany):
+    """limit the runtime of each statement to the time left for the running plugin (see postomaat.deadline).
+    raises DeadlineExceeded if there is no time left"""
+    timeout = get_timeout(None)
+    if timeout is None:
+        millis = 0
+    else:
+        millis = int(math.ceil(timeout * 1000.0 / _STATEMENT_TIMEOUT_STEP)) * _STATEMENT_TIMEOUT_STEP
+    current = conn.info.get('postomaat.statement_timeout', 0)
+    if current is None or current == millis:
+        # not supported by the server or already set
+        return
+    if millis and current and millis <= current <= millis + _STATEMENT_TIMEOUT_STEP:
+        return
+    setting = _statement_timeout_setting(conn.dialect, millis)
+    if setting is None:
+        conn.info['postomaat.statement_timeout'] = None
+        return
+    # the setting is transactional on postgresql: it would be undone with the transaction, and a failure would
+    # abort it. it is only changed between transactions and committed right away
+    transactional = conn.dialect.name == 'postgresql'
+    if transactional and conn.in_transaction():
+        return
+    try:
+        cursor.execute(setting)
+        if transactional:
+            conn.connection.commit()
+        conn.info['postomaat.statement_timeout'] = millis
+    except Exception as e:
+        logging.getLogger('%s.sql' % __package__).warning('Could not set statement timeout: %s' % str(e))
+        conn.info['postomaat.statement_timeout'] = None
+        if transactional:
+            try:
+                conn.connection.rollback()
+            except Exception:
+                pass
+
+
+def _start_statement_span(conn, cursor, statement, parameters, context, executemany):
+    if get_trace() is not None:
+        conn.info['postomaat.statement_start'] = timer()
+
+
+def _end_statement_span(conn, cursor, statement, parameters, context, executemany):
+    """record the statement in the trace of the request (see postomaat.trace)"""
+    start = conn.info.pop('postomaat.statement_start', None)
+    if start is not None:
+        add_span('sql', start, ' '.join(statement.split())[:80])
+
 
 def get_session(connectstring, **kwargs):
     global SQL_EXTENSION_ENABLED
@@ -43,6 +121,9 @@ def get_session(connectstring, **kwargs):
         engine = _engines[connectstring]
     else:
         engine = create_engine(connectstring, pool_recycle=20)
+        event.listen(engine, 'before_cursor_execute', _limit_statement_time)
+        event.listen(engine, 'before_cursor_execute', _start_statement_span)
+        event.listen(engine, 'after_cursor_execute', _end_statement_span)
         _engines[connectstring] = engine
 
     if _sessmaker is None:
@@ -0,0 +1,225 @@
+# -*- coding: UTF-8 -*-
+#   Copyright 2012-2018 Oli Schacher
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# Statistics in the Prometheus text exposition format, served on /metrics by a local HTTP listener.
+# Scrapes only read the counters and histograms of the Statskeeper and the stats providers,
+# they never wait for a worker thread or process.
+
+import threading
+import logging
+import time
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+from postomaat.stats import Statskeeper, Histogram, keyed_counters, plugin_counter_name
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    if value is None:
+        return 'NaN'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class MetricsWriter(object):
+    """collects metric families and renders them in the Prometheus text format"""
+
+    def __init__(self, prefix='postomaat_'):
+        self.prefix = prefix
+        self.lines = []
+
+    def family(self, name, mtype, helptext):
+        self.lines.append('# HELP %s%s %s' % (self.prefix, name, helptext))
+        self.lines.append('# TYPE %s%s %s' % (self.prefix, name, mtype))
+
+    def sample(self, name, value, labels=None):
+        if labels:
+            labelstring = ','.join('%s="%s"' % (key, escape_label(labels[key])) for key in sorted(labels))
+            self.lines.append('%s%s{%s} %s' % (self.prefix, name, labelstring, format_value(value)))
+        else:
+            self.lines.append('%s%s %s' % (self.prefix, name, format_value(value)))
+
+    def metric(self, name, mtype, helptext, value, labels=None):
+        self.family(name, mtype, helptext)
+        self.sample(name, value, labels)
+
+    def keyed(self, name, mtype, helptext, values, label):
+        """one family with a sample per key of dict values"""
+        if not values:
+            return
+        self.family(name, mtype, helptext)
+        for key in sorted(values):
+            self.sample(name, values[key], {label: key})
+
+    def histogram(self, name, histogram, labels):
+        """samples of a Histogram, with buckets at every power of two of its log-scale buckets"""
+        labels = dict(labels)
+        cumulative = 0
+        buckets = list(histogram.buckets)
+        for index, count in enumerate(buckets):
+            cumulative += count
+            if index % Histogram.SUBBUCKETS == Histogram.SUBBUCKETS - 1:
+                labels['le'] = '%g' % Histogram.bucket_upper(index)
+                self.sample(name + '_bucket', cumulative, labels)
+        labels['le'] = '+Inf'
+        self.sample(name + '_bucket', cumulative, labels)
+        del labels['le']
+        self.sample(name + '_sum', histogram.sum, labels)
+        self.sample(name + '_count', cumulative, labels)
+
+    def render(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+def render_metrics():
+    """returns the current statistics in the Prometheus text format"""
+    stats = Statskeeper()
+    counters = stats.get_counters()
+    histograms = stats.get_histograms()
+    providers = stats.provider_stats(('verdictcache', 'transactionmemo', 'threadpool', 'procpool'))
+    writer = MetricsWriter()
+
+    writer.metric('uptime_seconds', 'gauge', 'Seconds since postomaat started', time.time() - stats.starttime)
+    writer.metric('threads', 'gauge', 'Threads of the main process', stats.numthreads())
+
+    # requests
+    actions = dict((name[len('action.'):], histogram.count) for name, histogram in histograms.items()
+                   if name.startswith('action.'))
+    writer.keyed('requests_total', 'counter', 'Requests answered, by final action', actions, 'action')
+    ports = sorted((name[len('port.'):], histogram) for name, histogram in histograms.items() if name.startswith('port.'))
+    if ports:
+        writer.family('request_duration_seconds', 'histogram', 'Time from receiving a request until its answer, by incoming port')
+        for port, histogram in ports:
+            writer.histogram('request_duration_seconds', histogram, dict(port=port))
+    writer.keyed('timeouts_total', 'counter', 'Plugins exceeding their time budget (name=request: requests exceeding request_timeout)',
+                 keyed_counters(counters, 'timeouts'), 'name')
+    writer.keyed('shed_total', 'counter', 'Requests answered by admission control without running the plugins, by action',
+                 keyed_counters(counters, 'shed'), 'action')
+
+    # plugins
+    plugins = stats.plugin_stats()
+    if plugins:
+        for name, key, mtype, helptext in (
+                ('plugin_calls_total', 'calls', 'counter', 'Plugin calls'),
+                ('plugin_seconds_total', 'time', 'counter', 'Time spent in plugins'),
+                ('plugin_errors_total', 'errors', 'counter', 'Plugin calls ending with an exception'),
+                ('plugin_decisions_total', 'decisions', 'counter', 'Plugin runs ended by a plugin answering other than dunno')):
+            writer.keyed(name, mtype, helptext, dict((plugin, entry[key]) for plugin, entry in plugins.items()), 'plugin')
+        writer.family('plugin_actions_total', 'counter', 'Actions returned by plugins')
+        for plugin in sorted(plugins):
+            for action, count in sorted(plugins[plugin]['actions'].items()):
+                writer.sample('plugin_actions_total', count, dict(plugin=plugin, action=action))
+        writer.family('plugin_duration_seconds', 'histogram', 'Duration of plugin calls')
+        for plugin in sorted(plugins):
+            histogram = histograms.get('plugin.%s' % plugin_counter_name(plugin))
+            if histogram is not None:
+                writer.histogram('plugin_duration_seconds', histogram, dict(plugin=plugin))
+
+    # caches
+    hits = counters.get('verdictcache.hits', 0)
+    misses = counters.get('verdictcache.misses', 0)
+    writer.metric('verdictcache_hits_total', 'counter', 'Plugin verdicts taken from the verdict cache or transaction memo', hits)
+    writer.metric('verdictcache_misses_total', 'counter', 'Plugin verdicts not found in the verdict cache or transaction memo', misses)
+    writer.metric('verdictcache_hit_ratio', 'gauge', 'Share of verdict lookups found in a cache',
+                  float(hits) / (hits + misses) if hits + misses else 0.0)
+    for name in ('verdictcache', 'transactionmemo'):
+        if name in providers:
+            writer.metric('%s_entries' % name, 'gauge', 'Entries in the %s of the main process' % name, providers[name].get('size', 0))
+
+    # worker pools
+    pools = [(backend, providers[name]) for backend, name in (('thread', 'threadpool'), ('process', 'procpool'))
+             if providers.get(name)]
+    for name, key, mtype, helptext in (
+            ('pool_workers', 'workers', 'gauge', 'Worker threads or processes'),
+            ('pool_idle_workers', 'idle', 'gauge', 'Worker threads waiting for a session'),
+            ('pool_queue_depth', 'queue_depth', 'gauge', 'Sessions waiting for a worker'),
+            ('pool_queue_wait_seconds', 'queue_wait', 'gauge', 'Time sessions wait for a worker thread'),
+            ('pool_spawned_total', 'spawned', 'counter', 'Workers started'),
+            ('pool_retired_total', 'retired', 'counter', 'Idle worker threads ended'),
+            ('pool_exited_total', 'exited', 'counter', 'Worker processes ended'),
+            ('pool_crashed_total', 'crashed', 'counter', 'Worker processes crashed')):
+        values = [(backend, pool[key]) for backend, pool in pools if key in pool]
+        if values:
+            writer.family(name, mtype, helptext)
+            for backend, value in values:
+                writer.sample(name, value, dict(backend=backend))
+    states = {}
+    for backend, pool in pools:
+        for worker in pool.get('workerstates', []):
+            states[worker['state']] = states.get(worker['state'], 0) + 1
+    writer.keyed('pool_worker_states', 'gauge', 'Worker processes per state', states, 'state')
+    return writer.render()
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        try:
+            body = render_metrics().encode('utf-8')
+        except Exception as e:
+            logging.getLogger('%s.metrics' % __package__).exception(e)
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.getLogger('%s.metrics' % __package__).debug('%s - %s' % (self.address_string(), format % args))
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class MetricsServer(object):
+    """HTTP listener serving render_metrics() on /metrics"""
+
+    def __init__(self, address='127.0.0.1', port=9097):
+        self.address = address
+        self.port = port
+        self.logger = logging.getLogger('%s.metrics' % __package__)
+        self.httpd = None
+
+    def start(self):
+        self.httpd = ThreadingHTTPServer((self.address, self.port), MetricsRequestHandler)
+        thread = threading.Thread(name='Metrics server', target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.logger.info('Serving metrics on http://%s:%s/metrics' % (self.address, self.port))
+
+    def shutdown(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
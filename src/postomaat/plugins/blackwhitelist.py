@@ -128,12 +128,12 @@ class BlackWhiteList(ScannerPlugin):
         listings = None
         cache = get_default_cache()
         if usecache:
-            listings = cache.get('listings')
+            listings = cache.get_cache('listings')
         if not listings:
             listings = {}
             try:
                 session = get_session(self.config.get(self.section,'dbconnection'))
-                listing_types = [(l['name']).decode('utf-8') for l in LISTING_TYPES]
+                listing_types = [l['name'] for l in LISTING_TYPES]
                 result = session.query(UserPref).filter(UserPref.preference.in_(listing_types)).all()
                 
                 for r in result:
@@ -150,7 +150,7 @@ class BlackWhiteList(ScannerPlugin):
             except Exception as e:
                 self.logger.error('Failed to get listings: %s' % str(e))
             if listings and usecache:
-                cache.put('listings', listings)
+                cache.put_cache('listings', listings)
         return listings
     
     
@@ -25,6 +25,8 @@ if __name__ =='__main__':
 from postomaat.shared import ScannerPlugin, DUNNO, REJECT, DEFER, strip_address, extract_domain, get_config, string_to_actioncode
 from postomaat.extensions.sql import SQL_EXTENSION_ENABLED,get_session
 from postomaat.extensions.dnsquery import DNSQUERY_EXTENSION_ENABLED, lookup, mxlookup
+from postomaat.deadline import get_timeout, DeadlineExceeded
+from postomaat.trace import span
 import smtplib
 from string import Template
 import logging
@@ -134,6 +136,12 @@ class AddressCheck(ScannerPlugin):
                 'description': 'how should we retrieve the next hop?',
             },
             
+            'port': {
+                'section': 'ca_default',
+                'default': '25',
+                'description': 'smtp port of the next hop',
+            },
+            
             'sender': {
                 'section': 'ca_default',
                 'default': '${bounce}',
@@ -412,7 +420,8 @@ class AddressCheck(ScannerPlugin):
             except (ValueError, TypeError):
                 timeout = 10
             use_tls=int(test.get_domain_config(domain, 'use_tls', domainconfig))
-            result=test.smtptest(relay,[address,testaddress],mailfrom=sender, timeout=timeout, use_tls=use_tls)
+            port=int(test.get_domain_config(domain, 'port', domainconfig))
+            result=test.smtptest(relay,[address,testaddress],mailfrom=sender, timeout=timeout, use_tls=use_tls, port=port)
         
         
         if result.state != SMTPTestResult.TEST_OK:
@@ -640,10 +649,29 @@ class SMTPTest(object):
             return None 
         
     
-    def smtptest(self,relay,addrlist,helo=None,mailfrom=None,timeout=10, use_tls=1):
+    def _limit_timeout(self, smtp, timeout):
+        """set the socket timeout for the next smtp stage, limited to the time left for the plugin.
+        raises DeadlineExceeded if there is no time left"""
+        try:
+            stagetimeout=get_timeout(timeout)
+        except DeadlineExceeded:
+            smtp.close()
+            raise
+        smtp.timeout=stagetimeout
+        sock=getattr(smtp,'sock',None)
+        if sock is not None:
+            sock.settimeout(stagetimeout)
+    
+    def smtptest(self,relay,addrlist,helo=None,mailfrom=None,timeout=10, use_tls=1, port=25):
         """perform a smtp check until the rcpt to stage
         returns a SMTPTestResult
+        each stage may take up to timeout seconds, but not longer than the deadline of the running plugin.
+        raises DeadlineExceeded if the deadline is reached between two stages
         """
+        with span('smtp', relay):
+            return self._smtptest(relay, addrlist, helo, mailfrom, timeout, use_tls, port)
+    
+    def _smtptest(self,relay,addrlist,helo,mailfrom,timeout,use_tls,port):
         result=SMTPTestResult()
         result.relay=relay
         
@@ -661,10 +689,10 @@ class SMTPTest(object):
 
         result.stage=SMTPTestResult.STAGE_CONNECT
         smtp=smtplib.SMTP(local_hostname=helo)
-        smtp.timeout=timeout
+        self._limit_timeout(smtp, timeout)
         #smtp.set_debuglevel(True)
         try:
-            code,msg=smtp.connect(relay, 25)
+            code,msg=smtp.connect(relay, port)
             result.banner=(code,msg)
             if code<200 or code>299:
                 result.state=SMTPTestResult.TEST_FAILED
@@ -678,6 +706,7 @@ class SMTPTest(object):
         
         #HELO
         result.stage=SMTPTestResult.STAGE_HELO
+        self._limit_timeout(smtp, timeout)
         try:
             code,msg=smtp.ehlo()
             result.heloreply=(code,msg)
@@ -708,6 +737,7 @@ class SMTPTest(object):
         
         #MAIL FROM
         result.stage=SMTPTestResult.STAGE_MAIL_FROM
+        self._limit_timeout(smtp, timeout)
         try:
             code,msg=smtp.mail(mailfrom)
             result.mailfromreply=(code,msg)
@@ -722,6 +752,7 @@ class SMTPTest(object):
 
         #RCPT TO
         result.stage=SMTPTestResult.STAGE_RCPT_TO
+        self._limit_timeout(smtp, timeout)
         try:
             for addr in addrlist:
                 code,msg=smtp.rcpt(addr)
@@ -1016,8 +1047,9 @@ class RedisCache(CallAheadCacheInterface):
             'reason':reason,
             'check_ts':datetime.now().strftime(DATEFORMAT),
         }
-        expires = max(expires, self.redis.ttl(name))
-        self._update(name, values, expires)
+        with span('redis', 'blacklist'):
+            expires = max(expires, self.redis.ttl(name))
+            self._update(name, values, expires)
         
         
         
@@ -1035,7 +1067,8 @@ class RedisCache(CallAheadCacheInterface):
     def is_blacklisted(self,domain,relay):
         """Returns True if the server/relay combination is currently blacklisted and should not be used for recipient verification"""
         name = 'relay-%s-%s' % (relay, domain)
-        blacklisted = self.redis.exists(name)
+        with span('redis', 'exists'):
+            blacklisted = self.redis.exists(name)
         return blacklisted
     
     
@@ -1101,15 +1134,17 @@ class RedisCache(CallAheadCacheInterface):
             'message':message,
             'check_ts':datetime.now().strftime(DATEFORMAT),
         }
-        expires = max(expires, self.redis.ttl(name))
-        self._update(name, values, expires)
+        with span('redis', 'put_address'):
+            expires = max(expires, self.redis.ttl(name))
+            self._update(name, values, expires)
         
         
     
     def get_address(self,address):
         """Returns a tuple (positive(boolean),message) if a cache entry exists, None otherwise"""
         name = 'addr-%s' % address
-        entry = self.redis.hmget(name, ['positive', 'message'])
+        with span('redis', 'hmget'):
+            entry = self.redis.hmget(name, ['positive', 'message'])
         if entry[0] is not None:
             self.__pos2bool(entry, 0)
         else:
@@ -1389,7 +1424,8 @@ class SMTPTestCommandLineInterface(object):
             except (ValueError, TypeError):
                 timeout = 10
             use_tls = bool(int(test.get_domain_config(domain, 'use_tls', domainconfig)))
-            result=test.smtptest(relay,[address,testaddress],mailfrom=sender, timeout=timeout, use_tls=use_tls)
+            port = int(test.get_domain_config(domain, 'port', domainconfig))
+            result=test.smtptest(relay,[address,testaddress],mailfrom=sender, timeout=timeout, use_tls=use_tls, port=port)
             if result.state!=SMTPTestResult.TEST_OK:
                 print("There was a problem testing this server:")
                 print(result)
@@ -1548,7 +1584,8 @@ class SMTPTestCommandLineInterface(object):
         except (ValueError, TypeError):
             timeout = 10
         use_tls = bool(int(test.get_domain_config(domain, 'use_tls', domainconfig)))
-        result=test.smtptest(relay,[address,testaddress],mailfrom=sender, timeout=timeout, use_tls=use_tls)
+        port = int(test.get_domain_config(domain, 'port', domainconfig))
+        result=test.smtptest(relay,[address,testaddress],mailfrom=sender, timeout=timeout, use_tls=use_tls, port=port)
         
         servercachetime=int(test.get_domain_config(domain, 'test_server_interval', domainconfig))
         if result.state!=SMTPTestResult.TEST_OK:
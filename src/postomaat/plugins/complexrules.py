@@ -18,12 +18,12 @@
 #
 
 #TODO: do we need a "does not match regex" operator? (can curently be written as !bla=~/blubb/
-#TODO: regex modifiers
 
 #IDEA: pseudo field "senderdomain"
 #IDEA: operator "blacklistlookup"
 
-from postomaat.shared import ScannerPlugin,DUNNO,REJECT,DEFER,DEFER_IF_REJECT,DEFER_IF_PERMIT,OK,DISCARD,FILTER,HOLD,PREPEND,REDIRECT,WARN
+from postomaat.shared import ScannerPlugin,DUNNO,REJECT,DEFER,DEFER_IF_REJECT,DEFER_IF_PERMIT,OK,DISCARD,FILTER,HOLD,PREPEND,REDIRECT,WARN,FieldRegexSets,HAVE_RE2_SET
+from postomaat.stats import Statskeeper
 
 PYPARSING_AVAILABLE=False
 try:
@@ -44,7 +44,10 @@ except ImportError:
 import logging
 import os
 import time
-import string
+import glob
+import math
+from collections import deque
+from string import Template
 
 #allowed keywords at start of line
 postfixfields = ["smtpd_access_policy" , "protocol_state" , "protocol_name" , "helo_name",  "queue_id" , "sender" ,  "recipient" , "recipient_count" , "client_address" , "client_name" , "reverse_client_name" , "instance"  , "sasl_method" , "sasl_username" , "sasl_sender" , "size" , "ccert_subject" , "ccert_fingerprint" , "encryption_protocol" , "encryption_cipher" , "encryption_keysize" , "etrn_domain" , "stress" , "ccert_pubkey_fingerprint"]
@@ -57,18 +60,18 @@ if PYPARSING_AVAILABLE:
     AttOperator=oneOf("== != ~= > <")
     
     #allowed actions
-    ACTION = oneOf(map(string.upper, [DUNNO,REJECT,DEFER,DEFER_IF_REJECT,DEFER_IF_PERMIT,OK,DISCARD,FILTER,HOLD,PREPEND,REDIRECT,WARN]))
+    ACTION = oneOf([a.upper() for a in [DUNNO,REJECT,DEFER,DEFER_IF_REJECT,DEFER_IF_PERMIT,OK,DISCARD,FILTER,HOLD,PREPEND,REDIRECT,WARN]])
 
 class ValueChecker(object):
+    """a single comparison of a postfix field. compile() returns a predicate function(values,matches)
+    if regexsets (FieldRegexSets) is given, regexes are added to the set and the predicate looks up the match
+    in matches (the FieldMatches of the request), otherwise they are searched directly"""
 
-    def __init__(self,values,pfixname,op,checkval,modifiers=None):
-        self.debug=True
+    def __init__(self,pfixname,op,checkval,modifiers=None):
         self.pfixname=pfixname
         self.op=op
         self.checkval=checkval
         self.label="%s %s %s"%(pfixname,op,checkval)
-        self.values=values #all values
-        self.value=self.get_value() # the requested value
         self.logger=logging.getLogger('postomaat.complexrules.valuecheck')
         self.modifiers=modifiers
         self.funcs={
@@ -78,41 +81,53 @@ class ValueChecker(object):
          '<':self.fn_lt,
          '>':self.fn_gt,   
         }
-        
-    def get_value(self,name=None,defval=None):
-        if name is None:
-            name=self.pfixname
-            
-        if name not in self.values:
-            return defval
-        return self.values[name]
+    
+    def compile(self,regexsets=None):
+        if self.op=='~=':
+            return self.fn_regexmatches(regexsets)
+        return self.funcs[self.op]()
+    
+    def required_equalities(self):
+        """list of (field,value) which must be equal if this check is true"""
+        if self.op=='==':
+            return [(self.pfixname,self.checkval)]
+        return []
     
     def fn_equals(self):
-        return self.value==self.checkval
+        name=self.pfixname
+        checkval=self.checkval
+        return lambda values,matches: values.get(name)==checkval
 
     def fn_notequals(self):
-        return self.value!=self.checkval
+        name=self.pfixname
+        checkval=self.checkval
+        return lambda values,matches: values.get(name)!=checkval
+    
+    def _numeric(self,cmp):
+        name=self.pfixname
+        checkval=self.checkval
+        if name not in numeric:
+            self.logger.warn("can not use use < and > comparison operator on non-numeric value %s"%name)
+            return lambda values,matches: False
+        
+        def check(values,matches):
+            value=values.get(name)
+            if value is None:
+                return False
+            try:
+                numval=int(value)
+            except ValueError:
+                return False
+            return cmp(numval,checkval)
+        return check
     
     def fn_gt(self):
-        if self.pfixname not in numeric:
-            self.logger.warn("can not use use < and > comparison operator on non-numeric value %s"%self.pfixname)
-            return False
-        if self.value is None:
-            return False
-        numval=int(self.value)
-        return numval>self.checkval
+        return self._numeric(lambda a,b: a>b)
     
     def fn_lt(self):
-        if self.pfixname not in numeric:
-            self.logger.warn("can not use use < and > comparison operator on non-numeric value %s"%self.pfixname)
-            return False
-        if self.value is None:
-            return False
-        numval=int(self.value)
-        return numval<self.checkval
+        return self._numeric(lambda a,b: a<b)
     
-    def fn_regexmatches(self):
-        v=str(self.value)
+    def get_reflags(self):
         reflags=0
         if self.modifiers is not None:
             for flag in self.modifiers:
@@ -123,60 +138,68 @@ class ValueChecker(object):
                     reflags|=re.M
                 else:
                     self.logger.warn("unknown/unsupported regex flag '%s' - ignoring this flag"%(flag))
-        
-        try:
-            match= re.search(self.checkval, v,reflags)
-        except Exception as e:
-            match = None
-            logging.error(e)
-        return match is not None
-    
-    def __bool__(self):
-        func= self.funcs[self.op]
-        res=func()
-        #logmsg="%s %s %s ? : %s (%.4f)"%(self.pfixname,self.op,self.checkval,res,runtime)
-        #self.logger.debug(logmsg)
-        return res
-        
+        return reflags
+    
+    def fn_regexmatches(self,regexsets=None):
+        name=self.pfixname
+        if regexsets is not None:
+            ruleid=regexsets.add(name,self.checkval,self.get_reflags())
+            return lambda values,matches: ruleid in matches.get(name)
+        search=re.compile(self.checkval,self.get_reflags()).search
+        return lambda values,matches: search(str(values.get(name))) is not None
     
     def __str__(self):
         return self.label
     __repr__ = __str__
-    __nonzero__ = __bool__
 
 
 class BoolBinOp(object):
     reprsymbol = None
-    def evalop(self, arg):
+    def compile(self,regexsets=None):
         raise NotImplementedError
+    def required_equalities(self):
+        return []
     def __init__(self,t):
         self.args = t[0][0::2]
     def __str__(self):
         sep = " %s " % self.reprsymbol
         return "(" + sep.join(map(str,self.args)) + ")"
-    def __bool__(self):
-        return self.evalop(bool(a) for a in self.args)
-    __nonzero__ = __bool__
     __repr__ = __str__
 
 class BoolAnd(BoolBinOp):
     reprsymbol = '&&'
-    evalop = all
+    def required_equalities(self):
+        req=[]
+        for a in self.args:
+            req.extend(a.required_equalities())
+        return req
+    def compile(self,regexsets=None):
+        preds = tuple(a.compile(regexsets) for a in self.args)
+        if len(preds)==2:
+            p1,p2=preds
+            return lambda values,matches: p1(values,matches) and p2(values,matches)
+        return lambda values,matches: all(p(values,matches) for p in preds)
 
 class BoolOr(BoolBinOp):
     reprsymbol = ',,'
-    evalop = any
+    def compile(self,regexsets=None):
+        preds = tuple(a.compile(regexsets) for a in self.args)
+        if len(preds)==2:
+            p1,p2=preds
+            return lambda values,matches: p1(values,matches) or p2(values,matches)
+        return lambda values,matches: any(p(values,matches) for p in preds)
 
 class BoolNot(object):
     def __init__(self,t):
         self.arg = t[0][1]
-    def __bool__(self):
-        v = bool(self.arg)
-        return not v
+    def compile(self,regexsets=None):
+        pred = self.arg.compile(regexsets)
+        return lambda values,matches: not pred(values,matches)
+    def required_equalities(self):
+        return []
     def __str__(self):
         return "!" + str(self.arg)
     __repr__ = __str__
-    __nonzero__ = __bool__
 
 
 if PYPARSING_AVAILABLE:
@@ -186,7 +209,13 @@ if PYPARSING_AVAILABLE:
     AttOperand= charstring | intnum
 
 
-def makeparser(values):
+_PARSER=None
+def makeparser():
+    """returns the rule grammar. the parse result of a rule is (checkrule,action,message)"""
+    global _PARSER
+    if _PARSER is not None:
+        return _PARSER
+    
     SimpleExpression = PF_KEYWORD('pfvalue') + AttOperator('operator') + AttOperand('testvalue')
         
     booleanrule = infixNotation( SimpleExpression,
@@ -209,79 +238,278 @@ def makeparser(values):
             logging.error("Parser error, got unexpected token amount, tokens=%s"%tokens)
         #print "checking %s %s %s"%(pfixname,op,checkval)
         
-        return ValueChecker(values,pfixname,op,checkval,modifiers)
+        return ValueChecker(pfixname,op,checkval,modifiers)
 
     SimpleExpression.setParseAction(evalResult)
     #SimpleExpression.setDebug()
     configline=booleanrule + ACTION + restOfLine
+    _PARSER=configline
     return configline
 
 
+class ComplexRule(object):
+    """a rule parsed and compiled once. predicate(values,matches) returns True if the rule matches"""
+    def __init__(self,rule):
+        self.rule=rule
+        self.checkrule,self.action,message=makeparser().parseString(rule)
+        self.message=message.strip()
+        self.predicate=self.checkrule.compile()
+    
+    def index_keys(self):
+        """returns the list of (field,value) tuples which must be equal for this rule to match"""
+        keys=[]
+        for field,value in self.checkrule.required_equalities():
+            try:
+                hash(value)
+            except TypeError:
+                continue
+            keys.append((field,value))
+        return keys
+    
+    def __str__(self):
+        return self.rule
+    __repr__ = __str__
+
+
+class RuleIndex(object):
+    """Index of rules keyed on an equality predicate that must hold for the rule to match.
+    candidates() only returns the positions of rules whose indexed field matches plus all unindexable rules,
+    in their original order. If a rule requires multiple equalities, the one shared by the fewest rules is indexed.
+    
+    If re2 with its Set API is available, all regexes of the rules are combined into one set per field,
+    which is scanned once per field and request. Without re2 the regexes of the candidate rules are searched one by one,
+    as matching all of them up front would cost more than the index saves."""
+    def __init__(self,rules):
+        self.rules=rules
+        self.unindexed=[]
+        self.index={} # field -> {value -> [rule positions]}
+        if HAVE_RE2_SET:
+            self.regexsets=FieldRegexSets()
+            self.predicates=[rule.checkrule.compile(self.regexsets) for rule in rules]
+            self.regexsets.compile()
+        else:
+            self.regexsets=None
+            self.predicates=[rule.predicate for rule in rules]
+        
+        allkeys=[rule.index_keys() for rule in rules]
+        keycount={}
+        for keys in allkeys:
+            for key in keys:
+                keycount[key]=keycount.get(key,0)+1
+        
+        for pos,keys in enumerate(allkeys):
+            if not keys:
+                self.unindexed.append(pos)
+                continue
+            field,value=min(keys,key=lambda k:keycount[k])
+            self.index.setdefault(field,{}).setdefault(value,[]).append(pos)
+    
+    def matches(self,values):
+        """returns the regex match results for this request"""
+        if self.regexsets is None:
+            return None
+        return self.regexsets.matches(lambda field: str(values.get(field)))
+    
+    def candidates(self,values):
+        """returns the positions of all rules which could match values"""
+        positions=self.unindexed
+        merged=None
+        for field,valuemap in self.index.items():
+            hits=valuemap.get(values.get(field))
+            if hits:
+                if merged is None:
+                    merged=list(positions)
+                merged.extend(hits)
+        if merged is not None:
+            merged.sort()
+            positions=merged
+        return positions
+    
+    def indexed_count(self):
+        return len(self.rules)-len(self.unindexed)
+
+
+class RuleStats(object):
+    """cumulative profiling counters of one rule. Updated without a lock, concurrent threads may
+    occasionally lose an increment, which is good enough for profiling"""
+    samplesize=1000 # number of recent evaluation times kept for the percentile
+    
+    def __init__(self):
+        self.evaluations=0
+        self.hits=0
+        self.errors=0
+        self.totaltime=0.0
+        self.maxtime=0.0
+        self.recent=deque(maxlen=self.samplesize)
+    
+    def add(self,ruletime,hit):
+        self.evaluations+=1
+        if hit:
+            self.hits+=1
+        self.totaltime+=ruletime
+        if ruletime>self.maxtime:
+            self.maxtime=ruletime
+        self.recent.append(ruletime)
+    
+    def percentile(self,pct=99):
+        """returns the pct percentile of the recent evaluation times"""
+        samples=sorted(self.recent)
+        if not samples:
+            return 0.0
+        idx=int(math.ceil(pct/100.0*len(samples)))-1
+        return samples[max(idx,0)]
+    
+    def as_dict(self,percentiles=False):
+        """the counters as dict, with the p99 time if percentiles is True (sorts the recent samples)"""
+        evaluations=self.evaluations
+        result={
+            'evaluations':evaluations,
+            'hits':self.hits,
+            'errors':self.errors,
+            'totaltime':self.totaltime,
+            'avgtime':self.totaltime/evaluations if evaluations else 0.0,
+            'maxtime':self.maxtime,
+        }
+        if percentiles:
+            result['p99']=self.percentile(99)
+        return result
+
+
 class ComplexRuleParser(object):
     def __init__(self):
         self.rules=[]
+        self.index=None
+        self.rulestats={} # rule text -> RuleStats, kept across reloads for unchanged rules
         self.logger=logging.getLogger('postomaat.complexruleparser')
         
         self.warn_rule_execution_time=0.5 #warn limit per rule
         self.warn_total_execution_time=3 #warn limit for all rules
         self.max_execution_time=5.0  #hard limit
     
-    def add_rule(self,rule):
+    def _make_rule(self,rule):
+        """returns the compiled rule or None if it can not be parsed"""
         try:
-            _=makeparser({}).parseString(rule)  #test
-            self.rules.append(rule)
-            return True
+            return ComplexRule(rule)
         except ParseException as pe:
             self.logger.error("Could not parse rule -->%s<-- "%rule)
             self.logger.error(str(pe))
-        return False
+        except re.error as e:
+            self.logger.error("Invalid regex in rule -->%s<-- : %s"%(rule,str(e)))
+        return None
+    
+    def add_rule(self,rule):
+        compiled=self._make_rule(rule)
+        if compiled is None:
+            return False
+        self.rules=self.rules+[compiled]
+        self.index=None
+        return True
     
     def clear_rules(self):
         self.rules=[]
-        
-    def rules_from_string(self,all_rules):
-        if all_rules is None:
-            return
+        self.index=None
+    
+    def _parse_rules(self,all_rules):
+        """returns a tuple ([compiled rules],all_ok)"""
+        newrules=[]
         all_ok=True
         for line in all_rules.splitlines():
             line=line.strip()
             if line=='' or line.startswith('#'):
                 continue
-            if not self.add_rule(line):
+            compiled=self._make_rule(line)
+            if compiled is None:
                 all_ok=False
-                
+            else:
+                newrules.append(compiled)
+        return newrules,all_ok
+        
+    def rules_from_string(self,all_rules):
+        if all_rules is None:
+            return
+        newrules,all_ok=self._parse_rules(all_rules)
+        self.rules=self.rules+newrules
+        self.index=None
+        return all_ok
+    
+    def load_rules(self,all_rules):
+        """replace all current rules. the new rules become active at once, when all of them are parsed"""
+        if all_rules is None:
+            return
+        newrules,all_ok=self._parse_rules(all_rules)
+        self.rules=newrules
+        self.index=None
         return all_ok
 
+    def get_index(self):
+        index=self.index
+        if index is None or index.rules is not self.rules:
+            index=RuleIndex(self.rules)
+            rulestats={}
+            for rule in index.rules:
+                stats=self.rulestats.get(rule.rule)
+                if stats is None:
+                    stats=rulestats.get(rule.rule) or RuleStats()
+                rulestats[rule.rule]=stats
+            index.stats=[rulestats[rule.rule] for rule in index.rules]
+            self.rulestats=rulestats
+            self.index=index
+        return index
+    
+    def get_rulestats(self,percentiles=False):
+        """returns a list of dicts with the profiling counters of all active rules, in rule order.
+        does not build the index, the p99 times are only included if percentiles is True"""
+        rules=self.rules
+        index=self.index
+        if index is not None and index.rules is rules:
+            allstats=index.stats
+        else:
+            allstats=[self.rulestats.get(rule.rule) or RuleStats() for rule in rules]
+        result=[]
+        for rule,stats in zip(rules,allstats):
+            entry=stats.as_dict(percentiles)
+            entry['rule']=rule.rule
+            result.append(entry)
+        return result
+    
+    def dump_rulestats(self,sortkey='totaltime'):
+        """returns the rule profiling counters as text table, most expensive rules first"""
+        entries=sorted(self.get_rulestats(percentiles=True),key=lambda e:e[sortkey],reverse=True)
+        lines=["%10s %10s %8s %10s %9s %9s %9s  %s"%('evals','hits','errors','total(s)','avg(ms)','max(ms)','p99(ms)','rule')]
+        for e in entries:
+            lines.append("%10s %10s %8s %10.3f %9.3f %9.3f %9.3f  %s"%(e['evaluations'],e['hits'],e['errors'],e['totaltime'],
+                         e['avgtime']*1000,e['maxtime']*1000,e['p99']*1000,e['rule']))
+        return "\n".join(lines)+"\n"
+
     def apply(self,values):
         totalstart=time.time()
-        parser=makeparser(values)
-        ruletimes={}
-        for rule in self.rules:
+        index=self.get_index()
+        matches=index.matches(values)
+        for pos in index.candidates(values):
+            rule=index.rules[pos]
             rulestart=time.time()
             try:
-                parsetree=parser.parseString(rule)  #test
-                checkrule,action,message=parsetree
-                bmatch=bool(checkrule)
-                
-                now=time.time()
-                ruletime=now-rulestart
-                ruletimes[ruletime]=rule
-                
-                if self.warn_rule_execution_time>0 and ruletime>self.warn_rule_execution_time:
-                    self.logger.warn("warning: slow complexrule execution: %.4f for %s"%(ruletime,rule))
-                
-                if bmatch:
-                    logmsg="postomaat-rulehit: sender=%s recipient=%s rule=%s %s %s"%(values.get('sender'),values.get('recipient'),checkrule,action,message)
-                    self.logger.info(logmsg)
-                    return action,message.strip()
-                
-                if (now-totalstart)>self.max_execution_time:
-                    self.logger.warn("warning: complex max execution time limit reached - not all rules have been executed")
-                    break
-                
-            except ParseException as pe:
-                self.logger.warning("""Could not apply rule "%s" to message %s """%(rule,values))
-                self.logger.warning(str(pe))
+                bmatch=index.predicates[pos](values,matches)
+            except Exception as e:
+                index.stats[pos].errors+=1
+                self.logger.warning("""Could not apply rule "%s" to message %s : %s"""%(rule,values,str(e)))
+                continue
+            
+            now=time.time()
+            ruletime=now-rulestart
+            index.stats[pos].add(ruletime,bmatch)
+            
+            if self.warn_rule_execution_time>0 and ruletime>self.warn_rule_execution_time:
+                self.logger.warn("warning: slow complexrule execution: %.4f for %s"%(ruletime,rule))
+            
+            if bmatch:
+                logmsg="postomaat-rulehit: sender=%s recipient=%s rule=%s %s %s"%(values.get('sender'),values.get('recipient'),rule.checkrule,rule.action,rule.message)
+                self.logger.info(logmsg)
+                return rule.action,rule.message
+            
+            if (now-totalstart)>self.max_execution_time:
+                self.logger.warn("warning: complex max execution time limit reached - not all rules have been executed")
+                break
                 
         totaltime=time.time()-totalstart
         if self.warn_total_execution_time>0 and totaltime>self.warn_total_execution_time:
@@ -342,10 +570,56 @@ class ComplexRules(ScannerPlugin):
                 'default':'/etc/postomaat/complexrules.cf',
                 'description':'File containing rules',
             },
+            'rulestatsfile':{
+                'default':'',
+                'description':'periodically write per rule profiling counters (evaluations, hits, total/max/p99 time) to this file, most expensive rules first. ${pid} is replaced by the process id (use it with the process backend). leave empty to disable',
+            },
+            'rulestatsinterval':{
+                'default':'60',
+                'description':'write the rule statistics file every n seconds',
+            },
         }
         self.ruleparser=ComplexRuleParser()
         self.filereloader=FileReloader(None)
+        self.lastrulestatswrite=time.time()
+        Statskeeper().register_provider('complexrules.%s'%self.section,self.ruleparser.get_rulestats)
+    
+    def _rulestatsfile(self,pid=None):
+        filename=self.config.get(self.section,'rulestatsfile').strip()
+        if filename=='':
+            return None
+        if pid is None:
+            pid=os.getpid()
+        return Template(filename).safe_substitute(pid=pid)
+    
+    def write_rulestats_if_necessary(self):
+        now=time.time()
+        if now-self.lastrulestatswrite<self.config.getint(self.section,'rulestatsinterval'):
+            return
+        self.lastrulestatswrite=now
+        filename=self._rulestatsfile()
+        if filename is None:
+            return
+        try:
+            tmpname='%s.tmp'%filename
+            with open(tmpname,'w') as fp:
+                fp.write(self.ruleparser.dump_rulestats())
+            os.rename(tmpname,filename)
+        except Exception as e:
+            self.logger.error("Could not write rule statistics to %s: %s"%(filename,str(e)))
         
+    def reload_lists(self):
+        if not PYPARSING_AVAILABLE:
+            return []
+        filename=self.config.get(self.section,'filename').strip()
+        if not os.path.exists(filename):
+            return []
+        self.filereloader.filename=filename
+        self.filereloader.lastreload=0
+        if self.filereloader.reloadifnecessary():
+            self.ruleparser.load_rules(self.filereloader.content)
+        return [filename]
+    
     def examine(self,suspect):        
         if not PYPARSING_AVAILABLE:
             return DUNNO,''
@@ -357,8 +631,7 @@ class ComplexRules(ScannerPlugin):
         self.filereloader.filename=filename
         newcontent=self.filereloader.reloadifnecessary()
         if newcontent:
-            self.ruleparser.clear_rules()
-            reloadok=self.ruleparser.rules_from_string(self.filereloader.content)
+            reloadok=self.ruleparser.load_rules(self.filereloader.content)
             numrules=len(self.ruleparser.rules)
             if reloadok:
                 okmsg="all rules ok"
@@ -367,6 +640,7 @@ class ComplexRules(ScannerPlugin):
             self.logger.info("Rule reload complete, %s rules now active, (%s)"%(numrules,okmsg))
         
         retaction,retmessage=self.ruleparser.apply(suspect.values)
+        self.write_rulestats_if_necessary()
         return retaction,retmessage
 
     def lint(self):
@@ -390,11 +664,21 @@ class ComplexRules(ScannerPlugin):
         newcontent=self.filereloader.reloadifnecessary()
         assert newcontent
         
-        self.ruleparser.clear_rules()
-        ok= self.ruleparser.rules_from_string(self.filereloader.content)
+        ok= self.ruleparser.load_rules(self.filereloader.content)
         rulecount=len(self.ruleparser.rules)
-        print("%s rules ok"%(rulecount))
+        print("%s rules ok, %s indexed"%(rulecount,self.ruleparser.get_index().indexed_count()))
+        self.lint_rulestats()
         return ok
+    
+    def lint_rulestats(self):
+        """print the rule statistics files written by the running postomaat"""
+        pattern=self._rulestatsfile(pid='*')
+        if pattern is None:
+            return
+        for filename in sorted(glob.glob(pattern)):
+            print("Rule statistics from %s:"%filename)
+            with open(filename,'r') as fp:
+                print(fp.read())
 
                         
     def __str__(self):
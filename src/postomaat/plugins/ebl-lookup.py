@@ -39,6 +39,10 @@ except ImportError:
 
 
 class EBLLookup(ScannerPlugin):
+    verdictcache_keys = ('sender',)
+    verdictcache_templates = ('messagetemplate',)
+    concurrent_safe = True
+    
     def __init__(self,config,section=None):
         ScannerPlugin.__init__(self,config,section)
         self.logger=self._logger()
@@ -87,7 +91,8 @@ class EBLLookup(ScannerPlugin):
             return False
         
         whitelisted = False
-        self.whitelist = FileList(whitelist_file,lowercase=True)
+        if self.whitelist is None or self.whitelist.filename != whitelist_file:
+            self.whitelist = FileList(whitelist_file,lowercase=True)
         if from_domain in self.whitelist.get_list():
             whitelisted = True
             
@@ -214,7 +219,7 @@ class EBLLookup(ScannerPlugin):
         
         if listed:
             values = {
-                'dnszone': self.config.get(self.section,'dnszone','').strip(),
+                'dnszone': self.config.get(self.section,'dnszone').strip(),
                 'message': message,
             }
             message = apply_template(self.config.get(self.section,'messagetemplate'),suspect, values)
@@ -225,7 +230,7 @@ class EBLLookup(ScannerPlugin):
         
     
     def lint(self):
-        dnszone = self.config.get(self.section,'dnszone','').strip()
+        dnszone = self.config.get(self.section,'dnszone').strip()
         print('querying zone %s' % dnszone)
         
         lint_ok = True
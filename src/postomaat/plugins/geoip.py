@@ -146,6 +146,8 @@ class GeoIPCache(PyGeoIPCache):
         
         
 class GeoIPPlugin(ScannerPlugin):
+    verdictcache_keys = ('client_address',)
+    verdictcache_templates = ('reject_message',)
                                          
     def __init__(self,config,section=None):
         ScannerPlugin.__init__(self,config,section)
@@ -24,6 +24,8 @@ class HELOTLDPlugin(ScannerPlugin):
     """
     This plugin rejects messages if the HELO uses an invalid TLD
     """
+    verdictcache_keys = ('helo_name',)
+    verdictcache_templates = ('messagetemplate',)
                                          
     def __init__(self,config,section=None):
         ScannerPlugin.__init__(self,config,section)
@@ -3,6 +3,7 @@ import time
 from threading import Lock
 from postomaat.shared import ScannerPlugin, DUNNO, string_to_actioncode, apply_template
 from postomaat.extensions.sql import SQL_EXTENSION_ENABLED, get_session
+from postomaat.trace import span
 import re
 import os
 import sys
@@ -110,13 +111,16 @@ if REDIS_AVAILABLE:
             self.redis = redis.StrictRedis(host=host,port=port,db=db)
 
         def _real_add(self,eventname,timestamp):
-            self.redis.zadd(self._fix_eventname(eventname), timestamp, timestamp)
+            with span('redis', 'zadd'):
+                self.redis.zadd(self._fix_eventname(eventname), timestamp, timestamp)
 
         def _real_clear(self,eventname,abstime):
-            self.redis.zremrangebyscore(self._fix_eventname(eventname), '-inf', abstime)
+            with span('redis', 'zremrangebyscore'):
+                self.redis.zremrangebyscore(self._fix_eventname(eventname), '-inf', abstime)
 
         def _real_count(self,eventname):
-            return self.redis.zcard(self._fix_eventname(eventname))
+            with span('redis', 'zcard'):
+                return self.redis.zcard(self._fix_eventname(eventname))
 
     AVAILABLE_RATELIMIT_BACKENDS['redis']=RedisBackend
 
@@ -24,6 +24,7 @@ import re
 
 class IdentityCrisis(ScannerPlugin):
     """ Reject clients with no FCcdns and address literal HELO """
+    verdictcache_keys = ('reverse_client_name', 'helo_name')
     def __init__(self,config,section=None):
         ScannerPlugin.__init__(self,config,section)
         self.logger=self._logger()
@@ -71,6 +72,7 @@ class IdentityCrisis(ScannerPlugin):
 
 class CreativeTLD(ScannerPlugin):
     """ Reject clients with unofficial TLD in rdns """
+    verdictcache_keys = ('reverse_client_name',)
     def __init__(self,config,section=None):
         ScannerPlugin.__init__(self,config,section)
         self.logger=self._logger()
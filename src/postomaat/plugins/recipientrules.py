@@ -20,15 +20,42 @@ import re
 import logging
 import os
 import time
-from postomaat.shared import ScannerPlugin, apply_template, REJECT,DEFER,ACCEPT,OK,DUNNO,DISCARD,HOLD,PREPEND,REDIRECT,WARN
+from postomaat.shared import ScannerPlugin, apply_template, REJECT,DEFER,ACCEPT,OK,DUNNO,DISCARD,HOLD,PREPEND,REDIRECT,WARN, FieldRegexSets, HAVE_RE2_SET
 
 lg=logging.getLogger('postomaat.plugins.recipientrules')
 
+numeric_values=['recipient_count','size','encryption_keysize']
+
+def rule_values(suspect):
+    """returns a copy of the suspect values the rules are checked against"""
+    allvals=dict(suspect.values)
+    allvals['from_address']=suspect.from_address
+    allvals['to_address']=suspect.to_address
+    allvals['from_domain']=suspect.from_domain
+    allvals['to_domain']=suspect.to_domain
+    
+    for nv in numeric_values:
+        try:
+            allvals[nv]=int(allvals[nv])
+        except (KeyError,ValueError,TypeError):
+            pass
+    return allvals
+
+def field_value(allvals,field):
+    susval=allvals.get(field,'')
+    try:
+        susval=susval.strip()
+    except Exception:
+        pass
+    return susval
+
+
 class RulePart(object):
     def __init__(self):
         self.field=None
         self.operator=None
         self.value=''
+        self.regexid=None # id in the FieldRegexSets of the ruleset if the regex is matched by the set
         
 
 class RecRule(object):
@@ -37,35 +64,24 @@ class RecRule(object):
         self.action=None
         self.message=None
         
-    def hit(self,suspect):
-        """iterates over parts and returns True if all parts match"""
-        allvals=suspect.values
-        allvals['from_address']=suspect.from_address
-        allvals['to_address']=suspect.to_address
-        allvals['from_domain']=suspect.from_domain
-        allvals['to_domain']=suspect.to_domain
-        
-        numeric_values=['recipient_count','size','encryption_keysize']
-        for nv in numeric_values:
-            try:
-                allvals[nv]=int(allvals[nv])
-            except ValueError:
-                pass
+    def hit(self,suspect,allvals=None,matches=None):
+        """iterates over parts and returns True if all parts match
+        allvals: the values from rule_values(suspect), computed if not given
+        matches: FieldMatches of the ruleset's regexes for this request, if available"""
+        if allvals is None:
+            allvals=rule_values(suspect)
+        debug=lg.isEnabledFor(logging.DEBUG)
 
         #lg.debug(allvals)
         
         for part in self.parts:
-            susval=allvals.get(part.field,'')
-            try:
-                susval=susval.strip()
-            except Exception:
-                pass
+            susval=field_value(allvals,part.field)
             
             checkval=part.value
             if part.field in numeric_values:
                 try:
                     checkval=int(checkval)
-                except ValueError:
+                except (ValueError,TypeError):
                     pass
             if part.operator=='=':
                 hit=susval==checkval
@@ -80,15 +96,19 @@ class RecRule(object):
                     susval=0
                 hit=susval<checkval
             elif part.operator=='~':
-                hit=re.match(checkval,str(susval)) is not None
+                if matches is not None and part.regexid is not None:
+                    hit=part.regexid in matches.get(part.field)
+                else:
+                    hit=checkval.match(str(susval)) is not None
             else:
                 lg.warn("Unknown rule operator '%s'"%part.operator)
                 continue
             
-            dbgcheckval=checkval
-            if hasattr(checkval,'pattern'):
-                dbgcheckval=checkval.pattern
-            lg.debug(" '%s' %s '%s' ? : %s"%(susval,part.operator,dbgcheckval,hit))
+            if debug:
+                dbgcheckval=checkval
+                if hasattr(checkval,'pattern'):
+                    dbgcheckval=checkval.pattern
+                lg.debug(" '%s' %s '%s' ? : %s"%(susval,part.operator,dbgcheckval,hit))
             
             if not hit:
                 return None
@@ -141,6 +161,7 @@ class RecipientRules(ScannerPlugin):
             }                  
         }
         self.ruledict=None
+        self.ruleset=None # (ruledict,regexsets), replaced as a whole on reload
         self.lastreload=0
 
     def filechanged(self):
@@ -155,8 +176,29 @@ class RecipientRules(ScannerPlugin):
         if self.ruledict is None or self.filechanged():
             filename=self.config.get(self.section,'configfile')
             lg.info("Reloading file: %s"%filename)
-            self.ruledict=self.load_file(filename)
+            ruledict=self.load_file(filename)
+            self.ruleset=(ruledict,self.build_regexsets(ruledict))
+            self.ruledict=ruledict
             self.lastreload=time.time()
+    
+    def reload_lists(self):
+        self.ruledict=None
+        self.reload_if_necessary()
+        return [self.config.get(self.section,'configfile')]
+    
+    def build_regexsets(self,ruledict):
+        """combine the regexes of all rules into one set per field, so each field is scanned once per request.
+        returns None if the re2 set is not available, the regexes are then matched by each rule"""
+        if not HAVE_RE2_SET:
+            return None
+        regexsets=FieldRegexSets(anchored=True)
+        for rules in ruledict.values():
+            for recrule in rules:
+                for part in recrule.parts:
+                    if part.operator=='~':
+                        part.regexid=regexsets.add(part.field,part.value)
+        regexsets.compile()
+        return regexsets
             
     def examine(self,suspect):
         starttime=time.time()
@@ -164,14 +206,20 @@ class RecipientRules(ScannerPlugin):
         retmessage=None
         self.reload_if_necessary()
         
+        ruledict,regexsets=self.ruleset
+        
         to_domain=suspect.to_domain
         to_address=suspect.to_address
+        allvals=rule_values(suspect)
+        matches=None
+        if regexsets is not None:
+            matches=regexsets.matches(lambda field: str(field_value(allvals,field)))
         
         for rec in [to_address,to_domain,'global']:
-            if rec in self.ruledict:
+            if rec in ruledict:
                 lg.debug("Found rules for %s"%rec)
-                for recrule in self.ruledict[rec]:
-                    result=recrule.hit(suspect)
+                for recrule in ruledict[rec]:
+                    result=recrule.hit(suspect,allvals,matches)
                     if result:
                         return recrule.action,apply_template(recrule.message,suspect)
         
@@ -308,7 +356,7 @@ class RecipientRules(ScannerPlugin):
                 lg.warn("%s: cannot parse line %s: %s"%(filename, lc,line))
         
         #remove keys without actual working rules
-        for k in retdict.keys():
+        for k in list(retdict.keys()):
             if len(retdict[k])==0:
                 del retdict[k]
         
@@ -46,6 +46,10 @@ class SPFPlugin(ScannerPlugin):
 
     valid result types are: 'pass', 'permerror', 'fail', 'temperror', 'softfail', 'none', and 'neutral'
     """
+    verdictcache_keys = ('client_address', 'helo_name', 'sender')
+    verdictcache_tags = ('spf',)
+    verdictcache_templates = ('messagetemplate',)
+    concurrent_safe = True
                                          
     def __init__(self,config,section=None):
         ScannerPlugin.__init__(self,config,section)
@@ -89,7 +93,7 @@ class SPFPlugin(ScannerPlugin):
     
     def check_this_domain(self, from_domain):
         do_check = False
-        selective_sender_domain_file=self.config.get(self.section,'domain_selective_spf_file','').strip()
+        selective_sender_domain_file=self.config.get(self.section,'domain_selective_spf_file').strip()
         if selective_sender_domain_file != '' and os.path.exists(selective_sender_domain_file):
             if self.selective_domain_loader is None:
                 self.selective_domain_loader=FileList(selective_sender_domain_file,lowercase=True)
@@ -97,7 +101,7 @@ class SPFPlugin(ScannerPlugin):
                 do_check = True
                 
         if not do_check:
-            dbconnection = self.config.get(self.section, 'dbconnection', '').strip()
+            dbconnection = self.config.get(self.section,'dbconnection').strip()
             sqlquery = self.config.get(self.section, 'domain_sql_query')
             
             if dbconnection!='' and SQL_EXTENSION_ENABLED:
@@ -126,7 +130,7 @@ class SPFPlugin(ScannerPlugin):
             return True
 
         #check ip whitelist
-        ip_whitelist_file=self.config.get(self.section,'ip_whitelist_file', '').strip()
+        ip_whitelist_file=self.config.get(self.section,'ip_whitelist_file').strip()
         if ip_whitelist_file != '' and os.path.exists(ip_whitelist_file):
             plainlist = []
             if self.ip_whitelist_loader is None:
@@ -209,18 +213,18 @@ class SPFPlugin(ScannerPlugin):
             print('Error checking config')
             lint_ok = False
             
-        selective_sender_domain_file=self.config.get(self.section,'domain_selective_spf_file','').strip()
+        selective_sender_domain_file=self.config.get(self.section,'domain_selective_spf_file').strip()
         if selective_sender_domain_file != '' and not os.path.exists(selective_sender_domain_file):
             print("domain_selective_spf_file %s does not exist" % selective_sender_domain_file)
             lint_ok = False
             
-        ip_whitelist_file=self.config.get(self.section,'ip_whitelist_file', '').strip()
+        ip_whitelist_file=self.config.get(self.section,'ip_whitelist_file').strip()
         if ip_whitelist_file != '' and os.path.exists(ip_whitelist_file):
             print("ip_whitelist_file %s does not exist - IP whitelist is disabled" % ip_whitelist_file)
             lint_ok = False
         
         sqlquery = self.config.get(self.section, 'domain_sql_query')
-        dbconnection = self.config.get(self.section, 'dbconnection', '').strip()
+        dbconnection = self.config.get(self.section,'dbconnection').strip()
         if not SQL_EXTENSION_ENABLED and dbconnection != '':
             print('SQLAlchemy not available, cannot use SQL backend')
             lint_ok = False
@@ -19,24 +19,60 @@ import postomaat.logtools as logtools
 from postomaat.addrcheck import Addrcheck
 import multiprocessing
 import multiprocessing.queues
-
-from postomaat.scansession import SessionHandler
+import multiprocessing.sharedctypes
+import ctypes
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from postomaat.scansession import SessionHandler, format_threadinfo
 import postomaat.core
 import logging
 import traceback
-from postomaat.stats import Statskeeper, StatDelta
+from postomaat.stats import Statskeeper, StatDelta, Histogram, SCALAR_COUNTERS
+from postomaat.control import run_local_command
+import postomaat.profiler
+import postomaat.trace
 import threading
 import pickle
 import signal
+import select
+import socket
+import errno
+import time
+import os
+try:
+    import resource
+except ImportError:
+    resource = None
+
+IDLE_STATES = ('created', 'loading configuration', 'waiting for task', 'waiting for connection')
+LOADING_STATES = ('created', 'loading configuration')
+FAILED_STATES = ('crashed', 'plugin load failed')
 
 class ProcManager(object):
-    def __init__(self, logQueue, numprocs = None, queuesize=100, config = None):
+    def __init__(self, logQueue, numprocs = None, queuesize=100, config = None, prefork = False, minprocs = None, maxprocs = None,
+                 respawn_backoff = 1, idletimeout = 60):
         self._child_id_counter=0
+        self.set_limits(numprocs, minprocs, maxprocs, respawn_backoff, idletimeout)
+        self.crashes = 0 # consecutive crashes
+        self.lastcrash = 0
+        self.nextspawn = 0
+        self.lastbusy = time.time()
+        self.spawned = 0
+        self.crashed = 0
+        self.exited = 0
+        self.workerlock = threading.Lock()
+        self.prefork = prefork # workers accept connections on inherited listening sockets, see set_listeners
+        self.listeners = [] # prefork: (port, listening socket)
+        self.stopevents = {} # worker name -> event telling the worker to end after its current session
         self._logQueue = logQueue
-        self.manager = multiprocessing.Manager()
-        self.shared_state = self._init_shared_state()
+        # room for the workers of a rolling reload and maxprocs raised by later reloads
+        self.statetable = WorkerStateTable(max(4 * self.maxprocs, 64))
+        self.slots = {} # worker name -> slot in the state table
         self.config = config
-        self.numprocs = numprocs
+        self.configsnapshot = config_snapshot(config)
         self.workers = []
         self.queuesize = queuesize
         self.tasks = multiprocessing.Queue(queuesize)
@@ -46,11 +82,65 @@ class ProcManager(object):
         self._stayalive = True
         self.name = 'ProcessPool'
         self.message_listener = MessageListener(self.child_to_server_messages)
+        Statskeeper().register_counter_source('procpool', self.worker_counters)
+        self.supervisor = threading.Thread(target=self._supervise, name='ProcessPool supervisor')
+        self.supervisor.daemon = True
         self.start()
 
-    def _init_shared_state(self):
-        shared_state = self.manager.dict()
-        return shared_state
+    def set_limits(self, numprocs, minprocs = None, maxprocs = None, respawn_backoff = 1, idletimeout = 60):
+        # the supervisor keeps between minprocs and maxprocs workers, starting with numprocs
+        self.numprocs = numprocs
+        self.minprocs = minprocs or numprocs
+        self.maxprocs = max(maxprocs or numprocs, self.minprocs, numprocs)
+        self.respawn_backoff = respawn_backoff # seconds before respawning a crashed worker, doubled for each further crash
+        self.idletimeout = idletimeout # seconds without a busy moment before a worker above minprocs is stopped
+
+    def _allocate_slot(self, worker_name):
+        used = set(self.slots.values())
+        for slot in range(len(self.statetable)):
+            if slot not in used:
+                self.statetable.reset(slot)
+                self.slots[worker_name] = slot
+                return slot
+        self.logger.warning('No free slot in the worker state table for %s' % worker_name)
+        return -1
+
+    def _release_slot(self, worker):
+        """free the state table slot of an ended worker, its counters are added to the totals"""
+        slot = self.slots.get(worker.name, -1)
+        if slot < 0:
+            return
+        def release():
+            self.slots.pop(worker.name, None)
+            self.statetable.clear(slot)
+        Statskeeper().add_counters(self.statetable.get_counters(slot), release)
+
+    def worker_counters(self):
+        """returns the sum of the statistics counters of the running workers"""
+        counters = {}
+        for slot in list(self.slots.values()):
+            for name, value in self.statetable.get_counters(slot).items():
+                counters[name] = counters.get(name, 0) + value
+        return counters
+
+    def get_state(self, worker):
+        """returns the current state of worker"""
+        slot = self.slots.get(worker.name, -1)
+        if slot < 0:
+            return 'created'
+        return self.statetable.get_state(slot)
+
+    def worker_states(self):
+        """returns a dict per worker: name, pid, state, since (state change timestamp), lastbusy, lastidle, requests"""
+        result = []
+        for worker in list(self.workers):
+            slot = self.slots.get(worker.name, -1)
+            if slot < 0:
+                continue
+            info = self.statetable.read(slot)
+            info['name'] = worker.name
+            result.append(info)
+        return result
 
     @property
     def stayalive(self):
@@ -66,36 +156,259 @@ class ProcManager(object):
 
     def _send_poison_pills(self):
         """flood the queue with poison pills to tell all workers to shut down"""
+        for worker in self.workers:
+            if worker.name in self.stopevents:
+                self.stopevents[worker.name].set()
+        if self.prefork:
+            return
         for _ in range(len(self.workers)):
             # tasks queue is FIFO queue. As long as nothing is added to the queue
             # anymore the poison pills will be the last elements taken from the queue
             self.tasks.put_nowait(None)
 
-    def add_task(self, session):
-        if self._stayalive:
-            self.tasks.put(session)
+    def add_task(self, session, block=True):
+        """queue a session. returns False if the pool is shut down or block is False and the queue is full"""
+        if not self._stayalive:
+            return False
+        try:
+            self.tasks.put(session, block)
+        except queue.Full:
+            return False
+        return True
+
+    def queue_depth(self):
+        """number of sessions waiting for a worker process (0 if the platform can not tell)"""
+        try:
+            return self.tasks.qsize()
+        except NotImplementedError:
+            return 0
+
+    def queue_wait(self):
+        """the wait time of sessions passed to other processes is not known"""
+        return 0.0
 
     def _create_worker(self):
         self._child_id_counter +=1
         worker_name = "Worker-%s"%self._child_id_counter
         self.logger.debug("Creating worker: "+worker_name)
-        worker = multiprocessing.Process(target=postomaat_process_worker, name=worker_name, args=(self.tasks, self.config, self.shared_state, self.child_to_server_messages,self._logQueue))
+        stopevent = multiprocessing.Event()
+        self.stopevents[worker_name] = stopevent
+        workerstate = WorkerStateWrapper(self.statetable, self._allocate_slot(worker_name))
+        if self.prefork:
+            worker = multiprocessing.Process(target=postomaat_prefork_worker, name=worker_name, args=(self.listeners, stopevent, self.config, workerstate, self.child_to_server_messages, self._logQueue))
+        else:
+            worker = multiprocessing.Process(target=postomaat_process_worker, name=worker_name, args=(self.tasks, stopevent, self.config, workerstate, self.child_to_server_messages,self._logQueue))
         return worker
 
     def start(self):
-        for i in range(self.numprocs):
-            worker = self._create_worker()
-            worker.start()
-            self.workers.append(worker)
+        # prefork workers are started once the listening sockets are known
+        if not self.prefork:
+            self._start_workers()
 
         # Start the child-to-parent message listener
         self.message_listener.start()
+        self.supervisor.start()
+
+    def _start_workers(self, num=None):
+        if num is None:
+            num = self.numprocs
+        newworkers = []
+        for i in range(num):
+            worker = self._create_worker()
+            worker.start()
+            newworkers.append(worker)
+        self.workers.extend(newworkers)
+        self.spawned += num
+        return newworkers
+
+    def _supervise(self):
+        """replace workers which ended or crashed and adapt the number of workers to the load"""
+        while self._stayalive:
+            time.sleep(1)
+            try:
+                with self.workerlock:
+                    if not self._stayalive:
+                        break
+                    self._reap_workers()
+                    self._scale()
+            except Exception as e:
+                self.logger.error('Process pool supervisor failed: %s' % str(e))
+
+    def _reap_workers(self):
+        for worker in list(self.workers):
+            if worker.is_alive():
+                continue
+            self.workers.remove(worker)
+            self.stopevents.pop(worker.name, None)
+            state = self.get_state(worker)
+            self._release_slot(worker)
+            if worker.exitcode != 0 or state == 'crashed':
+                self.crashed += 1
+                if time.time() - self.lastcrash > 60:
+                    self.crashes = 0
+                self.crashes += 1
+                self.lastcrash = time.time()
+                delay = min(self.respawn_backoff * 2 ** (self.crashes - 1), 60)
+                self.nextspawn = time.time() + delay
+                self.logger.warning('Worker %s crashed (exit code %s), respawning in %.1fs' % (worker.name, worker.exitcode, delay))
+            else:
+                self.exited += 1
+                self.logger.debug('Worker %s ended' % worker.name)
+
+    def _scale(self):
+        if self.prefork and not self.listeners:
+            return
+        now = time.time()
+        if now < self.nextspawn:
+            return
+        numworkers = len(self.workers)
+        if numworkers < self.minprocs:
+            self._start_workers(self.minprocs - numworkers)
+            return
+
+        idle = [worker for worker in self.workers if self.get_state(worker) in IDLE_STATES]
+        waiting = self.queue_depth()
+        if not idle or waiting > len(idle):
+            self.lastbusy = now
+            if numworkers < self.maxprocs:
+                num = min(max(waiting - len(idle), 1), self.maxprocs - numworkers)
+                self.logger.debug('%s sessions waiting, %s idle workers: adding %s workers' % (waiting, len(idle), num))
+                self._start_workers(num)
+        elif numworkers > self.minprocs and now - self.lastbusy > self.idletimeout:
+            self.logger.debug('Stopping idle worker, %s workers left' % (numworkers - 1))
+            self.lastbusy = now
+            self.stopevents[idle[0].name].set()
+
+    def broadcast(self, command):
+        """let all worker processes run a control command (see control.run_local_command) the next time they
+        are idle or finished a session, at most one second later. returns the number of workers"""
+        self.statetable.post_command(command)
+        return len(self.workers)
+
+    def stats(self):
+        """number of workers and what the supervisor did"""
+        return {
+            'workers': len(self.workers),
+            'minprocs': self.minprocs,
+            'maxprocs': self.maxprocs,
+            'queue_depth': self.queue_depth(),
+            'spawned': self.spawned,
+            'crashed': self.crashed,
+            'exited': self.exited,
+            'workerstates': self.worker_states(),
+        }
+
+    def set_listeners(self, servers):
+        """prefork mode: let the worker processes accept connections on the listening sockets of servers.
+        the workers inherit the sockets when they are started, they are replaced if the ports change"""
+        if not self.prefork or not self._stayalive:
+            return
+        listeners = sorted([(server.port, server._socket) for server in servers], key=lambda listener: listener[0])
+        if [port for port, _ in listeners] == [port for port, _ in self.listeners] and self.workers:
+            return
+        self.logger.info("Starting %s worker processes accepting on ports %s" % (self.numprocs, ', '.join(str(port) for port, _ in listeners)))
+        with self.workerlock:
+            oldworkers = self.workers
+            self.listeners = listeners
+            self.workers = []
+            if listeners:
+                self._start_workers()
+        self._stop_workers(oldworkers)
+
+    def _stop_workers(self, workers, timeout=120):
+        """tell workers to end after their current session and wait up to timeout seconds for them, workers still
+        running then are terminated. the workers must already be removed from self.workers, this is not called
+        with workerlock held"""
+        for worker in workers:
+            if worker.name in self.stopevents:
+                self.stopevents[worker.name].set()
+        endtime = time.time() + timeout
+        for worker in workers:
+            worker.join(max(endtime - time.time(), 0))
+            if worker.is_alive():
+                self.logger.warning('Worker %s did not end within %ss, terminating it' % (worker.name, timeout))
+                worker.terminate()
+                worker.join(5)
+            if worker.is_alive() and hasattr(worker, 'kill'):
+                worker.kill()
+                worker.join(1)
+            self.stopevents.pop(worker.name, None)
+            self._release_slot(worker)
+
+    def _wait_ready(self, workers, timeout):
+        """wait until workers loaded their plugins. returns False if one of them failed or timeout passed"""
+        endtime = time.time() + timeout
+        while time.time() < endtime:
+            pending = False
+            for worker in workers:
+                state = self.get_state(worker)
+                if not worker.is_alive() or state in FAILED_STATES:
+                    self.logger.error('New worker %s failed to start: %s' % (worker.name, state))
+                    return False
+                if state in LOADING_STATES:
+                    pending = True
+            if not pending:
+                return True
+            time.sleep(0.1)
+        self.logger.error('New workers did not finish loading their plugins within %ss' % timeout)
+        return False
+
+    def config_changed(self, config):
+        """returns True if config differs from the configuration the workers were started with"""
+        return config_snapshot(config) != self.configsnapshot
+
+    def rolling_reload(self, config, batchsize=2, timeout=60):
+        """replace the workers by workers using config, batchsize at a time. a batch of old workers is stopped only
+        once its replacements finished loading their plugins, so the pool keeps its capacity and no more than
+        batchsize additional processes run. returns False if replacements failed, the remaining old workers are
+        kept in this case. workerlock is only held to change the list of workers, the supervisor keeps reaping and
+        scaling while the reload waits for workers"""
+        with self.workerlock:
+            self.config = config
+            self.configsnapshot = config_snapshot(config)
+            if self.prefork and not self.listeners:
+                return True
+            oldworkers = list(self.workers)
+        self.logger.info('Rolling reload of %s worker processes, %s at a time' % (len(oldworkers), batchsize))
+        while oldworkers:
+            batch, oldworkers = oldworkers[:batchsize], oldworkers[batchsize:]
+            with self.workerlock:
+                # workers the supervisor stopped or reaped meanwhile need no replacement
+                batch = [worker for worker in batch if worker in self.workers]
+                if not batch:
+                    continue
+                newworkers = self._start_workers(len(batch))
+            if not self._wait_ready(newworkers, timeout):
+                with self.workerlock:
+                    for worker in newworkers:
+                        if worker in self.workers:
+                            self.workers.remove(worker)
+                self._stop_workers(newworkers)
+                self.logger.error('Rolling reload aborted, %s workers keep running with the old configuration' % (len(batch) + len(oldworkers)))
+                return False
+            with self.workerlock:
+                for worker in batch:
+                    if worker in self.workers:
+                        self.workers.remove(worker)
+            self._stop_workers(batch)
+        self.logger.info('Rolling reload complete')
+        return True
 
     def shutdown(self):
         # setting stayalive equal to False
         # will send poison pills to all processors
         self.logger.debug("Shutdown procpool -> send poison pills")
-        self.stayalive = False
+        with self.workerlock:
+            self.stayalive = False
+
+        if self.prefork:
+            self.logger.debug("Stop prefork workers")
+            with self.workerlock:
+                oldworkers = self.workers
+                self.workers = []
+            self._stop_workers(oldworkers)
+            self._shutdown_listener()
+            return
 
         # add another poison pill for the ProcManager itself removing tasks...
         self.tasks.put_nowait(None)
@@ -120,6 +433,9 @@ class ProcManager(object):
         for worker in self.workers:
             worker.join(120)
 
+        self._shutdown_listener()
+
+    def _shutdown_listener(self):
         self.logger.debug("Join message listener")
         self.message_listener.stayalive = False
         # put poison pill into queue otherwise the process will not stop
@@ -130,8 +446,7 @@ class ProcManager(object):
         self.tasks.close()
 
         self.child_to_server_messages.close()
-        self.logger.debug("Shutdown multiprocessing manager")
-        self.manager.shutdown()
+        Statskeeper().unregister_counter_source('procpool')
         self.logger.debug("done...")
 
 class MessageListener(threading.Thread):
@@ -156,14 +471,61 @@ class MessageListener(threading.Thread):
                     self.statskeeper.increase_counter_values(delta)
                 except:
                     print(traceback.format_exc())
-
-
-def postomaat_process_worker(queue, config, shared_state,child_to_server_messages,logQueue):
-
-    signal.signal(signal.SIGHUP, signal.SIG_IGN)
-    logging.basicConfig(level=logging.DEBUG)
-    workerstate = WorkerStateWrapper(shared_state,'loading configuration')
-    logger = logging.getLogger('postomaat.process')
+            elif event_type == 'counters': # batch of counters not kept in shared memory, see CounterExporter
+                self.statskeeper.add_counters(message['counters'])
+                histograms = message.get('histograms')
+                if histograms:
+                    self.statskeeper.add_histograms(dict((name, Histogram.from_message(histogram))
+                                                         for name, histogram in histograms.items()))
+            elif event_type == 'slowrequest': # see postomaat.trace.set_sink
+                postomaat.trace.store_slow_request(message['entry'])
+
+
+class CounterExporter(object):
+    """Publishes the statistics counters of a worker process to the parent: the scalar counters are written
+    to the worker's slot in the state table, the others (per plugin, per action, ...) and the changes of the
+    latency histograms are sent in batches through the message queue, at most every interval seconds"""
+
+    def __init__(self, workerstate, messages, interval=1):
+        self.workerstate = workerstate
+        self.messages = messages
+        self.interval = interval
+        self.sent = {}
+        self.senthistograms = {}
+        self.lastsent = 0
+
+    def flush(self, force=False):
+        counters = Statskeeper().local_counters()
+        self.workerstate.set_counters(counters)
+        now = time.time()
+        if not force and now - self.lastsent < self.interval:
+            return
+        self.lastsent = now
+        delta = {}
+        for name, value in counters.items():
+            if name in SCALAR_COUNTERS:
+                continue
+            diff = value - self.sent.get(name, 0)
+            if diff:
+                delta[name] = diff
+                self.sent[name] = value
+        histograms = {}
+        for name, histogram in Statskeeper().get_histograms().items():
+            sent = self.senthistograms.get(name)
+            if sent is not None:
+                if histogram.count == sent.count:
+                    continue
+                histograms[name] = histogram.diff(sent).as_message()
+            else:
+                histograms[name] = histogram.as_message()
+            self.senthistograms[name] = histogram
+        if delta or histograms:
+            self.messages.put(dict(event_type='counters', counters=delta, histograms=histograms))
+
+
+def _init_worker(config, child_to_server_messages, logQueue):
+    """setup a worker process: returns a controller with the plugins loaded"""
+    Statskeeper().reset_counters()
 
     # Setup address compliance checker
     # -> Due to default linux forking behavior this should already
@@ -177,19 +539,74 @@ def postomaat_process_worker(queue, config, shared_state,child_to_server_message
 
     # load config and plugins
     controller = postomaat.core.MainController(config,logQueue)
-    controller.load_plugins()
+    controller.pluginsloaded = controller.load_plugins()
 
-    plugins = controller.plugins
+    # SIGUSR1 to a worker profiles only this worker, the parent's handler would broadcast
+    postomaat.profiler.configure(config)
+    signal.signal(signal.SIGUSR1, _sigusr1)
+
+    # slow requests are kept by the parent for the control command 'slow'
+    postomaat.trace.configure(config)
+    postomaat.trace.set_sink(lambda entry: child_to_server_messages.put(dict(event_type='slowrequest', entry=entry)))
+
+    return controller
+
+
+def _sigusr1(signum, frame):
+    postomaat.profiler.start()
+
+
+def _run_posted_commands(workerstate, plugins):
+    """run the control commands broadcast by the parent since the last call"""
+    for command in workerstate.poll_commands():
+        try:
+            run_local_command(command, plugins)
+        except Exception as e:
+            logging.getLogger('postomaat.process').error('Control command %s failed: %s' % (command, str(e)))
+
+
+def config_snapshot(config):
+    """returns the content of config as a dict section -> dict of options"""
+    if config is None:
+        return None
+    return dict((section, dict(config.items(section))) for section in config.sections())
 
-    # forward statistics counters to parent process
-    stats = Statskeeper()
-    stats.stat_listener_callback.append(lambda event: child_to_server_messages.put(event.as_message()))
+
+def postomaat_process_worker(taskqueue, stopevent, config, workerstate, child_to_server_messages, logQueue):
+
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    logging.basicConfig(level=logging.DEBUG)
+    workerstate.attach()
+    workerstate.workerstate = 'loading configuration'
+    parentpid = os.getppid()
+    logger = logging.getLogger('postomaat.process')
+
+    controller = _init_worker(config, child_to_server_messages, logQueue)
+    exporter = CounterExporter(workerstate, child_to_server_messages)
+    # a worker whose plugins failed to load keeps serving, but a rolling reload does not replace working ones by it
+    idlestate = 'waiting for task' if controller.pluginsloaded else 'plugin load failed'
+    plugins = controller.plugins
+    limits = _get_recycle_limits(config)
+    requests = 0
 
     try:
         while True:
-            workerstate.workerstate = 'waiting for task'
-            logger.debug("%s: Child process waiting for task" % logtools.createPIDinfo())
-            task = queue.get()
+            if stopevent.is_set():
+                logger.debug("%s: Child process stopped - shut down" % logtools.createPIDinfo())
+                workerstate.workerstate = 'ended'
+                return
+            if workerstate.workerstate != idlestate:
+                workerstate.workerstate = idlestate
+                logger.debug("%s: Child process waiting for task" % logtools.createPIDinfo())
+            try:
+                task = taskqueue.get(True, 1)
+            except queue.Empty:
+                exporter.flush()
+                _run_posted_commands(workerstate, plugins)
+                if os.getppid() != parentpid:
+                    logger.error("%s: Parent process is gone - shut down" % logtools.createPIDinfo())
+                    return
+                continue
             if task is None: # poison pill
                 logger.debug("%s: Child process received poison pill - shut down" % logtools.createPIDinfo())
                 try:
@@ -203,9 +620,159 @@ def postomaat_process_worker(queue, config, shared_state,child_to_server_message
             workerstate.workerstate = 'starting scan session'
 
             # recreate socket
+            task, acceptedtime, queuedtime = task
             sock = pickle.loads(task)
             handler = SessionHandler(sock, config, plugins)
+            handler.acceptedtime = acceptedtime
+            handler.queuedtime = queuedtime
             handler.handlesession(workerstate)
+            exporter.flush()
+            _run_posted_commands(workerstate, plugins)
+
+            requests += handler.requestcount
+            workerstate.add_requests(handler.requestcount)
+            reason = _recycle_reason(limits, requests)
+            if reason is not None:
+                # the supervisor in the parent starts a new worker
+                logger.info("%s: Child process recycled: %s" % (logtools.createPIDinfo(), reason))
+                workerstate.workerstate = 'ended'
+                return
+    except KeyboardInterrupt:
+        workerstate.workerstate = 'ended'
+    except:
+        trb = traceback.format_exc()
+        logger.error("Exception in child process: %s"%trb)
+        print(trb)
+        workerstate.workerstate = 'crashed'
+    finally:
+        try:
+            exporter.flush(force=True)
+        except Exception:
+            pass
+        controller.shutdown()
+
+
+def get_rss():
+    """returns the resident set size of the current process in bytes, None if unknown"""
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except Exception:
+        pass
+    if resource is not None:
+        # peak rss, in kilobytes on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return None
+
+
+def _get_recycle_limits(config):
+    """returns (max requests, max rss in bytes) after which a worker process is replaced, 0 means no limit"""
+    try:
+        maxrequests = config.getint('performance', 'max_requests_per_child')
+    except Exception:
+        maxrequests = 0
+    try:
+        maxrss = int(config.getfloat('performance', 'max_rss_per_child') * 1024 * 1024)
+    except Exception:
+        maxrss = 0
+    return maxrequests, maxrss
+
+
+def _recycle_reason(limits, requests):
+    """returns why the worker process should be replaced or None"""
+    maxrequests, maxrss = limits
+    if maxrequests and requests >= maxrequests:
+        return '%s requests handled' % requests
+    if maxrss:
+        rss = get_rss()
+        if rss is not None and rss > maxrss:
+            return 'rss %.1fMB' % (rss / 1024.0 / 1024.0)
+    return None
+
+
+def _get_port_plugins(controller, config, ports):
+    """returns a dict port -> plugins as configured in incomingport (port:plugin,plugin,...)"""
+    portplugins = {}
+    for portconfig in config.get('main', 'incomingport').split():
+        if ':' not in portconfig:
+            continue
+        port, pluginlist = portconfig.split(':')
+        port = int(port.strip())
+        if port in ports:
+            plugins, ok = controller._load_all(pluginlist)
+            if ok:
+                portplugins[port] = plugins
+    return portplugins
+
+
+def postomaat_prefork_worker(listeners, stopevent, config, workerstate, child_to_server_messages, logQueue):
+    """accept connections on the listening sockets inherited from the parent until stopevent is set"""
+
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    logging.basicConfig(level=logging.DEBUG)
+    workerstate.attach()
+    workerstate.workerstate = 'loading configuration'
+    parentpid = os.getppid()
+    logger = logging.getLogger('postomaat.process')
+
+    controller = _init_worker(config, child_to_server_messages, logQueue)
+    exporter = CounterExporter(workerstate, child_to_server_messages)
+    idlestate = 'waiting for connection' if controller.pluginsloaded else 'plugin load failed'
+    portplugins = _get_port_plugins(controller, config, [port for port, _ in listeners])
+    allplugins = list(controller.plugins)
+    for plugins in portplugins.values():
+        allplugins.extend(plugins)
+
+    limits = _get_recycle_limits(config)
+    requests = 0
+    reason = None
+
+    sockets = {}
+    for port, listener in listeners:
+        # all workers wait for the same sockets, those losing the race must not block in accept
+        listener.setblocking(False)
+        sockets[listener.fileno()] = (listener, portplugins.get(port, controller.plugins))
+
+    try:
+        while reason is None and not stopevent.is_set():
+            if workerstate.workerstate != idlestate:
+                workerstate.workerstate = idlestate
+            try:
+                readable, _, _ = select.select(list(sockets.keys()), [], [], 1)
+            except (select.error, socket.error, OSError) as e:
+                if e.args and e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not readable:
+                exporter.flush()
+                _run_posted_commands(workerstate, allplugins)
+            if not readable and os.getppid() != parentpid:
+                logger.error("%s: Parent process is gone - shut down" % logtools.createPIDinfo())
+                break
+            for fileno in readable:
+                listener, plugins = sockets[fileno]
+                try:
+                    sock, addr = listener.accept()
+                except socket.error as e:
+                    if e.args and e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR, errno.ECONNABORTED):
+                        continue # another worker was faster
+                    raise
+                sock.setblocking(True)
+                workerstate.workerstate = 'starting scan session'
+                handler = SessionHandler(sock, config, plugins)
+                handler.handlesession(workerstate)
+                exporter.flush()
+                _run_posted_commands(workerstate, allplugins)
+                requests += handler.requestcount
+                workerstate.add_requests(handler.requestcount)
+                reason = _recycle_reason(limits, requests)
+                if reason is not None:
+                    break
+        if reason is not None:
+            # the supervisor in the parent starts a new worker
+            logger.info("%s: Child process recycled: %s" % (logtools.createPIDinfo(), reason))
+        logger.debug("%s: Child process stopped - shut down" % logtools.createPIDinfo())
+        workerstate.workerstate = 'ended'
     except KeyboardInterrupt:
         workerstate.workerstate = 'ended'
     except:
@@ -214,24 +781,181 @@ def postomaat_process_worker(queue, config, shared_state,child_to_server_message
         print(trb)
         workerstate.workerstate = 'crashed'
     finally:
+        try:
+            exporter.flush(force=True)
+        except Exception:
+            pass
         controller.shutdown()
 
 
+WORKER_STATES = ('unused', 'created', 'loading configuration', 'plugin load failed', 'waiting for task', 'waiting for connection',
+                 'starting scan session', 'ended', 'crashed', 'unknown')
+WAITING_STATES = ('waiting for task', 'waiting for connection')
+
+
+class WorkerSlot(ctypes.Structure):
+    _fields_ = [
+        ('pid', ctypes.c_int),
+        ('state', ctypes.c_int), # index in WORKER_STATES
+        ('since', ctypes.c_double), # time of the last state change
+        ('lastbusy', ctypes.c_double), # time the worker last started a session
+        ('lastidle', ctypes.c_double), # time the worker last started waiting
+        ('requests', ctypes.c_long), # requests handled
+        ('counters', ctypes.c_double * len(SCALAR_COUNTERS)), # statistics counters, see CounterExporter
+        ('threadinfo', ctypes.c_char * 160), # what the worker is doing, see scansession.format_threadinfo
+    ]
+
+
+class WorkerStateTable(object):
+    """Fixed size table in shared memory with one slot per worker process. The parent assigns the slots,
+    each worker writes only its own slot, without locking or IPC. Readers may see a slot in the middle
+    of an update, which is fine for states and statistics.
+
+    The table also holds the last control commands broadcast to the workers (see ProcManager.broadcast)
+    in a ring with a sequence number, workers run those posted since they last looked."""
+
+    COMMANDS = 16 # commands kept in the ring
+    COMMANDSIZE = 256
+
+    def __init__(self, size):
+        self.slots = multiprocessing.sharedctypes.RawArray(WorkerSlot, size)
+        self.commands = multiprocessing.sharedctypes.RawArray(ctypes.c_char * self.COMMANDSIZE, self.COMMANDS)
+        self.commandseq = multiprocessing.sharedctypes.RawValue(ctypes.c_long, 0)
+        self.commandlock = multiprocessing.Lock()
+
+    def __len__(self):
+        return len(self.slots)
+
+    def reset(self, slot, state='created'):
+        entry = self.slots[slot]
+        entry.pid = 0
+        entry.requests = 0
+        entry.lastbusy = 0
+        entry.lastidle = 0
+        entry.since = time.time()
+        for index in range(len(SCALAR_COUNTERS)):
+            entry.counters[index] = 0
+        entry.threadinfo = b''
+        entry.state = WORKER_STATES.index(state)
+
+    def clear(self, slot):
+        self.slots[slot].state = 0
+
+    def get_state(self, slot):
+        code = self.slots[slot].state
+        if 0 <= code < len(WORKER_STATES):
+            return WORKER_STATES[code]
+        return 'unknown'
+
+    def set_state(self, slot, state):
+        try:
+            code = WORKER_STATES.index(state)
+        except ValueError:
+            code = WORKER_STATES.index('unknown')
+        entry = self.slots[slot]
+        now = time.time()
+        entry.since = now
+        if state in WAITING_STATES:
+            entry.lastidle = now
+        elif state == 'starting scan session':
+            entry.lastbusy = now
+        entry.state = code
+
+    def set_counters(self, slot, counters):
+        entry = self.slots[slot]
+        for index, name in enumerate(SCALAR_COUNTERS):
+            entry.counters[index] = counters.get(name, 0)
+
+    def get_counters(self, slot):
+        """returns the scalar statistics counters of slot as dict"""
+        entry = self.slots[slot]
+        return dict((name, entry.counters[index]) for index, name in enumerate(SCALAR_COUNTERS) if entry.counters[index])
+
+    def read(self, slot):
+        """returns the content of slot as dict"""
+        entry = self.slots[slot]
+        return dict(pid=entry.pid, state=self.get_state(slot), since=entry.since, lastbusy=entry.lastbusy,
+                    lastidle=entry.lastidle, requests=entry.requests,
+                    threadinfo=entry.threadinfo.decode('utf-8', 'replace'))
+
+    def set_threadinfo(self, slot, threadinfo):
+        if not isinstance(threadinfo, bytes):
+            threadinfo = threadinfo.encode('utf-8', 'replace')
+        self.slots[slot].threadinfo = threadinfo[:159]
+
+    def post_command(self, command):
+        """store command for the workers and increase the sequence number"""
+        command = command.encode('utf-8')
+        if len(command) >= self.COMMANDSIZE:
+            raise ValueError('command too long')
+        with self.commandlock:
+            seq = self.commandseq.value + 1
+            self.commands[seq % self.COMMANDS].value = command
+            self.commandseq.value = seq
+
+    def read_commands(self, since):
+        """returns (sequence number, commands posted after sequence number since). commands overwritten in
+        the ring before they were read are lost"""
+        with self.commandlock:
+            seq = self.commandseq.value
+            first = max(since + 1, seq - self.COMMANDS + 1)
+            return seq, [self.commands[index % self.COMMANDS].value.decode('utf-8') for index in range(first, seq + 1)]
+
+    def read_all(self):
+        """returns the content of all used slots as dicts, with the slot number"""
+        result = []
+        for slot in range(len(self.slots)):
+            if self.slots[slot].state == 0:
+                continue
+            info = self.read(slot)
+            info['slot'] = slot
+            result.append(info)
+        return result
+
+
 class WorkerStateWrapper(object):
-    def __init__(self, shared_state_dict, initial_state='created', process=None):
+    """the state of a worker process in its slot of the WorkerStateTable"""
+    def __init__(self, statetable, slot, initial_state='created'):
         self._state = initial_state
-        self.shared_state_dict = shared_state_dict
-        self.process = process
-        if not process:
-            self.process = multiprocessing.current_process()
+        self.statetable = statetable
+        self.slot = slot
+        # commands posted before the worker was started are not run
+        self.commandseq = statetable.commandseq.value
 
-        self._publish_state()
+    def attach(self):
+        """called in the worker process"""
+        if self.slot >= 0:
+            self.statetable.slots[self.slot].pid = os.getpid()
 
     def _publish_state(self):
-        try:
-            self.shared_state_dict[self.process.name] = self._state
-        except EOFError:
-            pass
+        if self.slot >= 0:
+            self.statetable.set_state(self.slot, self._state)
+
+    def set_counters(self, counters):
+        if self.slot >= 0:
+            self.statetable.set_counters(self.slot, counters)
+
+    def poll_commands(self):
+        """returns the control commands posted since the last call"""
+        if self.statetable.commandseq.value == self.commandseq:
+            return []
+        self.commandseq, commands = self.statetable.read_commands(self.commandseq)
+        return commands
+
+    @property
+    def threadinfo(self):
+        if self.slot >= 0:
+            return self.statetable.read(self.slot)['threadinfo']
+        return ''
+
+    @threadinfo.setter
+    def threadinfo(self, value):
+        if self.slot >= 0:
+            self.statetable.set_threadinfo(self.slot, format_threadinfo(value))
+
+    def add_requests(self, count):
+        if self.slot >= 0:
+            self.statetable.slots[self.slot].requests += count
 
     @property
     def workerstate(self):
@@ -0,0 +1,148 @@
+# -*- coding: UTF-8 -*-
+#   Copyright 2012-2018 Oli Schacher
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# Sampling profiler: while switched on (SIGUSR1 or the 'profile' control command), a thread takes the stacks of
+# all other threads of the process every few milliseconds. The stacks are written in the collapsed format of
+# flamegraph.pl, the samples per plugin are taken from the plugin argument of the session handler frames.
+# Nothing is recorded and nothing is running while the profiler is off.
+
+import sys
+import os
+import time
+import threading
+import logging
+from postomaat.stats import plugin_name
+
+# frames of the session handler whose local 'plugin' is the plugin the thread is running
+PLUGIN_FRAMES = ('examine_with_deadline', 'examine_plugin', '_examine_plugin_async')
+
+# frames of threads working on a request. samples of threads without one of them (idle pool threads waiting
+# for a session, accept, stats and control threads) are left out of the plugin shares
+SESSION_FRAMES = ('handlerequest', 'handlerequest_async', 'examine_with_deadline')
+
+# defaults, see configure()
+SETTINGS = dict(directory='/var/lib/postomaat', duration=30.0, interval=0.01)
+
+_profiler = None
+_lock = threading.Lock()
+
+
+def configure(config):
+    """take the profiler settings from the [performance] section of config"""
+    for option, key in (('profile_dir', 'directory'), ('profile_duration', 'duration'), ('profile_interval', 'interval')):
+        try:
+            value = config.get('performance', option).strip()
+        except Exception:
+            continue
+        if not value:
+            continue
+        SETTINGS[key] = value if key == 'directory' else float(value)
+
+
+def start(duration=None):
+    """start sampling the threads of this process for duration seconds (default: profile_duration).
+    returns the name of the collapsed stack file written at the end, None if the profiler is already running"""
+    global _profiler
+    if duration is None:
+        duration = SETTINGS['duration']
+    with _lock:
+        if _profiler is not None and _profiler.is_alive():
+            return None
+        _profiler = SamplingProfiler(float(duration), SETTINGS['interval'], SETTINGS['directory'])
+        _profiler.start()
+        return _profiler.filename
+
+
+def is_running():
+    return _profiler is not None and _profiler.is_alive()
+
+
+def create_file(filename):
+    """open a new file readable by the owner only for writing. fails if the file exists or is a symlink,
+    so a file planted by another user is never written to"""
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_NOFOLLOW', 0), 0o600)
+    return os.fdopen(fd, 'w')
+
+
+def frame_label(code):
+    return '%s (%s:%s)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class SamplingProfiler(threading.Thread):
+    """samples the stacks of all other threads every interval seconds for duration seconds, then writes
+    <directory>/postomaat-profile-<pid>-<time>.collapsed (stack count, one line per stack, root first)
+    and .plugins (samples per plugin and their share of the samples taken while handling requests, '-' for request
+    handling outside of plugins)"""
+
+    def __init__(self, duration, interval, directory):
+        threading.Thread.__init__(self, name='Sampling profiler')
+        self.daemon = True
+        self.duration = duration
+        self.interval = interval
+        self.logger = logging.getLogger('%s.profiler' % __package__)
+        self.filename = os.path.join(directory, 'postomaat-profile-%s-%s.collapsed' % (
+            os.getpid(), time.strftime('%Y%m%d-%H%M%S')))
+        self.stacks = {}
+        self.plugins = {}
+        self.idle = 0
+        self.samples = 0
+
+    def run(self):
+        self.logger.info('Profiling for %ss, writing to %s' % (self.duration, self.filename))
+        own = threading.current_thread().ident
+        deadline = time.time() + self.duration
+        while time.time() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self.sample(frame)
+            self.samples += 1
+            time.sleep(self.interval)
+        try:
+            self.write()
+        except Exception as e:
+            self.logger.error('Could not write profile %s: %s' % (self.filename, str(e)))
+
+    def sample(self, frame):
+        labels = []
+        plugin = None
+        busy = False
+        while frame is not None:
+            code = frame.f_code
+            if plugin is None and code.co_name in PLUGIN_FRAMES:
+                plugin = frame.f_locals.get('plugin')
+            if code.co_name in SESSION_FRAMES:
+                busy = True
+            labels.append(frame_label(code))
+            frame = frame.f_back
+        labels.reverse()
+        stack = ';'.join(labels)
+        self.stacks[stack] = self.stacks.get(stack, 0) + 1
+        if not busy:
+            self.idle += 1
+            return
+        plugin = '-' if plugin is None else plugin_name(plugin)
+        self.plugins[plugin] = self.plugins.get(plugin, 0) + 1
+
+    def write(self):
+        with create_file(self.filename) as fp:
+            for stack, count in sorted(self.stacks.items()):
+                fp.write('%s %s\n' % (stack, count))
+        total = sum(self.plugins.values())
+        with create_file(os.path.splitext(self.filename)[0] + '.plugins') as fp:
+            fp.write('# %s of %s thread samples handling requests, shares are of those\n' % (total, total + self.idle))
+            for plugin, count in sorted(self.plugins.items(), key=lambda item: -item[1]):
+                fp.write('%s %s %.1f%%\n' % (plugin, count, 100.0 * count / total))
+        self.logger.info('Profile written to %s (%s samples)' % (self.filename, self.samples))
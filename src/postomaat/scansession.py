@@ -13,17 +13,41 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from postomaat.shared import DUNNO, Suspect, DEFER, REJECT, DISCARD
+from postomaat.shared import DUNNO, Suspect, DEFER, REJECT, DISCARD, VerdictCache, get_verdictcache, get_transactionmemo
+from postomaat.deadline import DeadlineExceeded, deadline_scope
+from postomaat.stats import Statskeeper, timer
+from postomaat.trace import new_trace, finish as finish_trace, trace_scope, span
 import logging
 import sys
 import traceback
 import time
 import socket
+import threading
+try:
+    import concurrent.futures
+    HAVE_FUTURES = True
+except ImportError:
+    HAVE_FUTURES = False
+
+
+# keepalive_timeout of the asyncio backend if the option is empty
+DEFAULT_ASYNC_KEEPALIVE_TIMEOUT = 10.0
+
+PLUGINEXECUTOR = None
+_plugin_executor_lock = threading.Lock()
+
+def get_plugin_executor(maxworkers):
+    """returns the thread pool running concurrent plugins, shared by all sessions of this process"""
+    global PLUGINEXECUTOR
+    with _plugin_executor_lock:
+        if PLUGINEXECUTOR is None:
+            PLUGINEXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=maxworkers)
+        return PLUGINEXECUTOR
 
 
 class SessionHandler(object):
 
-    """thread handling one message"""
+    """handles all requests of one incoming connection"""
 
     def __init__(self, incomingsocket, config, plugins):
         self.incomingsocket = incomingsocket
@@ -33,36 +57,128 @@ class SessionHandler(object):
         self.config = config
         self.plugins = plugins
         self.workerthread = None
+        self.verdictcache = get_verdictcache()
+        self.transactionmemo = get_transactionmemo()
+        self._verdictcache_ttls = {}
+        self._plugin_timeouts = {}
+        self.requestcount = 0 # requests handled on this connection
+        self.acceptedtime = time.time()
+        self.queuedtime = None # set by the pool the session waits in
+        self.sessionstart = None
+        self.trace = None # trace of the current request, see postomaat.trace
     
-    def set_threadinfo(self, status):
+    def set_threadinfo(self, status, suspect=None, plugin=None):
+        """tell the worker what the session is doing. the text is formatted by format_threadinfo when
+        it is read, worker processes format it to keep it in shared memory"""
         if self.workerthread is not None:
-            self.workerthread.threadinfo = status
+            self.workerthread.threadinfo = (status, suspect, plugin)
     
+    def get_keepalive_timeout(self):
+        """seconds to wait for the next request on a persistent connection. 0 disables persistent connections.
+        by default only the asyncio backend keeps connections: with the thread and process backends an idle
+        connection blocks a worker, new connections would queue behind idle ones until postfix times out"""
+        try:
+            value = self.config.get('performance', 'keepalive_timeout').strip()
+            if value:
+                return float(value)
+            if self.config.get('performance', 'backend') == 'asyncio':
+                return DEFAULT_ASYNC_KEEPALIVE_TIMEOUT
+        except Exception:
+            pass
+        return 0
+
     def handlesession(self, workerthread=None):
+        """handle requests on the incoming connection until the client closes it or the keepalive timeout expires"""
         self.workerthread = workerthread
+        self.sessionstart = time.time()
         sess = None
         try:
-            self.set_threadinfo('receiving message')
-            sess = PolicydSession(self.incomingsocket, self. config)
-            success = sess. getrequest()
-            if not success:
-                self.logger.error('incoming request did not finish')
+            sess = PolicydSession(self.incomingsocket, self.config)
+            keepalive = self.get_keepalive_timeout()
+            if keepalive > 0:
+                sess.settimeout(keepalive)
+
+            while True:
+                self.set_threadinfo('receiving message')
+                try:
+                    success = sess.getrequest()
+                except socket.timeout:
+                    self.logger.debug('Connection idle for %ss - closing' % keepalive)
+                    break
+                if not success:
+                    if not sess.eof:
+                        self.logger.error('incoming request did not finish')
+                    break
+
+                self.action = DUNNO
+                self.arg = ""
+                self.requestcount += 1
+                self.trace = self.start_trace(sess.readstart, sess.readend)
+                with trace_scope(self.trace):
+                    self.handlerequest(sess)
+                    with span('write'):
+                        sess.sendanswer(self.action, self.arg)
+                self.finish_trace()
+                if keepalive <= 0:
+                    break
+
+        except KeyboardInterrupt:
+            sys.exit(0)
+        except Exception as e:
+            self.logger.exception(e)
+        finally:
+            if sess is not None:
                 sess.closeconn()
+            self.logger.debug('Session finished')
+
+    def start_trace(self, readstart, readend):
+        """returns the Trace of the request read from readstart to readend (timer()), None if tracing is disabled.
+        the trace of the first request of a connection includes its accept and queue wait"""
+        first = self.requestcount == 1
+        offset = timer() - time.time()
+        trace = new_trace(self.acceptedtime + offset if first else readstart)
+        if trace is None:
+            return None
+        if first:
+            dispatched = self.queuedtime if self.queuedtime is not None else self.sessionstart
+            trace.add('accept', self.acceptedtime + offset, dispatched + offset)
+            if self.queuedtime is not None:
+                trace.add('queue', self.queuedtime + offset, self.sessionstart + offset)
+        trace.add('read', readstart, readend)
+        return trace
 
+    def finish_trace(self):
+        """end the trace of the current request, slow requests are logged (see postomaat.trace)"""
+        if self.trace is not None:
+            finish_trace(self.trace)
+            self.trace = None
+
+    def set_trace_info(self, values, port):
+        if self.trace is not None:
+            self.trace.info.update(sender=values.get('sender'), recipient=values.get('recipient'),
+                                   client=values.get('client_address'), port=port, action=self.action)
+
+    def handlerequest(self, sess):
+        """run the plugins on the request last received in sess, sets self.action and self.arg"""
+        starttime = time.time()
+        port = None
+        try:
             values = sess.values
             suspect = Suspect(values)
+            suspect.deadline = self.get_request_deadline(starttime)
+            suspect.trace = self.trace
+            self.attach_transaction(suspect)
 
             # store incoming port to tag, could be used to disable plugins
             # based on port
             try:
-                port = sess.socket . getsockname()[1]
+                port = sess.socket.getsockname()[1]
                 if port is not None:
                     suspect.tags['incomingport'] = port
             except Exception as e:
                 self.logger.warning('Could not get incoming port: %s' % str(e))
 
-            self.set_threadinfo("Handling message %s" % suspect)
-            starttime = time.time()
+            self.set_threadinfo('Handling message', suspect)
             self.run_plugins(suspect, self.plugins)
 
             # how long did it all take?
@@ -71,70 +187,291 @@ class SessionHandler(object):
 
             # checks done.. print out suspect status
             self.logger.debug(suspect)
-            self.set_threadinfo("Finishing message %s" % suspect)
+            self.set_threadinfo('Finishing message', suspect)
 
-        except KeyboardInterrupt:
-            sys.exit(0)
         except ValueError:
             # Error in envelope send/receive address
-            try:
-                address_compliance_fail_action = self.config.get('main','address_compliance_fail_action').lower()
-            except Exception:
-                address_compliance_fail_action = "defer"
-
-            try:
-                message = self.config.get('main','address_compliance_fail_message')
-            except Exception:
-                message = "invalid sender or recipient address"
-
-            if address_compliance_fail_action   == "defer":
-                self.action = DEFER
-            elif address_compliance_fail_action == "reject":
-                self.action = REJECT
-            elif address_compliance_fail_action == "discard":
-                self.action = DISCARD
-            else:
-                self.action = DEFER
-            self.arg = message
+            self.action, self.arg = self.address_compliance_fail()
 
         except Exception as e:
             self.logger.exception(e)
-        finally:
-            if sess is not None:
-                sess.endsession(self.action, self.arg)
-            self.logger.debug('Session finished')
+
+        Statskeeper().record_request(time.time() - starttime, port, self.action)
+        self.set_trace_info(sess.values, port)
 
     def run_plugins(self, suspect, pluglist):
         """Run scannerplugins on suspect"""
-        for plugin in pluglist:
+        futures = {}
+        if self.get_concurrent_plugins(pluglist):
+            futures = self.start_concurrent_plugins(suspect, pluglist)
+        try:
+            for index, plugin in enumerate(pluglist):
+                if self.request_timed_out(suspect):
+                    break
+                try:
+                    self.logger.debug('Running plugin %s' % plugin)
+                    self.set_threadinfo('Running plugin', suspect, plugin)
+                    future = futures.pop(index, None)
+                    if future is not None and not future.cancel():
+                        try:
+                            ans = future.result(suspect.time_left())
+                        except concurrent.futures.TimeoutError:
+                            raise DeadlineExceeded('request deadline exceeded')
+                    else:
+                        # not started yet (executor busy), run it in this thread
+                        ans = self.examine_plugin(suspect, plugin)
+                    if self.handle_plugin_result(suspect, plugin, ans):
+                        break
+
+                except DeadlineExceeded:
+                    if self.handle_plugin_result(suspect, plugin, self.plugin_timed_out(plugin)):
+                        break
+
+                except Exception:
+                    exc = traceback. format_exc()
+                    self.logger.error('Plugin %s failed: %s' % (str(plugin), exc))
+                    Statskeeper().count_plugin_result(plugin, error=True)
+        finally:
+            # results of plugins after the decision are not needed anymore
+            for future in futures.values():
+                future.cancel()
+
+    def examine_plugin(self, suspect, plugin):
+        """returns the answer of plugin, from the verdict cache if possible.
+        raises DeadlineExceeded if the plugin did not finish within its time budget"""
+        starttime = timer()
+        try:
+            cachekey, ans = self.get_cached_verdict(suspect, plugin)
+            if cachekey is None or ans is None:
+                ans = self.examine_with_deadline(suspect, plugin, self.get_plugin_deadline(suspect, plugin))
+                self.store_verdict(suspect, plugin, cachekey, ans)
+            return ans
+        finally:
+            Statskeeper().record_plugin_call(plugin, timer() - starttime)
+
+    def examine_with_deadline(self, suspect, plugin, deadline):
+        """run plugin.examine with the deadline and the trace of the request set for the extensions used by the plugin"""
+        with deadline_scope(deadline), trace_scope(suspect.trace), span('examine', plugin):
+            ans = plugin.examine(suspect)
+        if deadline is not None and time.time() > deadline:
+            # the answer is too late, the plugin may have skipped checks which ran out of time
+            raise DeadlineExceeded('plugin %s exceeded its time budget' % plugin)
+        return ans
+
+    def get_request_deadline(self, starttime):
+        """returns the deadline for the answer of a request received at starttime, None if unlimited"""
+        try:
+            timeout = self.config.getfloat('performance', 'request_timeout')
+        except Exception:
+            timeout = 0
+        if timeout > 0:
+            return starttime + timeout
+        return None
+
+    def get_plugin_deadline(self, suspect, plugin):
+        """returns the deadline for a plugin starting now: the request deadline or its time budget
+        (plugin_timeout), whichever is earlier"""
+        try:
+            budget = self._plugin_timeouts[plugin]
+        except KeyError:
+            budget = 0
             try:
-                self.logger.debug('Running plugin %s' % plugin)
-                self.set_threadinfo(
-                    "%s : Running Plugin %s" % (suspect, plugin))
-                ans = plugin.examine(suspect)
-                arg = None
-                if isinstance(ans, tuple):
-                    result, arg = ans
+                if self.config.has_option(plugin.section, 'plugin_timeout'):
+                    budget = self.config.getfloat(plugin.section, 'plugin_timeout')
                 else:
-                    result = ans
+                    budget = self.config.getfloat('performance', 'plugin_timeout')
+            except Exception:
+                pass
+            self._plugin_timeouts[plugin] = budget
+
+        deadline = suspect.deadline
+        if budget > 0:
+            plugindeadline = time.time() + budget
+            if deadline is None or plugindeadline < deadline:
+                deadline = plugindeadline
+        return deadline
+
+    def get_timeout_answer(self):
+        """returns the (action, message) to use for plugins or requests running out of time"""
+        try:
+            action = self.config.get('performance', 'timeout_action').strip().lower()
+        except Exception:
+            action = DUNNO
+        try:
+            message = self.config.get('performance', 'timeout_message')
+        except Exception:
+            message = ''
+        return action, message
 
-                if result is None:
-                    result = DUNNO
+    def plugin_timed_out(self, plugin):
+        """count the timeout of plugin, returns the fallback answer"""
+        self.logger.warning('Plugin %s timed out' % plugin)
+        Statskeeper().increase_timeouts(str(plugin))
+        return self.get_timeout_answer()
+
+    def request_timed_out(self, suspect):
+        """returns True and sets the fallback answer if the request deadline has passed"""
+        if suspect.deadline is None or time.time() < suspect.deadline:
+            return False
+        self.logger.warning('Request deadline exceeded, not running the remaining plugins: %s' % suspect)
+        Statskeeper().increase_timeouts('request')
+        self.action, self.arg = self.get_timeout_answer()
+        suspect.tags['decisions'].append(('timeout', self.action))
+        return True
+
+    def get_concurrent_plugins(self, pluglist):
+        """returns True if concurrent_safe plugins should be started concurrently"""
+        if len(pluglist) < 2:
+            return False
+        try:
+            return self.config.getboolean('performance', 'concurrent_plugins')
+        except Exception:
+            return False
+
+    def start_concurrent_plugins(self, suspect, pluglist):
+        """start all concurrent_safe plugins in the plugin executor, returns a dict plugin index -> future"""
+        if not HAVE_FUTURES:
+            self.logger.warning('concurrent_plugins requires the concurrent.futures module')
+            return {}
+        try:
+            maxworkers = self.config.getint('performance', 'concurrent_plugins_threads')
+        except Exception:
+            maxworkers = 20
+        concurrent = [index for index, plugin in enumerate(pluglist) if plugin.is_concurrent_safe()]
+        if not concurrent or concurrent == [0]:
+            return {}
+        executor = get_plugin_executor(maxworkers)
+        futures = {}
+        for index in concurrent:
+            futures[index] = executor.submit(self.examine_plugin, suspect, pluglist[index])
+        return futures
+
+    def get_verdictcache_ttl(self, plugin):
+        """returns the verdict cache ttl for plugin, 0 if its verdicts are not cached"""
+        try:
+            return self._verdictcache_ttls[plugin]
+        except KeyError:
+            pass
+        ttl = 0
+        if plugin.get_verdictcache_keys() is not None:
+            try:
+                if self.config.has_option(plugin.section, 'verdictcache_ttl'):
+                    ttl = self.config.getfloat(plugin.section, 'verdictcache_ttl')
                 else:
-                    result = result.strip().lower()
-                self.action = result
-                self.arg = arg
-                suspect.tags['decisions'].append((str(plugin), result))
-                self.logger.debug('Plugin sez: %s (arg=%s)' % (result, arg))
-
-                if result != DUNNO:
-                    self.logger.debug(
-                        'Plugin makes a decision other than DUNNO - not running any other plugins')
-                    break
+                    ttl = self.config.getfloat('performance', 'verdictcache_ttl')
+            except Exception as e:
+                self.logger.warning('Invalid verdictcache_ttl for plugin %s: %s' % (plugin, str(e)))
+        self._verdictcache_ttls[plugin] = ttl
+        return ttl
 
-            except Exception:
-                exc = traceback. format_exc()
-                self.logger.error('Plugin %s failed: %s' % (str(plugin), exc))
+    def attach_transaction(self, suspect):
+        """attach the memo of the smtp transaction the request belongs to"""
+        suspect.transaction = self.transactionmemo.get(suspect.get_value('instance'))
+
+    def get_cached_verdict(self, suspect, plugin):
+        """returns a tuple (cachekey, answer). cachekey is None if the verdict of the plugin is not cached,
+        answer is None if there is no cached verdict. Verdicts are looked up in the transaction memo first"""
+        keys = plugin.get_verdictcache_keys()
+        if keys is None:
+            return None, None
+        if suspect.transaction is None and self.get_verdictcache_ttl(plugin) <= 0:
+            return None, None
+        cachekey = VerdictCache.make_key(plugin, suspect, keys)
+        cached = None
+        if suspect.transaction is not None:
+            cached = suspect.transaction.get(cachekey)
+        if cached is None and self.get_verdictcache_ttl(plugin) > 0:
+            cached = self.verdictcache.get(cachekey)
+        if cached is None:
+            Statskeeper().count('verdictcache.misses')
+            return cachekey, None
+        Statskeeper().count('verdictcache.hits')
+        ans, tags = cached
+        suspect.tags.update(tags)
+        self.logger.debug('Verdict of plugin %s from cache' % plugin)
+        return cachekey, ans
+
+    def store_verdict(self, suspect, plugin, cachekey, ans):
+        """remember the answer of a plugin for requests with the same cachekey"""
+        if cachekey is None:
+            return
+        tags = {}
+        for tag in plugin.verdictcache_tags:
+            if tag in suspect.tags:
+                tags[tag] = suspect.tags[tag]
+        if suspect.transaction is not None:
+            suspect.transaction[cachekey] = (ans, tags)
+        ttl = self.get_verdictcache_ttl(plugin)
+        if ttl > 0:
+            self.verdictcache.put(cachekey, (ans, tags), ttl)
+
+    def handle_plugin_result(self, suspect, plugin, ans):
+        """Store the answer of a plugin. Returns True if the plugin made a decision
+        and no further plugins should be run"""
+        arg = None
+        if isinstance(ans, tuple):
+            result, arg = ans
+        else:
+            result = ans
+
+        if result is None:
+            result = DUNNO
+        else:
+            result = result.strip().lower()
+        self.action = result
+        self.arg = arg
+        suspect.tags['decisions'].append((str(plugin), result))
+        self.logger.debug('Plugin sez: %s (arg=%s)' % (result, arg))
+        Statskeeper().count_plugin_result(plugin, action=result, decision=result != DUNNO)
+
+        if result != DUNNO:
+            self.logger.debug(
+                'Plugin makes a decision other than DUNNO - not running any other plugins')
+            return True
+        return False
+
+    def address_compliance_fail(self):
+        """Returns the (action, message) tuple to answer with if the envelope addresses are invalid"""
+        try:
+            address_compliance_fail_action = self.config.get('main','address_compliance_fail_action').lower()
+        except Exception:
+            address_compliance_fail_action = "defer"
+
+        try:
+            message = self.config.get('main','address_compliance_fail_message')
+        except Exception:
+            message = "invalid sender or recipient address"
+
+        if address_compliance_fail_action   == "defer":
+            action = DEFER
+        elif address_compliance_fail_action == "reject":
+            action = REJECT
+        elif address_compliance_fail_action == "discard":
+            action = DISCARD
+        else:
+            action = DEFER
+        return action, message
+
+
+def format_threadinfo(threadinfo):
+    """returns the text of a threadinfo set by SessionHandler.set_threadinfo"""
+    if not isinstance(threadinfo, tuple):
+        return threadinfo or ''
+    status, suspect, plugin = threadinfo
+    text = status
+    if suspect is not None:
+        text += ' sender=%s recipient=%s' % (suspect.get_value('sender'), suspect.get_value('recipient'))
+    if plugin is not None:
+        text += ' plugin=%s' % plugin
+    return text
+
+
+def format_response(action, arg):
+    """Returns the encoded policy protocol answer for action and optional arg"""
+    ret = action
+    if arg is not None and arg.strip() != "":
+        ret = "%s %s" % (action, arg.strip())
+    return ('action=%s\n\n' % ret).encode()
 
 
 class PolicydSession(object):
@@ -146,12 +483,20 @@ class PolicydSession(object):
         self.logger = logging.getLogger("%s.policysession" % __package__)
         self.file = self.socket.makefile('r')
         self.values = {}
+        self.eof = False
+        self.readstart = None # timer() when the first line and the end of the last request were read
+        self.readend = None
+
+    def settimeout(self, timeout):
+        """set the idle timeout for reading requests"""
+        self.socket.settimeout(timeout)
+
+    def sendanswer(self, action, arg):
+        """send the answer to the current request, the connection is kept open"""
+        self.socket.sendall(format_response(action, arg))
 
     def endsession(self, action, arg):
-        ret = action
-        if arg is not None and arg.strip() != "":
-            ret = "%s %s" % (action, arg.strip())
-        self.socket.send(('action=%s\n\n' % ret).encode())
+        self.sendanswer(action, arg)
         self.closeconn()
 
     def closeconn(self):
@@ -163,12 +508,24 @@ class PolicydSession(object):
             self.socket.close()
 
     def getrequest(self):
-        """return true if mail got in, false on error Session will be kept open"""
+        """read the next request into self.values. return true if a request got in, false on error or if
+        the client closed the connection (self.eof is set in this case). Session will be kept open"""
+        self.values = {}
         while True:
             line = self.file.readline()
+            if line == '':
+                # connection closed by client
+                self.eof = True
+                return False
             line = line.strip()
             if line == '':
+                if not self.values:
+                    # ignore stray empty lines between requests
+                    continue
+                self.readend = timer()
                 return True
+            if not self.values:
+                self.readstart = timer()
             try:
                 key, val = line.split('=', 1)
                 self.values[key] = val
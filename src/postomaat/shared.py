@@ -19,13 +19,22 @@ import socket
 import os
 import datetime
 import threading
+import re
 from postomaat.addrcheck import Addrcheck
 from string import Template
+from collections import OrderedDict
 try:
     import configparser
 except ImportError:
     import ConfigParser as configparser
 
+try:
+    import re2
+    HAVE_RE2_SET = hasattr(re2, 'Set')
+except ImportError:
+    re2 = None
+    HAVE_RE2_SET = False
+
 
 
 HOSTNAME=socket.gethostname()
@@ -63,6 +72,39 @@ ALLCODES = {
 }
 
 
+#attributes of a policy request, as sent by postfix (startscript --debugmsg, postomaat_bench)
+DEFAULT_REQUEST_ATTRS={
+    #Postfix version 2.1 and later:
+    'request':'smtpd_access_policy',
+    'protocol_state':'RCPT',
+    'protocol_name':'SMTP',
+    'helo_name':'smtp.example.com',
+    'queue_id':'8045F2AB23',
+    'sender':'sender@example.com',
+    'recipient':'recipient@example.org',
+    'recipient_count':'1',
+    'client_address':'1.2.3.4',
+    'client_name':'host.example.net',
+    'reverse_client_name':'host.example.net',
+    'instance':'123.456.7',
+    #Postfix version 2.2 and later:
+    'sasl_method':'',
+    'sasl_username':'',
+    'sasl_sender':'',
+    'size':'12345',
+    'ccert_subject':'',
+    'ccert_issuer':'',
+    'ccert_fingerprint':'',
+    #Postfix version 2.3 and later:
+    'encryption_protocol':'TLSv1/SSLv3',
+    'encryption_cipher':'DHE-RSA-AES256-SHA',
+    'encryption_keysize':'256',
+    'etrn_domain':'',
+    #Postfix version 2.5 and later:
+    'stress':'',
+}
+
+
 #protocol stages
 CONNECT="CONNECT"
 EHLO="EHLO"
@@ -154,6 +196,16 @@ def apply_template(templatecontent,suspect,values=None,valuesfunction=None):
     return message
 
 
+def template_fields(templatecontent):
+    """returns the set of variable names used in a template"""
+    fields=set()
+    for match in Template.pattern.finditer(templatecontent):
+        name=match.group('named') or match.group('braced')
+        if name is not None:
+            fields.add(name)
+    return fields
+
+
 def default_template_values(suspect, values=None):
     """Return a dict with default template variables applicable for this suspect
     if values is not none, fill the values dict instead of returning a new one"""
@@ -161,7 +213,9 @@ def default_template_values(suspect, values=None):
     if values is None:
         values = {}
         
-    values = dict(suspect.values.items()+values.items())
+    merged = dict(suspect.values)
+    merged.update(values)
+    values = merged
     values['timestamp']=int(time.time())
     values['from_address']=suspect.from_address
     values['to_address']=suspect.to_address
@@ -187,6 +241,15 @@ class Suspect(object):
         #tags set by plugins
         self.tags['decisions']=[]
         
+        #dict shared by all requests of the same smtp transaction (postfix 'instance'), None if not available
+        self.transaction=None
+        
+        #unix timestamp until the answer must be sent (performance.request_timeout), None if unlimited
+        self.deadline=None
+        
+        #spans of the request (postomaat.trace), None if tracing is disabled
+        self.trace=None
+        
         #additional basic information
         self.timestamp=time.time()
 
@@ -208,6 +271,12 @@ class Suspect(object):
             raise ValueError("invalid sender address: %s"%sender)
 
         # perform address check
+    def time_left(self,default=None):
+        """returns the seconds left until the request deadline (never negative), default if there is no deadline"""
+        if self.deadline is None:
+            return default
+        return max(self.deadline-time.time(),0)
+    
     def get_value(self,key):
         """returns one of the postfix supplied values"""
         if not key in self.values:
@@ -386,9 +455,74 @@ def extract_domain(address, lowercase=True):
             raise ValueError("invalid email address: '%s'"%address)
 
 class ScannerPlugin(BasicPlugin):
-    """Scanner Plugin Base Class"""
+    """Scanner Plugin Base Class
+    
+    With backend=asyncio, plugins may additionally define a coroutine ``async def examine_async(self,suspect)``
+    which is awaited on the event loop instead of running examine() in the executor.
+    
+    Plugins whose verdict only depends on a few request attributes can declare them in verdictcache_keys.
+    The verdict is then reused for the following recipients of the same smtp transaction, and if
+    performance.verdictcache_ttl (or verdictcache_ttl in the plugin section) is > 0, memoized for all requests
+    with the same values of these attributes. examine() is not called again in these cases.
+    Plugins may also store own data for the transaction in suspect.transaction.
+    
+    Plugins which only compute their verdict without side effects on other plugins or external systems
+    (eg. DNS lookups) can set concurrent_safe. With performance.concurrent_plugins enabled they are started
+    concurrently at the beginning of the request, their results are still evaluated in the configured order.
+    """
+    #request attributes (postfix fields or from_address, from_domain, to_address, to_domain) the verdict depends on.
+    #None: the verdict is never cached
+    verdictcache_keys = None
+    #tags set by examine() which are restored on cached verdicts
+    verdictcache_tags = ()
+    #config options containing message templates. The variables used in them are added to the cache key
+    verdictcache_templates = ()
+    #may run concurrently with other plugins. can be overridden with option 'concurrent' in the plugin section
+    concurrent_safe = False
+    
     def examine(self,suspect):
         self._logger().warning('Unimplemented examine() method')
+    
+    def reload_lists(self):
+        """reload the files the plugin reads lists or rules from now, even if they did not change.
+        returns the filenames reloaded. The default reloads all FileList attributes"""
+        reloaded=[]
+        for value in list(self.__dict__.values()):
+            if isinstance(value,FileList) and value.force_reload():
+                reloaded.append(value.filename)
+        return reloaded
+    
+    def is_concurrent_safe(self):
+        """returns True if the plugin may be started concurrently with other plugins"""
+        try:
+            if self.config.has_option(self.section,'concurrent'):
+                return self.config.getboolean(self.section,'concurrent')
+        except Exception:
+            pass
+        return self.concurrent_safe
+    
+    def get_verdictcache_keys(self):
+        """returns the tuple of request attributes the verdict depends on or None if it must not be cached"""
+        try:
+            return self._verdictcache_keys
+        except AttributeError:
+            pass
+        keys=self.verdictcache_keys
+        if keys is not None:
+            keys=list(keys)
+            for option in self.verdictcache_templates:
+                try:
+                    fields=template_fields(self.config.get(self.section,option))
+                except Exception:
+                    continue
+                if fields & set(['timestamp','date','time']):
+                    keys=None
+                    break
+                keys.extend(sorted(f for f in fields if f not in keys))
+            if keys is not None:
+                keys=tuple(keys)
+        self._verdictcache_keys=keys
+        return keys
 
     #legacy...
     def stripAddress(self,address):
@@ -506,6 +640,14 @@ class FileList(object):
 
         self.content = newcontent
 
+    def force_reload(self):
+        """Reload the file now, even if it did not change. Returns False if there is no file"""
+        if not self.filename or not os.path.isfile(self.filename):
+            return False
+        with self.lock:
+            self._reload()
+        return True
+
     def file_changed(self):
         """Return True if the file has changed on disks since the last reload"""
         if not os.path.isfile(self.filename):
@@ -569,19 +711,280 @@ class Cache(object):
             
             cleancount=0
             
-            for key in self.cache.keys()[:]:
+            for key in list(self.cache.keys()):
                 obj,instime=self.cache[key]
                 if now-instime>self.cachetime:
                     del self.cache[key]
                     cleancount+=1
             self.lock.release()
             self.logger.debug("Cleaned %s expired entries."%cleancount)
+    
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+    
+    def stats(self):
+        return dict(size=len(self.cache), cachetime=self.cachetime)
 
 
 
+class VerdictCache(object):
+    """Memoizes plugin verdicts for a limited time. When maxsize is reached, the oldest entries are evicted"""
+    def __init__(self, maxsize=10000):
+        self.maxsize=maxsize
+        self.entries=OrderedDict()
+        self.lock=threading.Lock()
+        self.hits=0
+        self.misses=0
+    
+    @staticmethod
+    def make_key(plugin, suspect, keys):
+        """returns the cache key for the verdict of plugin on suspect"""
+        values=[]
+        for name in keys:
+            if name in ('from_address','from_domain','to_address','to_domain'):
+                values.append(getattr(suspect,name))
+            else:
+                values.append(suspect.values.get(name))
+        return (plugin.__class__.__name__, plugin.section, tuple(values))
+    
+    def get(self, key):
+        """returns the cached value or None"""
+        with self.lock:
+            entry=self.entries.get(key)
+            if entry is not None:
+                value,expires=entry
+                if expires>time.time():
+                    self.hits+=1
+                    return value
+                del self.entries[key]
+            self.misses+=1
+            return None
+    
+    def put(self, key, value, ttl):
+        with self.lock:
+            self.entries.pop(key,None)
+            self.entries[key]=(value,time.time()+ttl)
+            while len(self.entries)>self.maxsize:
+                self.entries.popitem(last=False)
+    
+    def clear(self, keep=None):
+        """drop all verdicts, except those of the plugins in keep (a set of (class name, section))"""
+        with self.lock:
+            if not keep:
+                self.entries.clear()
+                return
+            for key in list(self.entries.keys()):
+                if key[:2] not in keep:
+                    del self.entries[key]
+    
+    def stats(self):
+        return dict(size=len(self.entries), hits=self.hits, misses=self.misses)
+
+
+class TransactionMemo(object):
+    """Short lived store for data of one smtp transaction. Postfix sends the same 'instance' value with all
+    requests (recipients) of a transaction, get() returns the same dict for all of them.
+    Transactions are kept in least recently used order, so stale ones are evicted from the front in O(1)"""
+    def __init__(self, maxsize=1000, ttl=600):
+        self.maxsize=maxsize
+        self.ttl=ttl
+        self.transactions=OrderedDict() # instance -> (memo dict, expiry time)
+        self.lock=threading.Lock()
+    
+    def get(self, instance):
+        """returns the memo dict of transaction instance, None if instance is empty or the memo is disabled"""
+        if not instance or self.maxsize<=0:
+            return None
+        now=time.time()
+        with self.lock:
+            entry=self.transactions.pop(instance,None)
+            if entry is None or entry[1]<now:
+                memo={}
+            else:
+                memo=entry[0]
+            self.transactions[instance]=(memo,now+self.ttl)
+            while self.transactions:
+                oldest=next(iter(self.transactions))
+                if len(self.transactions)<=self.maxsize and self.transactions[oldest][1]>=now:
+                    break
+                del self.transactions[oldest]
+        return memo
+    
+    def clear(self):
+        with self.lock:
+            self.transactions.clear()
+    
+    def stats(self):
+        return dict(size=len(self.transactions))
+
+
+TRANSACTIONMEMO=None
+def get_transactionmemo():
+    global TRANSACTIONMEMO
+    if TRANSACTIONMEMO is None:
+        TRANSACTIONMEMO=TransactionMemo()
+    return TRANSACTIONMEMO
+
+
+VERDICTCACHE=None
+def get_verdictcache():
+    global VERDICTCACHE
+    if VERDICTCACHE is None:
+        VERDICTCACHE=VerdictCache()
+    return VERDICTCACHE
+
+
 DEFAULTCACHE=None
 def get_default_cache():
     global DEFAULTCACHE
     if DEFAULTCACHE is None:
         DEFAULTCACHE=Cache()
     return DEFAULTCACHE
+
+
+
+class RegexSet(object):
+    """Match a text against many regular expressions and return the ids of all matching patterns.
+
+    If the re2 module with its Set API is available, all patterns are combined into one automaton and
+    the text is scanned only once. Patterns re2 does not support (backreferences, lookarounds, ...) and all
+    patterns without re2 are precompiled and matched one by one. (Merging them into one alternation does not
+    help with python's re: it tries every alternative at every position and loses the literal prefix search,
+    which makes it slower than separate searches.)
+
+    anchored: if True patterns must match at the start of the text (like re.match), otherwise anywhere (re.search)
+    """
+
+    def __init__(self, anchored=False):
+        self.anchored = anchored
+        self.patterns = []
+        self.logger = logging.getLogger('%s.regexset' % __package__)
+        self._compiled = None
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def add(self, ruleid, pattern, flags=0):
+        """add a pattern string or a compiled regex. Only the flags re.I, re.M and re.S are supported.
+        raises re.error if the pattern is invalid"""
+        if hasattr(pattern, 'pattern'):
+            flags = pattern.flags
+            pattern = pattern.pattern
+        flags = flags & (re.I | re.M | re.S)
+        re.compile(pattern, flags)
+        self.patterns.append((ruleid, pattern, flags))
+        self._compiled = None
+
+    def _inline_flags(self, flags):
+        chars = ''
+        if flags & re.I:
+            chars += 'i'
+        if flags & re.M:
+            chars += 'm'
+        if flags & re.S:
+            chars += 's'
+        if chars:
+            return '(?%s)' % chars
+        return ''
+
+    def compile(self):
+        """build the matchers. Called automatically by match() after patterns were added"""
+        re2set = None
+        re2ids = []
+        single = []
+
+        remaining = self.patterns
+        if HAVE_RE2_SET and remaining:
+            if self.anchored:
+                re2set = re2.Set.MatchSet(re2.Options())
+            else:
+                re2set = re2.Set.SearchSet(re2.Options())
+            remaining = []
+            for ruleid, pattern, flags in self.patterns:
+                try:
+                    re2set.Add(self._inline_flags(flags) + pattern)
+                    re2ids.append(ruleid)
+                except Exception:
+                    remaining.append((ruleid, pattern, flags))
+            if re2ids:
+                re2set.Compile()
+            else:
+                re2set = None
+
+        for ruleid, pattern, flags in remaining:
+            expression = re.compile(pattern, flags)
+            if self.anchored:
+                single.append((ruleid, expression.match))
+            else:
+                single.append((ruleid, expression.search))
+
+        self._compiled = (re2set, re2ids, single)
+        self.logger.debug('compiled regex set: %s patterns, %s in re2 set' % (len(self.patterns), len(re2ids)))
+
+    def match(self, text):
+        """returns the set of ruleids whose pattern matches text"""
+        compiled = self._compiled
+        if compiled is None:
+            self.compile()
+            compiled = self._compiled
+        re2set, re2ids, single = compiled
+
+        hits = set()
+        if re2set is not None:
+            for idx in re2set.Match(text) or ():
+                hits.add(re2ids[idx])
+        for ruleid, matchfunc in single:
+            if matchfunc(text) is not None:
+                hits.add(ruleid)
+        return hits
+
+
+class FieldRegexSets(object):
+    """One RegexSet per field, shared by all rules of a rule engine. Use matches() for each request to get
+    the ids of all matching patterns of a field, computed once per field and request"""
+
+    def __init__(self, anchored=False):
+        self.anchored = anchored
+        self.sets = {}
+        self._idcounter = 0
+
+    def add(self, field, pattern, flags=0):
+        """add a pattern for field, returns the id to look up in the match results"""
+        ruleid = self._idcounter
+        if field not in self.sets:
+            self.sets[field] = RegexSet(self.anchored)
+        self.sets[field].add(ruleid, pattern, flags)
+        self._idcounter += 1
+        return ruleid
+
+    def compile(self):
+        for regexset in self.sets.values():
+            regexset.compile()
+
+    def matches(self, getvalue):
+        """returns a FieldMatches for one request. getvalue(field) must return the text to match for a field"""
+        return FieldMatches(self.sets, getvalue)
+
+
+class FieldMatches(object):
+    """lazily computed match results of one request"""
+
+    def __init__(self, sets, getvalue):
+        self.sets = sets
+        self.getvalue = getvalue
+        self.cache = {}
+
+    def get(self, field):
+        """returns the set of ids of all patterns for field matching the request"""
+        try:
+            return self.cache[field]
+        except KeyError:
+            pass
+        regexset = self.sets.get(field)
+        if regexset is None:
+            hits = frozenset()
+        else:
+            hits = regexset.match(self.getvalue(field))
+        self.cache[field] = hits
+        return hits
@@ -0,0 +1,496 @@
+# -*- coding: UTF-8 -*-
+#   Copyright 2012-2018 Oli Schacher
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# In-process stand-ins for the services used by the plugins, so plugins can be benchmarked without network
+# access (postomaat_bench --plugin): a stub DNS server answering from zone fixtures, a fake SMTP relay for
+# call-aheads, an in-memory redis and temporary SQLite databases. Each stand-in can add latency and errors.
+
+import socket
+import struct
+import threading
+import logging
+import random
+import fnmatch
+import tempfile
+import sqlite3
+import time
+import os
+import re
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+
+class StandInError(Exception):
+    """an error injected by a stand-in"""
+    pass
+
+
+class Faults(object):
+    """latency (seconds) and error rate (0..1) injected by a stand-in"""
+
+    def __init__(self, latency=0, errorrate=0):
+        self.latency = latency
+        self.errorrate = errorrate
+        self.random = random.Random()
+        # calls the faults were applied to, where the stand-in does not count them itself
+        self.count = 0
+
+    def delay(self):
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def failed(self):
+        return self.errorrate > 0 and self.random.random() < self.errorrate
+
+
+# -- DNS
+
+QTYPES = {'A': 1, 'NS': 2, 'CNAME': 5, 'PTR': 12, 'MX': 15, 'TXT': 16, 'AAAA': 28}
+
+RCODE_NOERROR = 0
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+
+
+def read_zone(fp):
+    """returns the records of a zone fixture as (name, type, value) tuples. one record per line:
+    'name type value', e.g. 'example.com MX 10 mx.example.com' or 'example.com TXT "v=spf1 -all"'.
+    names may start with '*.' to answer for all names below. lines starting with # are ignored"""
+    records = []
+    for line in fp:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        parts = line.split(None, 2)
+        if len(parts) != 3 or parts[1].upper() not in QTYPES:
+            raise ValueError('invalid zone line: %s' % line)
+        name, qtype, value = parts
+        records.append((name, qtype.upper(), value))
+    return records
+
+
+def _encode_name(name):
+    labels = [label for label in name.strip('.').encode('idna').split(b'.') if label]
+    return b''.join(struct.pack('!B', len(label)) + label for label in labels) + b'\0'
+
+
+def _encode_rdata(qtype, value):
+    if qtype == 'A':
+        return socket.inet_aton(value)
+    if qtype == 'AAAA':
+        return socket.inet_pton(socket.AF_INET6, value)
+    if qtype == 'MX':
+        preference, host = value.split()
+        return struct.pack('!H', int(preference)) + _encode_name(host)
+    if qtype == 'TXT':
+        if len(value) > 1 and value.startswith('"') and value.endswith('"'):
+            value = value[1:-1]
+        data = value.encode('utf-8')
+        chunks = [data[i:i + 255] for i in range(0, len(data), 255)] or [b'']
+        return b''.join(struct.pack('!B', len(chunk)) + chunk for chunk in chunks)
+    return _encode_name(value)
+
+
+def _decode_question(data):
+    """returns (name, qtype, end of the question) of the first question of a dns query"""
+    offset = 12
+    labels = []
+    while True:
+        length = struct.unpack('!B', data[offset:offset + 1])[0]
+        offset += 1
+        if length == 0:
+            break
+        labels.append(data[offset:offset + length].decode('ascii'))
+        offset += length
+    qtype = struct.unpack('!H', data[offset:offset + 2])[0]
+    return '.'.join(labels).lower(), qtype, offset + 4
+
+
+class StubDNSServer(object):
+    """udp dns server answering A, AAAA, MX, TXT, PTR, NS and CNAME queries from a list of (name, type, value)
+    records (see read_zone). unknown names get NXDOMAIN. answers are delayed by latency seconds, with
+    errorrate an answer is SERVFAIL. there is no recursion, no CNAME chasing and no TCP"""
+
+    def __init__(self, records=(), address='127.0.0.1', port=0, latency=0, errorrate=0, ttl=300):
+        self.logger = logging.getLogger('%s.standins.dns' % __package__)
+        self.faults = Faults(latency, errorrate)
+        self.ttl = ttl
+        self.records = {}
+        for name, qtype, value in records:
+            self.add_record(name, qtype, value)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((address, port))
+        self.sock.settimeout(0.2)
+        self.address, self.port = self.sock.getsockname()
+        self.queries = 0
+        self.stayalive = False
+        self.thread = None
+
+    def add_record(self, name, qtype, value):
+        self.records.setdefault(name.strip('.').lower(), []).append((qtype.upper(), value))
+
+    def resolve(self, name, qtypecode):
+        """returns (rcode, [rdata]) for a query"""
+        entries = self.records.get(name)
+        if entries is None:
+            parts = name.split('.')
+            for index in range(1, len(parts)):
+                entries = self.records.get('*.' + '.'.join(parts[index:]))
+                if entries is not None:
+                    break
+        if entries is None:
+            return RCODE_NXDOMAIN, []
+        return RCODE_NOERROR, [_encode_rdata(qtype, value) for qtype, value in entries if QTYPES[qtype] == qtypecode]
+
+    def answer(self, data):
+        ident, flags = struct.unpack('!HH', data[:4])
+        name, qtypecode, end = _decode_question(data)
+        if self.faults.failed():
+            rcode, answers = RCODE_SERVFAIL, []
+        else:
+            rcode, answers = self.resolve(name, qtypecode)
+        # QR, AA and RA set, RD copied from the query
+        header = struct.pack('!HHHHHH', ident, 0x8480 | (flags & 0x0100) | rcode, 1, len(answers), 0, 0)
+        # the names of the answers point to the question (offset 12)
+        records = b''.join(b'\xc0\x0c' + struct.pack('!HHIH', qtypecode, 1, self.ttl, len(rdata)) + rdata
+                           for rdata in answers)
+        return header + data[12:end] + records
+
+    def reply(self, data, peer):
+        try:
+            self.sock.sendto(self.answer(data), peer)
+        except Exception as e:
+            self.logger.debug('Could not answer query from %s: %s' % (peer, str(e)))
+
+    def serve(self):
+        while self.stayalive:
+            try:
+                data, peer = self.sock.recvfrom(4096)
+            except socket.timeout:
+                continue
+            except Exception:
+                break
+            self.queries += 1
+            if self.faults.latency > 0:
+                timer = threading.Timer(self.faults.latency, self.reply, (data, peer))
+                timer.daemon = True
+                timer.start()
+            else:
+                self.reply(data, peer)
+
+    def start(self):
+        self.stayalive = True
+        self.thread = threading.Thread(target=self.serve, name='Stub DNS server')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stayalive = False
+        if self.thread is not None:
+            self.thread.join()
+        self.sock.close()
+
+
+def use_stub_resolver(address, port):
+    """send the lookups of postomaat.extensions.dnsquery and pyspf to the dns server at address:port"""
+    try:
+        from dns import resolver
+        stub = resolver.Resolver(configure=False)
+        stub.nameservers = [address]
+        stub.port = port
+        resolver.default_resolver = stub
+    except ImportError:
+        pass
+    try:
+        import DNS
+        DNS.defaults['server'] = [address]
+        DNS.defaults['port'] = port
+    except ImportError:
+        pass
+
+
+# -- SMTP
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        relay = self.server.relay
+        relay.connections += 1
+        self.reply(220, '%s ESMTP' % relay.hostname)
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            line = line.decode('utf-8', 'replace').strip()
+            command = line[:4].upper()
+            if command == 'EHLO':
+                self.reply(250, relay.hostname, 'PIPELINING', '8BITMIME')
+            elif command == 'HELO':
+                self.reply(250, relay.hostname)
+            elif command == 'MAIL':
+                self.reply(250, '2.1.0 Ok')
+            elif command == 'RCPT':
+                match = re.search(r'<([^>]*)>', line)
+                self.reply(*relay.rcpt_reply(match.group(1) if match else ''))
+            elif command in ('RSET', 'NOOP'):
+                self.reply(250, '2.0.0 Ok')
+            elif command == 'QUIT':
+                self.reply(221, '2.0.0 Bye')
+                break
+            else:
+                self.reply(502, '5.5.2 Command not implemented')
+
+    def reply(self, code, *lines):
+        self.server.relay.faults.delay()
+        last = len(lines) - 1
+        self.wfile.write(''.join('%s%s%s\r\n' % (code, ' ' if index == last else '-', text)
+                                 for index, text in enumerate(lines)).encode('utf-8'))
+
+
+class _ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeSMTPRelay(object):
+    """smtp server answering call-aheads: banner, EHLO/HELO, MAIL FROM, RCPT TO, RSET, NOOP and QUIT, no STARTTLS.
+    responses maps recipient addresses or fnmatch patterns (e.g. '*@example.org') to the (code, message) of
+    their RCPT TO reply, other recipients get default. each reply is delayed by latency seconds, with errorrate
+    a RCPT TO reply is a temporary error"""
+
+    def __init__(self, responses=None, default=(250, '2.1.5 Ok'), address='127.0.0.1', port=0, latency=0,
+                 errorrate=0, hostname='relay.bench.example'):
+        self.responses = dict((key.lower(), value) for key, value in (responses or {}).items())
+        self.default = default
+        self.hostname = hostname
+        self.faults = Faults(latency, errorrate)
+        self.connections = 0
+        self.server = _ThreadingTCPServer((address, port), _SMTPHandler)
+        self.server.relay = self
+        self.address, self.port = self.server.server_address[:2]
+        self.thread = None
+
+    def rcpt_reply(self, address):
+        if self.faults.failed():
+            return 451, '4.3.0 Injected temporary error'
+        address = address.lower()
+        reply = self.responses.get(address)
+        if reply is not None:
+            return reply
+        for pattern, reply in self.responses.items():
+            if fnmatch.fnmatch(address, pattern):
+                return reply
+        return self.default
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs=dict(poll_interval=0.2),
+                                       name='Fake SMTP relay')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.server.shutdown()
+            self.thread.join()
+        self.server.server_close()
+
+
+# -- redis
+
+class _RedisData(object):
+    """the redis commands used by the plugins on in-memory hashes and sorted sets. values are stored and
+    returned as strings (like a connection with decode_responses)"""
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+
+    def _get(self, name, default=None):
+        expires = self.expires.get(name)
+        if expires is not None and expires <= time.time():
+            self.delete(name)
+        return self.data.get(name, default)
+
+    def ping(self):
+        return True
+
+    def keys(self, pattern='*'):
+        return [name for name in list(self.data) if self._get(name) is not None and fnmatch.fnmatch(name, pattern)]
+
+    def exists(self, *names):
+        return sum(1 for name in names if self._get(name) is not None)
+
+    def delete(self, *names):
+        count = 0
+        for name in names:
+            self.expires.pop(name, None)
+            if self.data.pop(name, None) is not None:
+                count += 1
+        return count
+
+    def expire(self, name, seconds):
+        if self._get(name) is None:
+            return False
+        self.expires[name] = time.time() + int(seconds)
+        return True
+
+    def ttl(self, name):
+        if self._get(name) is None:
+            return -2
+        expires = self.expires.get(name)
+        if expires is None:
+            return -1
+        return int(round(expires - time.time()))
+
+    def hmset(self, name, mapping):
+        self.data.setdefault(name, {}).update((key, str(value)) for key, value in mapping.items())
+        return True
+
+    def hmget(self, name, keys, *args):
+        if isinstance(keys, str):
+            keys = [keys]
+        values = self._get(name, {})
+        return [values.get(key) for key in list(keys) + list(args)]
+
+    def zadd(self, name, *args, **kwargs):
+        """zadd(name, mapping) or the redis-py 2 form zadd(name, score, member, ...)"""
+        if len(args) == 1 and isinstance(args[0], dict):
+            members = args[0].items()
+        else:
+            members = [(args[index + 1], args[index]) for index in range(0, len(args), 2)]
+        zset = self.data.setdefault(name, {})
+        added = 0
+        for member, score in members:
+            if str(member) not in zset:
+                added += 1
+            zset[str(member)] = float(score)
+        return added
+
+    def zremrangebyscore(self, name, minimum, maximum):
+        zset = self._get(name, {})
+        minimum, maximum = float(minimum), float(maximum)
+        removed = [member for member, score in zset.items() if minimum <= score <= maximum]
+        for member in removed:
+            del zset[member]
+        return len(removed)
+
+    def zcard(self, name):
+        return len(self._get(name, {}))
+
+
+class FakeRedis(object):
+    """in-memory replacement for a redis.StrictRedis connection, with the commands used by the plugins.
+    each command (or pipeline execute) is delayed by latency seconds and fails with errorrate"""
+
+    COMMANDS = ('ping', 'keys', 'exists', 'delete', 'expire', 'ttl', 'hmset', 'hmget', 'zadd',
+                'zremrangebyscore', 'zcard')
+
+    def __init__(self, latency=0, errorrate=0):
+        self.faults = Faults(latency, errorrate)
+        self.store = _RedisData()
+        self.lock = threading.Lock()
+        self.commands = 0
+
+    def roundtrip(self):
+        self.commands += 1
+        self.faults.delay()
+        if self.faults.failed():
+            raise StandInError('injected redis error')
+
+    def execute(self, calls):
+        self.roundtrip()
+        with self.lock:
+            return [getattr(self.store, name)(*args, **kwargs) for name, args, kwargs in calls]
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def __getattr__(self, name):
+        if name not in self.COMMANDS:
+            raise AttributeError(name)
+
+        def command(*args, **kwargs):
+            return self.execute([(name, args, kwargs)])[0]
+        return command
+
+
+class FakePipeline(object):
+    """queues commands until execute, which is one round trip of the FakeRedis"""
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.calls = []
+
+    def execute(self):
+        calls, self.calls = self.calls, []
+        return self.redis.execute(calls)
+
+    def __getattr__(self, name):
+        if name not in FakeRedis.COMMANDS:
+            raise AttributeError(name)
+
+        def command(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+            return self
+        return command
+
+
+# -- SQL
+
+class SQLiteFixture(object):
+    """a temporary sqlite database. url is its sqlalchemy connection string"""
+
+    def __init__(self, directory=None):
+        fd, self.filename = tempfile.mkstemp(prefix='postomaat-bench-', suffix='.sqlite', dir=directory)
+        os.close(fd)
+        self.url = 'sqlite:///%s' % self.filename
+
+    def execute(self, statement, rows=None):
+        """run a statement, for each of rows if given"""
+        conn = sqlite3.connect(self.filename)
+        try:
+            if rows is None:
+                conn.execute(statement)
+            else:
+                conn.executemany(statement, rows)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def remove(self):
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
+
+
+def inject_sql_faults(connectstring, latency=0, errorrate=0):
+    """delay and fail the statements sent by postomaat.extensions.sql to the database of connectstring"""
+    from sqlalchemy import event
+    from postomaat.extensions.sql import get_session
+    faults = Faults(latency, errorrate)
+
+    def _inject(conn, cursor, statement, parameters, context, executemany):
+        faults.count += 1
+        faults.delay()
+        if faults.failed():
+            raise StandInError('injected sql error')
+
+    event.listen(get_session(connectstring).bind, 'before_cursor_execute', _inject)
+    return faults
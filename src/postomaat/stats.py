@@ -20,6 +20,9 @@ import time
 import threading
 import logging
 import os
+import re
+import math
+import collections
 
 class StatDelta(object):
     """Represents the delta to be applied on the total statistics"""
@@ -32,34 +35,394 @@ class StatDelta(object):
         self.in_ = 0
         self.out = 0
         self.scantime = 0
+        self.timeouts = {} # name of the plugin (or 'request') -> number of timeouts
+        self.shed = {} # action -> number of requests answered by admission control without running the plugins
 
         for k,v in kwargs.items():
             setattr(self,k,v)
 
     def as_message(self):
-        return dict(event_type='statsdelta', total=self.total , spam=self.spam, ham=self.ham, virus=self.virus, blocked=self.blocked, in_=self.in_ , out=self.out, scantime=self.scantime)
+        return dict(event_type='statsdelta', total=self.total , spam=self.spam, ham=self.ham, virus=self.virus, blocked=self.blocked, in_=self.in_ , out=self.out, scantime=self.scantime, timeouts=self.timeouts, shed=self.shed)
+
+
+# clock for measuring durations, not affected by changes of the system time
+timer = getattr(time, 'perf_counter', time.time)
+
+SCALAR_COUNTERS = ('total', 'spam', 'ham', 'virus', 'blocked', 'in', 'out', 'timeouts', 'shed')
+
+
+def add_counters(target, counters):
+    for name, value in counters.items():
+        target[name] = target.get(name, 0) + value
+
+
+def keyed_counters(counters, prefix):
+    """returns the counters named prefix.<key> as dict key -> value"""
+    prefix = prefix + '.'
+    return dict((name[len(prefix):], value) for name, value in counters.items() if name.startswith(prefix))
+
+
+def plugin_name(plugin):
+    """name of plugin in the statistics: its class, followed by its config section if that differs
+    (eg. ComplexRules.rules_a), so instances of a class configured in different sections are counted apart"""
+    name = plugin.__class__.__name__
+    section = getattr(plugin, 'section', None)
+    if section and section != name:
+        name = '%s.%s' % (name, section)
+    return name
+
+
+def plugin_counter_name(name):
+    """plugin name as part of counter and histogram names, without the '.' used as separator there"""
+    return name.replace('%', '%25').replace('.', '%2E')
+
+
+def _unquote_plugin(name):
+    return name.replace('%2E', '.').replace('%25', '%')
+
+
+class Histogram(object):
+    """Latency histogram with fixed log-scale buckets (HDR style): every power of two from MIN_VALUE seconds
+    is split into SUBBUCKETS linear buckets, so percentiles are accurate to about 1/SUBBUCKETS of the value.
+    Recording is O(1), histograms are merged by adding up their buckets"""
+
+    MIN_VALUE = 1e-6 # seconds
+    SUBBUCKETS = 16
+    EXPONENTS = 32 # up to MIN_VALUE * 2**32, about 70 minutes
+    NBUCKETS = SUBBUCKETS * EXPONENTS
+
+    def __init__(self):
+        self.buckets = [0] * self.NBUCKETS
+        self.count = 0
+        self.sum = 0.0
+
+    @classmethod
+    def bucket_index(cls, value):
+        if value <= cls.MIN_VALUE:
+            return 0
+        mantissa, exponent = math.frexp(value / cls.MIN_VALUE) # 0.5 <= mantissa < 1, exponent >= 1
+        index = (exponent - 1) * cls.SUBBUCKETS + int((mantissa - 0.5) * 2 * cls.SUBBUCKETS)
+        return min(index, cls.NBUCKETS - 1)
+
+    @classmethod
+    def bucket_upper(cls, index):
+        """returns the highest value counted in bucket index"""
+        exponent, sub = divmod(index, cls.SUBBUCKETS)
+        return cls.MIN_VALUE * (2 ** exponent * (cls.SUBBUCKETS + sub + 1)) / cls.SUBBUCKETS
+
+    def record(self, value):
+        """record a duration in seconds"""
+        self.buckets[self.bucket_index(value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other):
+        """add the values of other to this histogram"""
+        buckets = self.buckets
+        for index, count in enumerate(other.buckets):
+            if count:
+                buckets[index] += count
+        self.count += other.count
+        self.sum += other.sum
+        return self
+
+    def copy(self):
+        return Histogram().merge(self)
+
+    def diff(self, older):
+        """returns a histogram of the values recorded since older (an earlier copy of this histogram)"""
+        result = Histogram()
+        result.buckets = [new - old for new, old in zip(self.buckets, older.buckets)]
+        result.count = self.count - older.count
+        result.sum = self.sum - older.sum
+        return result
+
+    def percentile(self, q):
+        """returns the value (upper bucket bound) below which q percent of the recorded values are, 0 if empty"""
+        buckets = list(self.buckets)
+        total = sum(buckets)
+        if total == 0:
+            return 0.0
+        rank = max(int(math.ceil(q / 100.0 * total)), 1)
+        seen = 0
+        for index, count in enumerate(buckets):
+            seen += count
+            if seen >= rank:
+                return self.bucket_upper(index)
+        return self.bucket_upper(self.NBUCKETS - 1)
+
+    def percentiles(self, qs=(50, 90, 99, 99.9)):
+        return dict((q, self.percentile(q)) for q in qs)
+
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return self.sum / self.count
+
+    def as_message(self):
+        """returns the histogram as a compact dict (only used buckets), see from_message"""
+        return dict(sum=self.sum, buckets=dict((index, count) for index, count in enumerate(self.buckets) if count))
+
+    @classmethod
+    def from_message(cls, message):
+        result = cls()
+        for index, count in message['buckets'].items():
+            result.buckets[int(index)] += count
+            result.count += count
+        result.sum = message['sum']
+        return result
+
+
+def add_histograms(target, histograms):
+    """merge the histograms (dict name -> Histogram) into target"""
+    for name, histogram in histograms.items():
+        if name in target:
+            target[name].merge(histogram)
+        else:
+            target[name] = histogram.copy()
 
 
 class Statskeeper(object):
 
-    """Keeps track of a few stats to generate mrtg graphs and stuff"""
+    """Keeps track of a few stats to generate mrtg graphs and stuff
+
+    Counters and latency histograms are kept per thread (only written by their own thread, no locking on
+    the request path) and summed up when they are read. Counters of other processes are added by registered
+    sources, histograms of worker processes are merged in with add_histograms.
+
+    Latency histograms are named request, port.<incoming port>, action.<final action> and plugin.<plugin>.
+    Counters of plugins are named plugin.<plugin>.<calls|time|errors|decisions|action.<action>>, see plugin_stats"""
     __shared_state = {}
 
     def __init__(self):
         self.__dict__ = self.__shared_state
-        if not hasattr(self, 'totalcount'):
-            self.totalcount = 0
-            self.spamcount = 0
-            self.hamcount = 0
-            self.viruscount = 0
-            self.blockedcount = 0
-            self.incount = 0
-            self.outcount = 0
-            self.scantimes = []
+        if not hasattr(self, 'starttime'):
+            self.scantimes = collections.deque(maxlen=100)
             self.starttime = time.time()
             self.lastscan = 0
             self.stat_listener_callback = []
-
+            self.lock = threading.Lock()
+            self.local = threading.local()
+            self.blocks = [] # (thread, counters dict of the thread, histograms dict of the thread)
+            self.base = {} # counters of ended threads and worker processes
+            self.basehistograms = {}
+            self.sources = {} # name -> callback returning counters, eg. of worker processes
+        if not hasattr(self, 'providers'):
+            self.providers = {}
+
+    def _get_block(self):
+        """returns the counters of the current thread"""
+        counters = getattr(self.local, 'counters', None)
+        if counters is None:
+            counters = {}
+            self.local.counters = counters
+            self.local.histograms = {}
+            with self.lock:
+                self.blocks.append((threading.current_thread(), counters, self.local.histograms))
+        return counters
+
+    def _get_histograms(self):
+        """returns the histograms of the current thread"""
+        histograms = getattr(self.local, 'histograms', None)
+        if histograms is None:
+            self._get_block()
+            histograms = self.local.histograms
+        return histograms
+
+    def record_latency(self, name, duration):
+        """record duration (seconds) in the latency histogram name"""
+        histograms = self._get_histograms()
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = Histogram()
+            histograms[name] = histogram
+        histogram.record(duration)
+
+    def record_plugin_call(self, plugin, duration):
+        """count a call of plugin (examine, including verdict cache lookups) which took duration seconds"""
+        counters = self._get_block()
+        prefix = 'plugin.%s' % plugin_counter_name(plugin_name(plugin))
+        key = prefix + '.calls'
+        counters[key] = counters.get(key, 0) + 1
+        key = prefix + '.time'
+        counters[key] = counters.get(key, 0) + duration
+        self.record_latency(prefix, duration)
+
+    def count_plugin_result(self, plugin, action=None, error=False, decision=False):
+        """count the outcome of a plugin call: the action it returned, an exception, or a decision ending the
+        plugin run (action other than dunno)"""
+        counters = self._get_block()
+        prefix = 'plugin.%s' % plugin_counter_name(plugin_name(plugin))
+        if action is not None:
+            key = '%s.action.%s' % (prefix, action)
+            counters[key] = counters.get(key, 0) + 1
+        if error:
+            key = prefix + '.errors'
+            counters[key] = counters.get(key, 0) + 1
+        if decision:
+            key = prefix + '.decisions'
+            counters[key] = counters.get(key, 0) + 1
+
+    def plugin_stats(self):
+        """returns a dict plugin name (see plugin_name) -> dict with calls, time (seconds), mean, percentiles (seconds), errors,
+        decisions (runs ended by the plugin), actions (dict action -> count) and share (of the total request time)"""
+        counters = self.get_counters()
+        histograms = self.get_histograms()
+        result = {}
+        for name, value in counters.items():
+            if not name.startswith('plugin.'):
+                continue
+            plugin, key = name[len('plugin.'):].split('.', 1)
+            plugin = _unquote_plugin(plugin)
+            entry = result.get(plugin)
+            if entry is None:
+                entry = dict(calls=0, time=0.0, errors=0, decisions=0, actions={})
+                result[plugin] = entry
+            if key.startswith('action.'):
+                entry['actions'][key[len('action.'):]] = value
+            else:
+                entry[key] = value
+        request = histograms.get('request')
+        requesttime = request.sum if request is not None else 0
+        for plugin, entry in result.items():
+            entry['mean'] = entry['time'] / entry['calls'] if entry['calls'] else 0.0
+            entry['share'] = entry['time'] / requesttime if requesttime else 0.0
+            histogram = histograms.get('plugin.%s' % plugin_counter_name(plugin))
+            entry['percentiles'] = histogram.percentiles() if histogram is not None else {}
+        return result
+
+    def record_request(self, duration, port=None, action=None):
+        """record the time a request took until its answer, by incoming port and final action"""
+        self.record_latency('request', duration)
+        if port is not None:
+            self.record_latency('port.%s' % port, duration)
+        if action is not None:
+            self.record_latency('action.%s' % action.lower(), duration)
+
+    def reset_counters(self):
+        """drop all counters and counter sources. called in forked worker processes, the counters inherited
+        from the parent are still reported by the parent"""
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.blocks = []
+        self.base = {}
+        self.basehistograms = {}
+        self.sources = {}
+
+    def count(self, name, value=1):
+        counters = self._get_block()
+        counters[name] = counters.get(name, 0) + value
+
+    def add_counters(self, counters, callback=None):
+        """add counters to the totals (eg. of an ended worker process). callback is called while the totals
+        are locked, so the counters can be removed from their source without being counted twice"""
+        with self.lock:
+            add_counters(self.base, counters)
+            if callback is not None:
+                callback()
+
+    def register_counter_source(self, name, callback):
+        """register a callback returning counters kept elsewhere (eg. in shared memory by worker processes)"""
+        self.sources[name] = callback
+
+    def unregister_counter_source(self, name):
+        self.sources.pop(name, None)
+
+    def local_counters(self):
+        """returns the sum of the counters of all threads of this process"""
+        with self.lock:
+            return self._local_counters()
+
+    def _local_counters(self):
+        alive = self._fold_blocks()
+        result = dict(self.base)
+        for thread, counters, histograms in alive:
+            add_counters(result, dict(counters))
+        return result
+
+    def _fold_blocks(self):
+        """add the counters of ended threads to the base, returns the blocks of the running threads"""
+        alive = []
+        for block in self.blocks:
+            thread, counters, histograms = block
+            if thread.is_alive():
+                alive.append(block)
+            else:
+                add_counters(self.base, dict(counters))
+                add_histograms(self.basehistograms, dict(histograms))
+        self.blocks = alive
+        return alive
+
+    def add_histograms(self, histograms):
+        """merge histograms (dict name -> Histogram, eg. from a worker process) into the totals"""
+        with self.lock:
+            add_histograms(self.basehistograms, histograms)
+
+    def get_histograms(self):
+        """returns the latency histograms of all threads as dict name -> Histogram. Worker processes
+        send the changes of theirs to the parent with the other counters, see procpool.CounterExporter"""
+        with self.lock:
+            alive = self._fold_blocks()
+            result = {}
+            add_histograms(result, self.basehistograms)
+            for thread, counters, histograms in alive:
+                add_histograms(result, dict(histograms))
+        return result
+
+    def get_counters(self):
+        """returns the sum of all counters, including those of the registered sources"""
+        with self.lock:
+            result = self._local_counters()
+            for name, callback in list(self.sources.items()):
+                try:
+                    add_counters(result, callback())
+                except Exception as e:
+                    logging.getLogger('postomaat.stats').error('Counter source %s failed: %s' % (name, str(e)))
+        return result
+
+    @property
+    def totalcount(self):
+        return self.get_counters().get('total', 0)
+
+    @property
+    def spamcount(self):
+        return self.get_counters().get('spam', 0)
+
+    @property
+    def hamcount(self):
+        return self.get_counters().get('ham', 0)
+
+    @property
+    def viruscount(self):
+        return self.get_counters().get('virus', 0)
+
+    @property
+    def blockedcount(self):
+        return self.get_counters().get('blocked', 0)
+
+    @property
+    def incount(self):
+        return self.get_counters().get('in', 0)
+
+    @property
+    def outcount(self):
+        return self.get_counters().get('out', 0)
+
+    @property
+    def timeoutcount(self):
+        return self.get_counters().get('timeouts', 0)
+
+    @property
+    def timeouts(self):
+        return keyed_counters(self.get_counters(), 'timeouts')
+
+    @property
+    def shedcount(self):
+        return self.get_counters().get('shed', 0)
+
+    @property
+    def shed(self):
+        return keyed_counters(self.get_counters(), 'shed')
 
     def uptime(self):
         """uptime since we started postomaat"""
@@ -86,6 +449,26 @@ class Statskeeper(object):
         string += str(seconds) + " " + (seconds == 1 and "second" or "seconds")
         return string
 
+    def register_provider(self, name, callback):
+        """register a callback returning detailed statistics of a component (eg. a list of dicts).
+        a provider registered again under the same name replaces the old one"""
+        self.providers[name] = callback
+
+    def unregister_provider(self, name):
+        self.providers.pop(name, None)
+
+    def provider_stats(self, names=None):
+        """returns a dict name -> statistics of all registered providers, or only of those in names"""
+        result = {}
+        for name, callback in list(self.providers.items()):
+            if names is not None and name not in names:
+                continue
+            try:
+                result[name] = callback()
+            except Exception as e:
+                logging.getLogger('postomaat.stats').error('Stats provider %s failed: %s' % (name, str(e)))
+        return result
+
     def numthreads(self):
         """return the number of threads"""
         return len(threading.enumerate())
@@ -116,18 +499,33 @@ class Statskeeper(object):
         self.increase_counter_values(delta)
 
     def increase_counter_values(self, statdelta):
-        self.totalcount += statdelta.total
-        self.spamcount += statdelta.spam
-        self.viruscount += statdelta.virus
-        self.hamcount += statdelta.ham
-        self.blockedcount += statdelta.blocked
+        counters = self._get_block()
+        for name, value in (('total', statdelta.total), ('spam', statdelta.spam), ('virus', statdelta.virus),
+                            ('ham', statdelta.ham), ('blocked', statdelta.blocked), ('in', statdelta.in_),
+                            ('out', statdelta.out)):
+            if value:
+                counters[name] = counters.get(name, 0) + value
         if statdelta.scantime:
             self._appendscantime(statdelta.scantime)
         self.lastscan = time.time()
-        self.incount += statdelta.in_
-        self.outcount += statdelta.out
+        for name, count in statdelta.timeouts.items():
+            counters['timeouts'] = counters.get('timeouts', 0) + count
+            key = 'timeouts.%s' % name
+            counters[key] = counters.get(key, 0) + count
+        for action, count in statdelta.shed.items():
+            counters['shed'] = counters.get('shed', 0) + count
+            key = 'shed.%s' % action
+            counters[key] = counters.get(key, 0) + count
         self.fire_stats_changed_event(statdelta)
 
+    def increase_timeouts(self, name):
+        """count a plugin running out of its time budget or a request running out of time"""
+        self.increase_counter_values(StatDelta(timeouts={name: 1}))
+
+    def increase_shed(self, action):
+        """count a request answered with action by admission control because the server is overloaded"""
+        self.increase_counter_values(StatDelta(shed={action: 1}))
+
     def fire_stats_changed_event(self,statdelta):
         for callback in self.stat_listener_callback:
             callback(statdelta)
@@ -135,7 +533,7 @@ class Statskeeper(object):
     def scantime(self):
         """Get the average scantime of the last 100 messages.
         If last msg is older than five minutes, return 0"""
-        tms = self.scantimes[:]
+        tms = list(self.scantimes)
         length = len(tms)
 
         # no entries in scantime list
@@ -145,7 +543,7 @@ class Statskeeper(object):
         # newest entry is older than five minutes
         # clear entries
         if time.time() - self.lastscan > 300:
-            self.scantimes = []
+            self.scantimes.clear()
             return "0"
 
         avg = sum(tms) / length
@@ -158,9 +556,6 @@ class Statskeeper(object):
             f = float(scantime)
         except:
             return
-        while len(self.scantimes) > 100:
-            del self.scantimes[0]
-
         self.scantimes.append(f)
 
 
@@ -175,6 +570,7 @@ class StatsThread(object):
         self.writeinterval = 30
         self.identifier = 'postomaat'
         self.stayalive = True
+        self.lasthistograms = {}
 
     def writestats(self):
         if self.config.has_option('main', 'mrtgdir'):
@@ -217,6 +613,34 @@ class StatsThread(object):
             self.write_mrtg(
                 '%s/scantime' % dir, self.stats.scantime(), None, uptime, self.identifier)
 
+            # plugin and request timeouts
+            self.write_mrtg(
+                '%s/timeouts' % dir, float(self.stats.timeoutcount), None, uptime, self.identifier)
+
+            # requests shed by admission control: total, rejected (anything but dunno)
+            rejected = sum(count for action, count in self.stats.shed.items() if action != 'dunno')
+            self.write_mrtg(
+                '%s/shed' % dir, float(self.stats.shedcount), float(rejected), uptime, self.identifier)
+
+            self.write_latencies(dir, uptime)
+
+    def write_latencies(self, dir, uptime):
+        """write latency percentiles (milliseconds) of the requests since the last write:
+        latency (p50, p99) and latency_tail (p90, p99.9) of all requests, latency_<histogram> (p50, p99)
+        per incoming port, final action and plugin"""
+        histograms = self.stats.get_histograms()
+        for name, histogram in histograms.items():
+            last = self.lasthistograms.get(name)
+            interval = histogram.diff(last) if last is not None else histogram
+            p50, p90, p99, p999 = [interval.percentile(q) * 1000 for q in (50, 90, 99, 99.9)]
+            if name == 'request':
+                self.write_mrtg('%s/latency' % dir, "%.3f" % p50, "%.3f" % p99, uptime, self.identifier)
+                self.write_mrtg('%s/latency_tail' % dir, "%.3f" % p90, "%.3f" % p999, uptime, self.identifier)
+            else:
+                filename = 'latency_%s' % re.sub(r'[^\w.-]', '_', name)
+                self.write_mrtg('%s/%s' % (dir, filename), "%.3f" % p50, "%.3f" % p99, uptime, self.identifier)
+        self.lasthistograms = histograms
+
     def write_mrtg(self, filename, value1, value2, uptime, identifier):
         try:
             with open(filename, 'w') as fp:
@@ -24,8 +24,13 @@ import logging
 
 
 class ThreadPool(threading.Thread):
+    """Worker threads consuming sessions from a queue.
 
-    def __init__(self, minthreads=1, maxthreads=20, queuesize=100):
+    The pool thread sleeps until add_task finds no idle worker for the new session (or the check interval
+    passes) and then spawns workers in batches. Workers idle for longer than idletimeout retire themselves
+    as long as there are more than minthreads, the pool never has to wait for a worker to finish."""
+
+    def __init__(self, minthreads=1, maxthreads=20, queuesize=100, idletimeout=30, spawnbatch=4, scalewait=0.05):
         self.workers = []
         self.queuesize = queuesize
         self.tasks = queue.Queue(queuesize)
@@ -33,14 +38,25 @@ class ThreadPool(threading.Thread):
         self.maxthreads = maxthreads
         assert self.minthreads > 0
         assert self.maxthreads > self.minthreads
+        self.idletimeout = idletimeout # seconds a worker above minthreads waits for a task before it retires
+        self.spawnbatch = max(spawnbatch, 1) # minimum number of workers started at once
+        self.scalewait = scalewait # queue wait in seconds that triggers spawning workers
 
         self.logger = logging.getLogger('%s.threadpool' % __package__)
         self.threadlistlock = threading.Lock()
-        self.checkinterval = 10
+        self.wakeup = threading.Event()
+        self.checkinterval = 1
         self.threadcounter = 0
         self._stayalive = True
         self.laststats = 0
         self.statinverval = 60
+        self.queuewait = 0.0 # moving average of the time tasks spent in the queue
+        self.idle = 0 # workers waiting for a task
+        self.idlelock = threading.Lock()
+        self.spawned = 0
+        self.retired = 0
+        self.scaleups = 0
+        self.lastscaleup = 0
         threading.Thread.__init__(self)
         self.name = 'Threadpool'
         self.daemon = False
@@ -56,89 +72,140 @@ class ThreadPool(threading.Thread):
         if self._stayalive and not value:
             self._stayalive = False
             self._send_poison_pills()
+            self.wakeup.set()
         self._stayalive = value
 
     def _send_poison_pills(self):
-        """flood the queue with poison pills to tell all workers to shut down"""
-        for _ in range(self.maxthreads):
-            self.tasks.put_nowait(None)
-
-    def add_task(self, session):
-        if self._stayalive:
-            self.tasks.put(session)
-
-    def get_task(self):
-        if self._stayalive:
-            return self.tasks.get(True)
-        else:
+        """flood the queue with poison pills to tell all workers to shut down. workers not getting one
+        (queue full) notice the shutdown after their next task or idle timeout"""
+        for _ in range(len(self.workers)):
+            try:
+                self.tasks.put_nowait(None)
+            except queue.Full:
+                break
+
+    def add_task(self, session, block=True):
+        """queue a session. returns False if the pool is shut down or block is False and the queue is full"""
+        if not self._stayalive:
+            return False
+        session.queuedtime = time.time()
+        try:
+            self.tasks.put(session, block)
+        except queue.Full:
+            self.wakeup.set()
+            return False
+        if self.idle < self.tasks.qsize() and len(self.workers) < self.maxthreads:
+            # no idle worker for this session, let the pool thread spawn some
+            self.wakeup.set()
+        return True
+
+    def queue_depth(self):
+        """number of sessions waiting for a worker"""
+        return self.tasks.qsize()
+
+    def queue_wait(self):
+        """estimated seconds a new session waits for a worker: the moving average of the recent queue wait times,
+        or the time the oldest session has been waiting if that is longer (eg. if all workers are stuck)"""
+        wait = self.queuewait
+        try:
+            oldest = self.tasks.queue[0]
+            wait = max(wait, time.time() - oldest.queuedtime)
+        except (IndexError, AttributeError):
+            pass
+        return wait
+
+    def _record_queuewait(self, session):
+        queuedtime = getattr(session, 'queuedtime', None)
+        if queuedtime is not None:
+            self.queuewait += (time.time() - queuedtime - self.queuewait) * 0.1
+
+    def get_task(self, timeout=None):
+        """returns the next session, None if the pool is shut down. raises queue.Empty after timeout seconds"""
+        if not self._stayalive:
             return None
+        with self.idlelock:
+            self.idle += 1
+        try:
+            return self.tasks.get(True, timeout)
+        finally:
+            with self.idlelock:
+                self.idle -= 1
+
+    def retire(self, worker):
+        """called by a worker which did not get a task within idletimeout. returns True if the worker should end"""
+        with self.threadlistlock:
+            if not self._stayalive:
+                return True
+            if len(self.workers) <= self.minthreads:
+                return False
+            try:
+                self.workers.remove(worker)
+            except ValueError:
+                pass
+            self.retired += 1
+        self.logger.debug('Retiring idle worker %s, %s workers left' % (worker.workerid, len(self.workers)))
+        return True
+
+    def stats(self):
+        """current size of the pool and its scaling decisions"""
+        return {
+            'workers': len(self.workers),
+            'idle': self.idle,
+            'minthreads': self.minthreads,
+            'maxthreads': self.maxthreads,
+            'queue_depth': self.queue_depth(),
+            'queue_wait': self.queue_wait(),
+            'spawned': self.spawned,
+            'retired': self.retired,
+            'scaleups': self.scaleups,
+            'lastscaleup': self.lastscaleup,
+        }
 
     def run(self):
-        self.logger.debug('Threadpool initializing. minthreads=%s maxthreads=%s maxqueue=%s checkinterval=%s' % (
-            self.minthreads, self.maxthreads, self.queuesize, self.checkinterval))
+        self.logger.debug('Threadpool initializing. minthreads=%s maxthreads=%s maxqueue=%s idletimeout=%s spawnbatch=%s scalewait=%s' % (
+            self.minthreads, self.maxthreads, self.queuesize, self.idletimeout, self.spawnbatch, self.scalewait))
 
         while self._stayalive:
-            curthreads = self.workers
-            numthreads = len(curthreads)
-
-            # check the minimum boundary
-            requiredminthreads = self.minthreads
-            if numthreads < requiredminthreads:
-                diff = requiredminthreads - numthreads
-                self._add_worker(diff)
-                continue
-
-            # check the maximum boundary
-            if numthreads > self.maxthreads:
-                diff = numthreads - self.maxthreads
-                self._remove_worker(diff)
-                continue
-
-            changed = False
-            # ok, we are within the boundaries, now check if we can dynamically
-            # adapt something
-            queuesize = self.tasks.qsize()
-
-            # if there are more tasks than current number of threads, we try to
-            # increase
-            workload = float(queuesize) / float(numthreads)
-
-            if workload > 1 and numthreads < self.maxthreads:
-                self._add_worker()
-                numthreads += 1
-                changed = True
-
-            if workload < 1 and numthreads > self.minthreads:
-                self._remove_worker()
-                numthreads -= 1
-                changed = True
+            self._scale()
 
             # log current stats
-            if changed or time.time() - self.laststats > self.statinverval:
-                workerlist = "\n%s" % '\n'.join(map(repr, self.workers))
-                self.logger.debug('queuesize=%s workload=%.2f workers=%s workerlist=%s' % (
-                    queuesize, workload, numthreads, workerlist))
+            if time.time() - self.laststats > self.statinverval:
+                self.logger.debug('threadpool stats: %s' % self.stats())
                 self.laststats = time.time()
 
-            time.sleep(self.checkinterval)
+            self.wakeup.wait(self.checkinterval)
+            self.wakeup.clear()
 
         self.logger.info('Threadpool shut down')
 
-    def _remove_worker(self, num=1):
-        self.logger.debug('Removing %s workerthread(s)' % num)
-        for bla in range(0, num):
-            worker = self.workers[0]
-            worker.stayalive = False
-            worker.join(120)
-            del self.workers[0]
+    def _scale(self):
+        """start workers if sessions are waiting without an idle worker or the queue wait is too long"""
+        numthreads = len(self.workers)
+        if numthreads < self.minthreads:
+            self._add_worker(self.minthreads - numthreads)
+            return
+
+        if numthreads >= self.maxthreads:
+            return
+        waiting = self.tasks.qsize()
+        missing = waiting - self.idle
+        if missing <= 0 and not (waiting and self.queue_wait() > self.scalewait):
+            return
+        num = min(max(missing, self.spawnbatch), self.maxthreads - numthreads)
+        self.scaleups += 1
+        self.lastscaleup = time.time()
+        self.logger.debug('%s sessions waiting, %s idle workers: adding %s workers' % (waiting, self.idle, num))
+        self._add_worker(num)
 
     def _add_worker(self, num=1):
         self.logger.debug('Adding %s workerthread(s)' % num)
-        for bla in range(0, num):
-            self.threadcounter += 1
-            worker = Worker("[%s]" % self.threadcounter, self)
-            self.workers.append(worker)
-            worker.start()
+        with self.threadlistlock:
+            for bla in range(0, num):
+                self.threadcounter += 1
+                worker = Worker("[%s]" % self.threadcounter, self)
+                self.workers.append(worker)
+                worker.start()
+            self.spawned += num
 
     def shutdown(self):
 
@@ -146,26 +213,26 @@ class ThreadPool(threading.Thread):
         # poison pills to the workers
         self.stayalive = False
 
-
-        # now remove elements from the queue
-        # first, put another poison pill for the Threadpool itself
-        self.tasks.put_nowait(None)
-        returnMessage = "Temporarily unavailable... Please try again later."
-        markDeferCounter = 0
+        # close the connections of sessions still queued, postfix retries them
+        closed = 0
         while True:
-            # don't use the get_task from Threadpool since this will
-            # not give anything once stayalive is False
-            sesshandler = self.tasks.get(True)
-            if sesshandler == None:  # poison pill -> shut down
+            try:
+                sesshandler = self.tasks.get_nowait()
+            except queue.Empty:
                 break
-            markDeferCounter += 1
-            sesshandler.protohandler.defer(returnMessage)
-
-        self.logger.info("Marked %s messages as '%s' to close queue" % (markDeferCounter,returnMessage))
-
-        # remove all the workers (joins them also)
-        for worker in self.workers:
-            worker.stayalive = False
+            if sesshandler is None:
+                continue
+            closed += 1
+            try:
+                sesshandler.incomingsocket.close()
+            except Exception:
+                pass
+        if closed:
+            self.logger.info("Closed %s queued sessions" % closed)
+
+        # the workers see stayalive=False after their current session
+        self._send_poison_pills()
+        for worker in list(self.workers):
             worker.join(120) # wait 120 seconds max
 
 class Worker(threading.Thread):
@@ -192,12 +259,18 @@ class Worker(threading.Thread):
             self.workerstate = 'waiting for task'
             if self.noisy:
                 self.logger.debug('Getting new task...')
-            sesshandler = self.pool.get_task()
+            try:
+                sesshandler = self.pool.get_task(self.pool.idletimeout)
+            except queue.Empty:
+                if self.pool.retire(self):
+                    self.stayalive = False
+                continue
             if sesshandler == None:  # poison pill -> shut down
                 if self.noisy:
                     self.logger.debug("got a poison pill .. good bye world")
                 self.stayalive = False
                 continue
+            self.pool._record_queuewait(sesshandler)
 
             if self.noisy:
                 self.logger.debug('Doing work')
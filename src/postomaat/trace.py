@@ -0,0 +1,214 @@
+# -*- coding: UTF-8 -*-
+#   Copyright 2012-2018 Oli Schacher
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# Spans of the request currently handled by this thread: accept, queue wait, protocol read, each plugin,
+# the dns/sql/redis/smtp calls of the plugins and the response write. Requests slower than
+# slow_request_threshold are logged with their span tree to the postomaat.slowrequests logger and kept
+# for the control command 'slow'. Without a threshold no trace is created and spans do nothing.
+
+import threading
+import collections
+import logging
+import time
+import os
+
+from postomaat.stats import timer
+
+_local = threading.local()
+
+# defaults, see configure()
+SETTINGS = dict(threshold=0.0, buffer=100)
+
+# the last slow requests of this process (the main process also keeps those of the worker processes)
+SLOW_REQUESTS = collections.deque(maxlen=SETTINGS['buffer'])
+
+# called with each slow request instead of keeping it, see set_sink
+_sink = None
+
+
+def configure(config):
+    """take the slow request settings from the [performance] section of config"""
+    global SLOW_REQUESTS
+    try:
+        SETTINGS['threshold'] = config.getfloat('performance', 'slow_request_threshold')
+    except Exception:
+        pass
+    try:
+        SETTINGS['buffer'] = max(config.getint('performance', 'slow_request_buffer'), 1)
+    except Exception:
+        pass
+    if SLOW_REQUESTS.maxlen != SETTINGS['buffer']:
+        SLOW_REQUESTS = collections.deque(SLOW_REQUESTS, maxlen=SETTINGS['buffer'])
+
+
+def set_sink(sink):
+    """let worker processes pass their slow requests to the parent instead of keeping them"""
+    global _sink
+    _sink = sink
+
+
+def new_trace(starttime=None):
+    """returns a Trace for a request starting at starttime (timer()), None if tracing is disabled"""
+    if SETTINGS['threshold'] <= 0:
+        return None
+    return Trace(starttime)
+
+
+def get_trace():
+    """returns the trace of the current thread or None"""
+    return getattr(_local, 'trace', None)
+
+
+def span_name(kind, details):
+    if not details:
+        return kind
+    return '%s %s' % (kind, ' '.join(str(detail) for detail in details))
+
+
+class Trace(object):
+    """the spans of one request. spans are lists [name, start, end, parent span] with timer() values"""
+
+    def __init__(self, starttime=None):
+        now = timer()
+        self.starttime = now if starttime is None else starttime
+        self.walltime = time.time() - (now - self.starttime)
+        self.endtime = None
+        self.spans = []
+        self.info = {}
+
+    def add(self, name, start, end=None, parent=None):
+        """add a span, returns it. spans may be added by several threads (concurrent plugins)"""
+        entry = [name, start, end, parent]
+        self.spans.append(entry)
+        return entry
+
+    def duration(self):
+        end = self.endtime if self.endtime is not None else timer()
+        return end - self.starttime
+
+    def as_dict(self):
+        """the trace as a dict with the span tree, times in milliseconds since the start of the trace"""
+        nodes = {}
+        roots = []
+        for entry in sorted(self.spans, key=lambda entry: entry[1]):
+            name, start, end, parent = entry
+            node = dict(name=name, start=round((start - self.starttime) * 1000, 3),
+                        duration=None if end is None else round((end - start) * 1000, 3), children=[])
+            nodes[id(entry)] = node
+            if parent is not None and id(parent) in nodes:
+                nodes[id(parent)]['children'].append(node)
+            else:
+                roots.append(node)
+        return dict(time=self.walltime, pid=os.getpid(), duration=round(self.duration() * 1000, 3),
+                    info=self.info, spans=roots)
+
+
+def format_slow_request(entry):
+    """returns the text of a slow request entry (Trace.as_dict) for the log"""
+    info = ' '.join('%s=%s' % (key, entry['info'][key]) for key in sorted(entry['info']))
+    lines = ['slow request %.1fms %s' % (entry['duration'], info)]
+
+    def add_lines(nodes, depth):
+        for node in nodes:
+            duration = '-' if node['duration'] is None else '%.1fms' % node['duration']
+            lines.append('%s+%.1fms %s %s' % ('  ' * depth, node['start'], duration, node['name']))
+            add_lines(node['children'], depth + 1)
+
+    add_lines(entry['spans'], 1)
+    return '\n'.join(lines)
+
+
+def finish(trace):
+    """end trace. if the request was slower than slow_request_threshold, log it and keep it for 'slow'"""
+    trace.endtime = timer()
+    if trace.duration() < SETTINGS['threshold']:
+        return None
+    entry = trace.as_dict()
+    logging.getLogger('%s.slowrequests' % __package__).warning(format_slow_request(entry))
+    store_slow_request(entry)
+    return entry
+
+
+def store_slow_request(entry):
+    if _sink is None:
+        SLOW_REQUESTS.append(entry)
+        return
+    try:
+        _sink(entry)
+    except Exception as e:
+        logging.getLogger('%s.slowrequests' % __package__).error('Could not pass slow request: %s' % str(e))
+
+
+def get_slow_requests(count=None):
+    """returns the last count slow requests, oldest first"""
+    entries = list(SLOW_REQUESTS)
+    if count is not None:
+        entries = entries[-count:] if count > 0 else []
+    return entries
+
+
+class trace_scope(object):
+    """context manager setting the trace of the current thread, spans started in the thread are top level
+    spans of the trace. keeps the current span if trace already is the trace of the thread"""
+
+    def __init__(self, trace):
+        self.trace = trace
+        self.previous = None
+
+    def __enter__(self):
+        self.previous = (getattr(_local, 'trace', None), getattr(_local, 'parent', None))
+        if self.previous[0] is not self.trace:
+            _local.trace = self.trace
+            _local.parent = None
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        _local.trace, _local.parent = self.previous
+        return False
+
+
+class span(object):
+    """context manager recording a span named kind and details in the trace of the current thread.
+    does nothing if the thread has no trace, the details are only formatted if a span is recorded"""
+
+    __slots__ = ('kind', 'details', 'trace', 'entry', 'previous')
+
+    def __init__(self, kind, *details):
+        self.kind = kind
+        self.details = details
+        self.trace = None
+
+    def __enter__(self):
+        trace = getattr(_local, 'trace', None)
+        if trace is not None:
+            self.trace = trace
+            self.previous = _local.parent
+            self.entry = trace.add(span_name(self.kind, self.details), timer(), None, self.previous)
+            _local.parent = self.entry
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.trace is not None:
+            self.entry[2] = timer()
+            _local.parent = self.previous
+        return False
+
+
+def add_span(kind, start, *details):
+    """record a span started at start (timer()) and ending now in the trace of the current thread"""
+    trace = getattr(_local, 'trace', None)
+    if trace is not None:
+        trace.add(span_name(kind, details), start, timer(), getattr(_local, 'parent', None))